@@ -0,0 +1,410 @@
+import argparse
+import csv
+import gc
+import glob
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from errors import DuplicateUrlError
+from exporter import write_export
+from importer import import_recipes
+from page_cache import PageCache
+from page_parser import find_recipe, parse_page, recipe_fields
+from recipe_store import COLUMNS, RecipeStore
+from similar_index import SimilarIndex
+from tag_index import TagIndex
+from tag_ops import make_transform
+from webpage import fetch_webpage_info
+
+# 生成するレシピの件数
+CORPUS_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_SIZES = [1000, 10000, 100000]
+# 1回の計測で繰り返す書き込みの回数
+WRITE_OPS = 100
+# ページ情報の取得を計測するページ数
+FETCH_PAGES = 50
+PAGE_SIZE = 20
+SEED = 42
+# ページの解析を計測する合成ページの数
+PARSE_PAGES = 50
+
+# 合成データに使う語彙
+INGREDIENTS = [
+    '鶏もも肉', '鶏むね肉', '豚バラ肉', '豚こま', '牛こま', 'ひき肉', '鮭', 'さば', 'ぶり', 'えび',
+    'いか', 'あさり', '豆腐', '厚揚げ', '卵', '大根', '人参', '玉ねぎ', 'じゃがいも', 'キャベツ',
+    '白菜', 'ほうれん草', '小松菜', 'なす', 'ピーマン', 'ブロッコリー', 'きのこ', 'しめじ', 'ごぼう', 'かぼちゃ',
+]
+METHODS = [
+    '照り焼き', '煮物', '炒め', '唐揚げ', '味噌汁', 'カレー', 'サラダ', '生姜焼き', '南蛮漬け', 'グラタン',
+    '天ぷら', 'マリネ', '炊き込みご飯', 'スープ', 'ナムル', 'きんぴら', '甘酢あん', 'ホイル焼き', '丼', 'パスタ',
+]
+ADJECTIVES = ['簡単', '絶品', 'やみつき', '時短', '基本の', 'ふわふわ', 'こってり', 'さっぱり', '作り置き', 'ごちそう']
+MEMO_PHRASES = [
+    '砂糖を少し控えめにした', '醤油を大さじ1に増やす', '弱火でじっくり煮込む', '子どもにも好評だった',
+    'にんにくを多めに入れる', '前日に下味をつけておくと良い', 'レンジで3分加熱してから焼く', '冷凍保存できる',
+    'ごま油で香りづけ', '仕上げに大葉をのせる', 'みりんの代わりに砂糖でも可', 'お弁当にぴったり',
+]
+TAGS = [
+    '和食', '洋食', '中華', '主菜', '副菜', '汁物', 'お弁当', '作り置き', '時短', '節約',
+    'ヘルシー', 'おもてなし', '子ども向け', 'おつまみ', '麺類', 'ご飯もの', 'デザート', 'パン', '鍋', '丼',
+]
+# タグの出現頻度は上位ほど多くなるようにする（Zipf分布に近い重み）
+TAG_WEIGHTS = [1 / (rank + 1) for rank in range(len(TAGS))]
+
+RECIPE_HTML = '''<!DOCTYPE html>
+<html lang="ja"><head>
+<meta charset="utf-8">
+<title>{title} | レシピサイト</title>
+<meta property="og:image" content="/images/{page}.jpg">
+{padding}
+</head><body><h1>{title}</h1><p>{memo}</p></body></html>'''
+
+# 実際のレシピサイトに近い、本文が長く末尾にJSON-LDがあるページ
+RECIPE_PAGE_HTML = '''<!DOCTYPE html>
+<html lang="ja"><head>
+<meta charset="utf-8">
+<title>{title} | レシピサイト</title>
+<meta property="og:image" content="/images/{page}.jpg">
+<link rel="canonical" href="/recipe/{page}">
+{head_padding}
+</head><body>
+<header><nav>{nav}</nav></header>
+<main><h1>{title}</h1><img src="/images/{page}-step.jpg"><p>{memo}</p>
+<ol>{steps}</ol></main>
+<footer>{nav}</footer>
+<script type="application/ld+json">{json_ld}</script>
+</body></html>'''
+
+def generate_recipe(rng, i):
+    ingredient = rng.choice(INGREDIENTS)
+    title = f'{rng.choice(ADJECTIVES)}{ingredient}の{rng.choice(METHODS)}'
+    memo = '。'.join(rng.sample(MEMO_PHRASES, rng.randint(0, 3)))
+    tags = rng.choices(TAGS, weights=TAG_WEIGHTS, k=rng.randint(1, 4))
+    return {
+        'URL': f'https://recipes.example.com/recipe/{i}',
+        'タイトル': title,
+        'メモ': memo,
+        'タグ': ','.join(dict.fromkeys(tags)),
+        '画像URL': f'https://img.recipes.example.com/{i}.jpg',
+    }
+
+def generate_corpus(size, seed=SEED, start=0):
+    # 同じシードからは常に同じレシピを生成する
+    rng = random.Random(seed + start)
+    for i in range(start, start + size):
+        yield generate_recipe(rng, i)
+
+def generate_page(rng, i):
+    recipe = generate_recipe(rng, i)
+    ingredients = [f'{name} {rng.randint(1, 300)}g' for name in rng.sample(INGREDIENTS, rng.randint(3, 10))]
+    json_ld = {
+        '@context': 'https://schema.org',
+        '@graph': [
+            {'@type': 'WebSite', 'name': 'レシピサイト'},
+            {
+                '@type': 'Recipe', 'name': recipe['タイトル'], 'image': [f'/images/{i}.jpg'],
+                'recipeIngredient': ingredients, 'recipeYield': f'{rng.randint(1, 4)}人分',
+                'prepTime': f'PT{rng.randint(5, 30)}M', 'cookTime': f'PT{rng.randint(5, 60)}M',
+            },
+        ],
+    }
+    return RECIPE_PAGE_HTML.format(
+        title=recipe['タイトル'], memo=recipe['メモ'], page=i,
+        head_padding='<link rel="stylesheet" href="/css/site.css">\n' * 30,
+        nav=''.join(f'<a href="/category/{tag}">{tag}</a>' for tag in TAGS) * 5,
+        steps=''.join(f'<li><p>{phrase}</p></li>' for phrase in rng.sample(MEMO_PHRASES, 8)) * 10,
+        json_ld=json.dumps(json_ld, ensure_ascii=False),
+    ).encode('utf-8')
+
+def legacy_parse(url, content):
+    # 以前の実装と同じく BeautifulSoup で文書全体の木を作ってから取り出す（比較用）
+    from bs4 import BeautifulSoup
+    from urllib.parse import urljoin
+    soup = BeautifulSoup(content, 'html.parser')
+    img_tag = soup.find('meta', property='og:image') or soup.find('img')
+    img_url = img_tag.get('content') or img_tag.get('src') if img_tag else None
+    link_tag = soup.find('link', rel='canonical')
+    recipe = None
+    for script in soup.find_all('script', type='application/ld+json'):
+        try:
+            recipe = find_recipe(json.loads(script.string or ''))
+        except ValueError:
+            continue
+        if recipe:
+            recipe = recipe_fields(recipe)
+            break
+    return {
+        'title': soup.title.string if soup.title else None,
+        'img_url': urljoin(url, img_url) if img_url else None,
+        'canonical_url': urljoin(url, link_tag.get('href')) if link_tag else None,
+        'recipe': recipe,
+    }
+
+def load_pages(pages_dir=None, seed=SEED):
+    # 保存したレシピページ（*.html）があればそれを、無ければ合成したページを使う
+    if pages_dir:
+        pages = []
+        for path in sorted(glob.glob(os.path.join(pages_dir, '*.htm*'))):
+            with open(path, 'rb') as f:
+                pages.append((f'https://recipes.example.com/{os.path.basename(path)}', f.read()))
+        return pages
+    rng = random.Random(seed)
+    return [(f'https://recipes.example.com/recipe/{i}', generate_page(rng, i)) for i in range(PARSE_PAGES)]
+
+def write_corpus_csv(path, recipes):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(recipes)
+
+def measure(fn, repeat=3):
+    # 経過時間は通常の実行で計り、ピークメモリは tracemalloc を有効にした別の1回で計る
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds_min': min(times),
+        'seconds_median': statistics.median(times),
+        'peak_bytes': peak,
+    }
+
+class StubHandler(BaseHTTPRequestHandler):
+    # レシピページの代わりに決まったHTMLを返す
+    protocol_version = 'HTTP/1.1'
+    # keep-aliveの接続でヘッダーと本文の送信が遅延しないようにする
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        page = self.path.rsplit('/', 1)[-1]
+        rng = random.Random(page)
+        recipe = generate_recipe(rng, 0)
+        body = RECIPE_HTML.format(
+            title=recipe['タイトル'], memo=recipe['メモ'], page=page,
+            padding='<meta name="description" content="レシピ">\n' * 200
+        ).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', f'"{page}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_store(size, workdir, repeat, seed):
+    results = {}
+    store = RecipeStore(os.path.join(workdir, f'bench_{size}.db'))
+    start = time.perf_counter()
+    store.insert_many(generate_corpus(size, seed), skip_existing=False)
+    results['build'] = {'seconds_min': time.perf_counter() - start, 'seconds_median': None, 'peak_bytes': None}
+
+    results['load_recipes'] = measure(store.load, repeat)
+    results['list_page_first'] = measure(lambda: store.list_page(0, PAGE_SIZE), repeat)
+    results['list_page_middle'] = measure(lambda: store.list_page(size // 2, PAGE_SIZE), repeat)
+    results['count'] = measure(store.count, repeat)
+
+    # 書き込みは WRITE_OPS 回まとめて計り、1回あたりの時間に直す
+    new_recipes = iter(generate_corpus(WRITE_OPS * (repeat + 1), seed, start=size))
+    inserted = []
+    def save_recipes():
+        for _ in range(WRITE_OPS):
+            recipe = next(new_recipes)
+            try:
+                inserted.append(store.insert(recipe))
+            except DuplicateUrlError:
+                pass
+    def update_recipes():
+        for recipe_id in inserted[-WRITE_OPS:]:
+            store.update(recipe_id, {'メモ': '更新したメモ', 'タグ': '和食,更新'})
+    def delete_recipes():
+        for _ in range(min(WRITE_OPS, len(inserted))):
+            store.delete(inserted.pop())
+    for name, fn in (('save_recipe', save_recipes), ('update_recipe', update_recipes), ('delete_recipe', delete_recipes)):
+        result = measure(fn, 1)
+        result['seconds_min'] /= WRITE_OPS
+        result['seconds_median'] /= WRITE_OPS
+        result['ops'] = WRITE_OPS
+        results[name] = result
+
+    tag_index = TagIndex()
+    def rebuild_tags():
+        tag_index.rebuild(store.iter_tags(), store.data_version())
+        return tag_index.all_tags()
+    results['get_all_tags'] = measure(rebuild_tags, repeat)
+    results['get_all_tags_cached'] = measure(tag_index.all_tags, repeat)
+    results['filter_by_tags'] = measure(lambda: tag_index.query(['和食', '主菜']), repeat)
+    results['search'] = measure(lambda: store.search('鶏もも肉 照り焼き'), repeat)
+
+    # タグの一括変更は、プレビューと1つのトランザクションでの書き込みを計る（計るたびに名前を行き来させる）
+    renames = [('時短', 'かんたん'), ('かんたん', '時短')]
+    retag_ids = tag_index.query(['時短'])
+    def rename_tag(dry_run=False):
+        source, target = renames[0] if dry_run else renames.pop(0)
+        if not dry_run:
+            renames.append((source, target))
+        return store.retag(retag_ids, make_transform('rename', [source], [target]), dry_run)
+    results['retag_preview'] = measure(lambda: rename_tag(dry_run=True), repeat)
+    results['retag'] = measure(rename_tag, repeat)
+
+    # 類似レシピは行列を作り直す時間と、作った行列・保存した行列を使う時間を計る
+    similar_path = os.path.join(workdir, f'similar_{size}.npz')
+    similar_index = SimilarIndex(similar_path)
+    results['similar_rebuild'] = measure(lambda: similar_index.rebuild(store.iter_texts(), store.data_version()), 1)
+    results['similar_load'] = measure(lambda: SimilarIndex(similar_path).load(store.data_version()), repeat)
+    results['similar_recipes'] = measure(lambda: similar_index.similar(size // 2), repeat)
+    results['what_can_i_cook'] = measure(lambda: similar_index.query('鶏もも肉 玉ねぎ 卵'), repeat)
+    def update_similar():
+        for recipe_id in range(1, WRITE_OPS + 1):
+            version = similar_index.version
+            similar_index.apply(version, version + 1, [('add', recipe_id, store.get(recipe_id))])
+    result = measure(update_similar, 1)
+    similar_index.flush()
+    result['seconds_min'] /= WRITE_OPS
+    result['seconds_median'] /= WRITE_OPS
+    result['ops'] = WRITE_OPS
+    results['similar_update'] = result
+    results['export_csv'] = measure(lambda: write_export(store.iter_frames(), io.BytesIO(), 'csv'), repeat)
+    store.conn.close()
+
+    # インポートは空のデータベースに取り込む時間を計る
+    csv_path = os.path.join(workdir, f'bench_{size}.csv')
+    write_corpus_csv(csv_path, generate_corpus(size, seed))
+    def run_import():
+        path = os.path.join(workdir, f'import_{size}.db')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        target = RecipeStore(path)
+        with open(csv_path, 'rb') as f:
+            import_recipes(target, f)
+        target.conn.close()
+    results['import_csv'] = measure(run_import, 1)
+    return results
+
+def bench_fetch(workdir, repeat):
+    server = start_stub_server()
+    base = f'http://127.0.0.1:{server.server_port}/recipe'
+    urls = [f'{base}/{i}' for i in range(FETCH_PAGES)]
+    cache = PageCache(os.path.join(workdir, 'page_cache.json'))
+    try:
+        results = {
+            'get_webpage_info': measure(lambda: [fetch_webpage_info(url) for url in urls], repeat),
+        }
+        for url in urls:
+            fetch_webpage_info(url, cache)
+        results['get_webpage_info_cached'] = measure(lambda: [fetch_webpage_info(url, cache) for url in urls], repeat)
+    finally:
+        server.shutdown()
+    for result in results.values():
+        result['seconds_min'] /= FETCH_PAGES
+        result['seconds_median'] /= FETCH_PAGES
+        result['ops'] = FETCH_PAGES
+    return results
+
+def bench_parse(repeat, pages_dir=None, seed=SEED):
+    pages = load_pages(pages_dir, seed)
+    if not pages:
+        return {}
+    results = {
+        'parse_page_bs4': measure(lambda: [legacy_parse(url, content) for url, content in pages], repeat),
+        'parse_page': measure(lambda: [parse_page(url, content) for url, content in pages], repeat),
+    }
+    for result in results.values():
+        result['seconds_min'] /= len(pages)
+        result['seconds_median'] /= len(pages)
+        result['ops'] = len(pages)
+        result['bytes'] = sum(len(content) for _, content in pages) // len(pages)
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    # 前回の結果と比べて、時間の比（今回/前回）を表示する
+    previous = {(r['size'], r['name']): r for r in baseline['results']}
+    for result in results['results']:
+        before = previous.get((result['size'], result['name']))
+        if not before or not before['seconds_min']:
+            continue
+        ratio = result['seconds_min'] / before['seconds_min']
+        print(f"{result['name']:<26} {str(result['size']):>8} {ratio:6.2f}x", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description='レシピ帳の主な処理の速度とメモリ使用量を計測します（ネットワーク不要）')
+    parser.add_argument('--sizes', type=int, nargs='+', choices=CORPUS_SIZES, default=DEFAULT_SIZES, help='生成するレシピの件数')
+    parser.add_argument('--repeat', type=int, default=3, help='1つの処理を計測する回数')
+    parser.add_argument('--seed', type=int, default=SEED, help='合成データの乱数シード')
+    parser.add_argument('--output', help='結果を書き出すJSONファイル（省略時は標準出力）')
+    parser.add_argument('--compare', help='比較する前回の結果のJSONファイル')
+    parser.add_argument('--skip-fetch', action='store_true', help='ページ情報の取得を計測しない')
+    parser.add_argument('--skip-parse', action='store_true', help='ページの解析を計測しない')
+    parser.add_argument('--pages', help='解析の計測に使う保存済みのレシピページ（*.html）のディレクトリ（省略時は合成したページ）')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        if not args.skip_fetch:
+            for name, result in bench_fetch(workdir, args.repeat).items():
+                results.append({'name': name, 'size': None, **result})
+        if not args.skip_parse:
+            for name, result in bench_parse(args.repeat, args.pages, args.seed).items():
+                results.append({'name': name, 'size': None, **result})
+        for size in args.sizes:
+            print(f'{size}件のレシピで計測しています...', file=sys.stderr)
+            for name, result in bench_store(size, workdir, args.repeat, args.seed).items():
+                results.append({'name': name, 'size': size, **result})
+
+    output = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    text = json.dumps(output, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(output, json.load(f))
+
+if __name__ == '__main__':
+    main()
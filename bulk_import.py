@@ -0,0 +1,148 @@
+import argparse
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from canonical_url import canonicalize
+from webpage import RETRY_STATUSES
+
+# 同時に取得するURLの数（全体とホストごと）
+MAX_WORKERS = 8
+PER_HOST_LIMIT = 2
+# 失敗時の再試行回数とバックオフの初期値（秒）
+MAX_RETRIES = 3
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+URL_PATTERN = re.compile(r'https?://[^\s"\'<>]+')
+
+def parse_urls(text):
+    # テキストやブックマークのHTMLからURLを重複なく取り出す（計測用パラメーターなどの違いは同じURLとみなす）
+    urls = []
+    seen = set()
+    for url in URL_PATTERN.findall(text):
+        url = url.rstrip('.,;)')
+        key = canonicalize(url)
+        if key not in seen:
+            seen.add(key)
+            urls.append(url)
+    return urls
+
+class HostLimiter:
+    def __init__(self, per_host=PER_HOST_LIMIT):
+        self.per_host = per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def get(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
+
+def backoff_delay(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    # 指数バックオフ（フルジッター）
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+def is_retryable(error):
+    # 接続の失敗・タイムアウトと、一時的なエラーのステータスだけを再試行する
+    # （URLの誤りや404のような失敗は何度試しても変わらない）
+    import requests
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUSES
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+def _fetch_with_retry(url, fetch, limiter, retries, backoff):
+    for attempt in range(retries + 1):
+        try:
+            with limiter.get(url):
+                title, img_url = fetch(url)
+            return {'url': url, 'title': title, 'img_url': img_url, 'error': None}
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                return {'url': url, 'title': None, 'img_url': None, 'error': str(e)}
+            time.sleep(backoff_delay(attempt, backoff))
+
+def fetch_all(urls, fetch, max_workers=MAX_WORKERS, per_host=PER_HOST_LIMIT,
+              retries=MAX_RETRIES, backoff=BACKOFF_BASE, progress=None):
+    # 複数のURLのページ情報を並列に取得し、入力と同じ順序で返す
+    limiter = HostLimiter(per_host)
+    results = [None] * len(urls)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_fetch_with_retry, url, fetch, limiter, retries, backoff): i
+            for i, url in enumerate(urls)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            if progress:
+                progress(done, len(urls))
+    return results
+
+def to_recipes(results, memo='', tags='', details=None):
+    # 取得に成功した結果を保存用のレシピに変換する
+    # details を渡すと、ページから取り出した項目（正規のURL・材料など）も加える
+    recipes = []
+    failed = []
+    for result in results:
+        if result['error']:
+            failed.append(result)
+        else:
+            recipes.append({
+                'URL': result['url'],
+                'タイトル': result['title'],
+                'メモ': memo,
+                'タグ': tags,
+                '画像URL': result['img_url'],
+                **(details(result['url']) if details else {}),
+            })
+    return recipes, failed
+
+def print_progress(done, total, width=40):
+    filled = int(width * done / total) if total else width
+    sys.stderr.write(f"\r[{'#' * filled}{'.' * (width - filled)}] {done}/{total}")
+    if done == total:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description='URLの一覧からレシピをまとめて追加します')
+    parser.add_argument('file', help='URLを含むテキストまたはブックマークのHTMLファイル（-で標準入力）')
+    parser.add_argument('--tags', default='', help='追加するレシピに付けるタグ（カンマ区切り）')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help='全体の同時取得数')
+    parser.add_argument('--per-host', type=int, default=PER_HOST_LIMIT, help='ホストごとの同時取得数')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES, help='失敗時の再試行回数')
+    args = parser.parse_args()
+
+    if args.file == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.file, encoding='utf-8', errors='replace') as f:
+            text = f.read()
+    urls = parse_urls(text)
+
+    from page_cache import PageCache
+    from webpage import fetch_webpage_info, page_details
+    from recipe_store import open_store
+
+    cache = PageCache()
+    results = fetch_all(
+        urls, lambda url: fetch_webpage_info(url, cache, retry_failed=True),
+        max_workers=args.workers, per_host=args.per_host, retries=args.retries,
+        progress=print_progress,
+    )
+    recipes, failed = to_recipes(results, tags=args.tags, details=lambda url: page_details(url, cache))
+    cache.flush()
+    inserted = open_store().insert_many(recipes)
+    added, skipped = len(inserted), len(recipes) - len(inserted)
+
+    print(f"追加: {added}件 / 重複: {skipped}件 / 失敗: {len(failed)}件")
+    for result in failed:
+        print(f"  {result['url']}: {result['error']}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# 重複チェックのルールを上書きする設定ファイル（無ければ既定のルールを使う）
+RULES_FILE = 'url_rules.json'
+# 正規化の方式を変えたら上げる（保存済みのURLのインデックスが作り直される）
+CANONICAL_VERSION = '1'
+
+# 同じページでも共有元によって付く、内容に関係しないクエリパラメーター
+# ref や si のように、サイトによっては内容を表す名前は含めない
+# （使うサイトがあれば設定ファイルの extra_tracking_params に書くと、既定のものに加えて取り除く）
+TRACKING_PARAMS = [
+    'fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'yclid', 'msclkid', 'twclid', 'igshid',
+    'mc_cid', 'mc_eid', '_ga', '_gl', 'ref_src', 'spm', 'scid',
+]
+TRACKING_PREFIXES = ['utm_', 'hsa_', 'pk_', 'mtm_']
+# ホスト名の先頭から取り除く部分（www付き・モバイル版のサブドメインを同じサイトとして扱う）
+HOST_PREFIXES = ['www.', 'm.', 'sp.', 'mobile.', 'amp.']
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+PERCENT_ESCAPE = re.compile(r'%[0-9a-fA-F]{2}')
+
+_rules = None
+
+def load_rules(path=RULES_FILE):
+    # 既定のルールに設定ファイルの内容を重ねる
+    rules = {
+        'tracking_params': TRACKING_PARAMS,
+        'tracking_prefixes': TRACKING_PREFIXES,
+        'host_prefixes': HOST_PREFIXES,
+    }
+    extra_params = []
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            settings = json.load(f)
+        rules.update({key: value for key, value in settings.items() if key in rules})
+        extra_params = settings.get('extra_tracking_params', [])
+    return {
+        'tracking_params': sorted({name.lower() for name in rules['tracking_params'] + extra_params}),
+        'tracking_prefixes': sorted({prefix.lower() for prefix in rules['tracking_prefixes']}),
+        'host_prefixes': list(dict.fromkeys(prefix.lower() for prefix in rules['host_prefixes'])),
+    }
+
+def get_rules():
+    global _rules
+    if _rules is None:
+        _rules = load_rules()
+    return _rules
+
+def rules_version(rules=None):
+    # ルールが変わったことを検出するための値
+    data = json.dumps(rules or get_rules(), sort_keys=True).encode('utf-8')
+    return f'{CANONICAL_VERSION}-{hashlib.blake2b(data, digest_size=4).hexdigest()}'
+
+def _is_tracking(name, rules):
+    name = name.lower()
+    return name in rules['tracking_params'] or name.startswith(tuple(rules['tracking_prefixes']))
+
+def _normalize_host(host, rules):
+    host = host.lower().rstrip('.')
+    for prefix in rules['host_prefixes']:
+        # 「m.example」のようにドメイン名そのものになってしまう場合は取り除かない
+        if host.startswith(prefix) and '.' in host[len(prefix):]:
+            host = host[len(prefix):]
+            break
+    return host
+
+def canonicalize(url, rules=None):
+    # 重複チェック用の正規形を返す（表示や保存には元のURLを使う）
+    # http/https・www/モバイル版・末尾のスラッシュ・計測用パラメーター・フラグメントの違いを無視する
+    rules = rules or get_rules()
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS:
+        return url.strip()
+    host = _normalize_host(parts.hostname or '', rules)
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != DEFAULT_PORTS[scheme]:
+        host = f'{host}:{port}'
+
+    path = PERCENT_ESCAPE.sub(lambda m: m.group(0).upper(), parts.path)
+    path = re.sub(r'/{2,}', '/', path).rstrip('/') or '/'
+
+    params = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if not _is_tracking(name, rules)]
+    query = urlencode(sorted(params))
+    return urlunsplit(('https', host, path, query, ''))
+
+def url_key(url, rules=None):
+    # 正規形を8バイトのハッシュにして、インデックスのキーにする
+    return hashlib.blake2b(canonicalize(url, rules).encode('utf-8'), digest_size=8).digest()
+
+def main():
+    parser = argparse.ArgumentParser(description='重複チェックに使うURLの正規形を表示します')
+    parser.add_argument('urls', nargs='*', help='正規化するURL（省略時は標準入力から1行に1つずつ）')
+    parser.add_argument('--rules', default=RULES_FILE, help='ルールの設定ファイル')
+    args = parser.parse_args()
+
+    rules = load_rules(args.rules)
+    for url in args.urls or (line.strip() for line in sys.stdin if line.strip()):
+        print(f'{url}\t{canonicalize(url, rules)}')
+
+if __name__ == '__main__':
+    main()
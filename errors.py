@@ -0,0 +1,9 @@
+# SQLiteとGoogle Sheetsのどちらの保存先でも使う例外
+
+class ConflictError(Exception):
+    # 他のセッションが先に更新・削除したレシピを書き換えようとした
+    pass
+
+class DuplicateUrlError(Exception):
+    # 他のレシピと同じURLに書き換えようとした
+    pass
@@ -0,0 +1,83 @@
+import argparse
+import gzip
+import json
+import tempfile
+
+# 形式ごとの拡張子とMIMEタイプ
+FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'jsonl': ('jsonl', 'application/x-ndjson'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+FORMAT_LABELS = {'csv': 'CSV', 'jsonl': 'JSON Lines', 'parquet': 'Parquet'}
+# メモリ上に置くサイズの上限（超えたら一時ファイルに書き出す）
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+def export_filename(fmt, compress=False, basename='recipes'):
+    ext, _ = FORMATS[fmt]
+    if compress and fmt != 'parquet':
+        ext += '.gz'
+    return f'{basename}.{ext}'
+
+def export_mime(fmt, compress=False):
+    if compress and fmt != 'parquet':
+        return 'application/gzip'
+    return FORMATS[fmt][1]
+
+def _write_text(frames, out, fmt):
+    first = True
+    for df in frames:
+        if fmt == 'csv':
+            text = df.to_csv(index=False, header=first)
+        else:
+            records = df.astype(object).where(df.notna(), None).to_dict('records')
+            text = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        out.write(text.encode('utf-8'))
+        first = False
+    if first and fmt == 'csv':
+        # レシピが無くてもヘッダー行だけは書き出す
+        from recipe_store import COLUMNS
+        out.write((','.join(COLUMNS) + '\n').encode('utf-8'))
+
+def _write_parquet(frames, out, compress):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from recipe_store import COLUMNS, INTEGER_COLUMNS
+
+    # 整数の列以外は文字列として扱い、チャンクごとに行グループとして書き出す
+    schema = pa.schema([(column, pa.int64() if column in INTEGER_COLUMNS else pa.string()) for column in COLUMNS])
+    with pq.ParquetWriter(out, schema, compression='gzip' if compress else 'snappy') as writer:
+        for df in frames:
+            df = df.reindex(columns=COLUMNS).astype(object).where(df.notna(), None)
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+
+def write_export(frames, out, fmt='csv', compress=False):
+    # DataFrameのチャンクを順に書き出す（全件をメモリに載せない）
+    if fmt == 'parquet':
+        _write_parquet(frames, out, compress)
+    elif compress:
+        with gzip.GzipFile(fileobj=out, mode='wb') as gz:
+            _write_text(frames, gz, fmt)
+    else:
+        _write_text(frames, out, fmt)
+
+def export_to_tempfile(frames, fmt='csv', compress=False):
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    write_export(frames, out, fmt, compress)
+    out.seek(0)
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description='保存したレシピをファイルにエクスポートします')
+    parser.add_argument('output', help='出力先のファイル')
+    parser.add_argument('--format', choices=list(FORMATS), default='csv', help='出力形式')
+    parser.add_argument('--gzip', action='store_true', help='gzipで圧縮する')
+    args = parser.parse_args()
+
+    from recipe_store import open_store
+    store = open_store()
+    with open(args.output, 'wb') as out:
+        write_export(store.iter_frames(), out, args.format, args.gzip)
+
+if __name__ == '__main__':
+    main()
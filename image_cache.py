@@ -0,0 +1,263 @@
+import atexit
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from webpage import CONNECT_TIMEOUT, READ_TIMEOUT, CHUNK_SIZE, get_session
+import tracing
+
+# 画像キャッシュを置くディレクトリ
+IMAGE_CACHE_DIR = 'image_cache'
+INDEX_FILE = 'index.json'
+# キャッシュ全体の容量の上限（超えたら最後に使った時刻が古いものから削除する）
+MAX_CACHE_BYTES = 200 * 1024 * 1024
+# 1枚の画像としてダウンロードする最大バイト数
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+# 一覧に表示するサムネイルの大きさと画質
+THUMBNAIL_SIZE = (480, 360)
+THUMBNAIL_QUALITY = 80
+# バックグラウンドでダウンロードする並列数
+DOWNLOAD_WORKERS = 4
+# ダウンロードに失敗した画像を再試行するまでの時間（秒）
+RETRY_AFTER = 60 * 60
+# 変更をまとめてインデックスに書き込むまでの待ち時間（秒）
+FLUSH_INTERVAL = 5
+
+def thumbnail_format():
+    # WebPが使えない環境ではJPEGにする
+    from PIL import features
+    return ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    # 画像を中央で切り抜いて固定サイズのサムネイルにする
+    from PIL import Image, ImageOps
+    fmt, _ = thumbnail_format()
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEGは縮小しながら読み込んでデコードを軽くする
+        image.draft('RGB', size)
+        image = ImageOps.exif_transpose(image)
+        has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha and fmt == 'WEBP' else 'RGB')
+        image = ImageOps.fit(image, size, Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, fmt, quality=quality)
+    return out.getvalue()
+
+def download_image(url, max_bytes=MAX_IMAGE_BYTES):
+    response = get_session().get(url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    with response:
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ValueError('画像のサイズが大きすぎます')
+        data = bytearray()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            data += chunk
+            if len(data) > max_bytes:
+                raise ValueError('画像のサイズが大きすぎます')
+    tracing.incr('bytes_fetched', len(data))
+    return bytes(data)
+
+def _write_file(path, data):
+    # 同じ画像を複数のスレッドが同時に書いても混ざらないよう、書き手ごとの一時ファイルに書いてから置き換える
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=f'{os.path.basename(path)}.', suffix='.tmp', delete=False) as f:
+        f.write(data)
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        _remove_file(f.name)
+        raise
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class ImageCache:
+    # 画像の内容のハッシュをキーにして、元の画像とサムネイルをディスクに保存する
+    # 同じ画像が別のURLで配信されていても1つだけ保存する
+    def __init__(self, root=IMAGE_CACHE_DIR, max_bytes=MAX_CACHE_BYTES, workers=DOWNLOAD_WORKERS, flush_interval=FLUSH_INTERVAL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        # ロックは必ず _flush_lock -> _lock の順に取る
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # 画像URL -> 内容のハッシュ
+        self._urls = {}
+        # 内容のハッシュ -> 保存したファイルの情報（最後に使った順）
+        self._objects = OrderedDict()
+        self._total_bytes = 0
+        # ダウンロード中の画像URLと、失敗した画像URL -> 失敗した時刻
+        self._pending = set()
+        self._failed = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # まだインデックスに書き込んでいない変更があるか
+        self._dirty = False
+        self._timer = None
+        self._load()
+        # 終了時に書き込み待ちの変更を保存する
+        atexit.register(self.flush)
+
+    def _index_path(self):
+        return os.path.join(self.root, INDEX_FILE)
+
+    def _load(self):
+        path = self._index_path()
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # 壊れたインデックスは無視して作り直す
+            return
+        for digest, entry in sorted(data.get('objects', {}).items(), key=lambda item: item[1].get('accessed_at', 0)):
+            self._objects[digest] = entry
+            self._total_bytes += entry['size']
+        self._urls = {url: digest for url, digest in data.get('urls', {}).items() if digest in self._objects}
+
+    def _mark_dirty(self):
+        # ダウンロードのたびにインデックス全体を書き直さず、一定時間後にまとめて書き込む
+        # （_lock を取った状態で呼ぶ）
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        # 最後に使った時刻は次の書き込みの際にまとめて保存する
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                data = json.dumps({'urls': self._urls, 'objects': self._objects}, ensure_ascii=False).encode('utf-8')
+                self._dirty = False
+            # 書き込み中もロックを離してサムネイルの参照を待たせない
+            try:
+                _write_file(self._index_path(), data)
+            except OSError:
+                # 書き込めなかった変更は次の機会に書き直す
+                with self._lock:
+                    self._dirty = True
+                raise
+
+    def _original_path(self, digest):
+        return os.path.join(self.root, 'originals', digest[:2], digest)
+
+    def _thumbnail_path(self, digest, ext):
+        return os.path.join(self.root, 'thumbnails', digest[:2], f'{digest}.{ext}')
+
+    def _evict(self):
+        # 容量の上限を超えた分を、最後に使った時刻が古いものから削除する（最新の1件は残す）
+        evicted = set()
+        while self._total_bytes > self.max_bytes and len(self._objects) > 1:
+            digest, entry = self._objects.popitem(last=False)
+            self._total_bytes -= entry['size']
+            _remove_file(self._original_path(digest))
+            _remove_file(self._thumbnail_path(digest, entry['thumbnail']))
+            evicted.add(digest)
+        if evicted:
+            self._urls = {url: digest for url, digest in self._urls.items() if digest not in evicted}
+
+    def _lookup(self, url):
+        # キャッシュ済みならハッシュとファイルの情報を返し、最後に使った時刻を更新する
+        with self._lock:
+            digest = self._urls.get(url)
+            if digest is None:
+                return None, None
+            entry = self._objects[digest]
+            if not os.path.exists(self._thumbnail_path(digest, entry['thumbnail'])):
+                # ファイルが外部から削除されていたら登録を外して取り直させる
+                del self._objects[digest]
+                self._total_bytes -= entry['size']
+                self._urls = {key: value for key, value in self._urls.items() if value != digest}
+                return None, None
+            entry['accessed_at'] = time.time()
+            self._objects.move_to_end(digest)
+            return digest, entry
+
+    def thumbnail(self, url):
+        # サムネイルのパスを返す（まだ無ければNone）
+        digest, entry = self._lookup(url)
+        tracing.incr('image_cache_hits' if digest else 'image_cache_misses')
+        return self._thumbnail_path(digest, entry['thumbnail']) if digest else None
+
+    def original(self, url):
+        digest, _ = self._lookup(url)
+        return self._original_path(digest) if digest else None
+
+    def is_failed(self, url):
+        with self._lock:
+            failed_at = self._failed.get(url)
+            return failed_at is not None and time.time() - failed_at < RETRY_AFTER
+
+    def is_pending(self, url):
+        with self._lock:
+            return url in self._pending
+
+    def fetch(self, url):
+        # 画像をダウンロードしてサムネイルを作り、サムネイルのパスを返す
+        path = self.thumbnail(url)
+        if path:
+            return path
+        try:
+            with tracing.span('download_image', url=url):
+                data = download_image(url)
+            digest = hashlib.sha256(data).hexdigest()
+            with self._lock:
+                entry = self._objects.get(digest)
+            if entry is None:
+                thumbnail = make_thumbnail(data)
+                _, ext = thumbnail_format()
+                _write_file(self._original_path(digest), data)
+                _write_file(self._thumbnail_path(digest, ext), thumbnail)
+                entry = {'size': len(data) + len(thumbnail), 'thumbnail': ext, 'accessed_at': time.time()}
+        except Exception:
+            with self._lock:
+                self._failed[url] = time.time()
+            raise
+
+        with self._lock:
+            if digest not in self._objects:
+                self._objects[digest] = entry
+                self._total_bytes += entry['size']
+            self._objects.move_to_end(digest)
+            self._urls[url] = digest
+            self._failed.pop(url, None)
+            self._evict()
+            self._mark_dirty()
+        return self._thumbnail_path(digest, entry['thumbnail'])
+
+    def _fetch_in_background(self, url):
+        try:
+            self.fetch(url)
+        except Exception:
+            # 失敗は記録済みなので、一定時間後の再試行に任せる
+            pass
+        finally:
+            with self._lock:
+                self._pending.discard(url)
+
+    def prefetch(self, urls):
+        # まだキャッシュに無い画像をバックグラウンドでダウンロードする
+        for url in urls:
+            if not url or self.is_failed(url):
+                continue
+            with self._lock:
+                if url in self._urls or url in self._pending:
+                    continue
+                self._pending.add(url)
+            self._executor.submit(self._fetch_in_background, url)
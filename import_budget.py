@@ -0,0 +1,73 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# 起動時の読み込み時間の上限（秒）と、起動時に読み込んではいけないモジュール
+# streamlit 自体の読み込みは両方のアプリで共通なので計測に含めない
+# 上限は計測した値（どちらも0.12〜0.21秒程度）の2倍近くにして、マシンの揺らぎで失敗しないようにする
+BUDGETS = {
+    'recipe_book': {
+        'seconds': 0.35,
+        'forbidden': ['pandas', 'bs4', 'requests', 'PIL', 'gspread', 'google.oauth2', 'scipy'],
+    },
+    'my_recipe_book': {
+        'seconds': 0.35,
+        'forbidden': ['pandas', 'bs4', 'requests', 'PIL', 'gspread', 'google.oauth2', 'scipy'],
+    },
+}
+REPEAT = 3
+
+# 新しいプロセスで streamlit を読み込んだ後、対象のモジュールの読み込みだけを計測する
+PROBE = '''
+import importlib, json, sys, time
+import streamlit
+before = set(sys.modules)
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'modules': sorted(set(sys.modules) - before)}))
+'''
+
+def probe(module):
+    result = subprocess.run([sys.executable, '-c', PROBE, module], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def check(module, budget, repeat=REPEAT):
+    # 何回か計測して一番速かった結果を使う（ディスクキャッシュの影響を減らす）
+    results = [probe(module) for _ in range(repeat)]
+    best = min(results, key=lambda result: result['seconds'])
+    loaded = set(best['modules'])
+    forbidden = [name for name in budget['forbidden'] if name in loaded]
+    return {
+        'module': module,
+        'seconds': best['seconds'],
+        'budget': budget['seconds'],
+        'margin': budget['seconds'] - best['seconds'],
+        'modules': len(loaded),
+        'forbidden': forbidden,
+        'ok': best['seconds'] <= budget['seconds'] and not forbidden,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='アプリの起動時に読み込まれるモジュールと読み込み時間を確認します')
+    parser.add_argument('modules', nargs='*', help=f"確認するモジュール（{', '.join(BUDGETS)}。省略時はすべて）")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='1つのモジュールを計測する回数')
+    args = parser.parse_args()
+    unknown = [module for module in args.modules if module not in BUDGETS]
+    if unknown:
+        parser.error(f"対象外のモジュールです: {', '.join(unknown)}")
+
+    failed = False
+    print(f"{'モジュール':<16}{'時間(秒)':>10}{'上限(秒)':>10}{'余裕(秒)':>10}{'読込数':>8}  結果")
+    for module in args.modules or list(BUDGETS):
+        result = check(module, BUDGETS[module], args.repeat)
+        status = 'OK' if result['ok'] else 'NG'
+        if result['forbidden']:
+            status += f" （読み込まれたモジュール: {', '.join(result['forbidden'])}）"
+        print(f"{module:<16}{result['seconds']:>10.3f}{result['budget']:>10.2f}{result['margin']:>10.3f}{result['modules']:>8}  {status}")
+        failed = failed or not result['ok']
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
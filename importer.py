@@ -0,0 +1,161 @@
+import argparse
+import sys
+from canonical_url import url_key
+from recipe_store import COLUMNS
+from tag_index import split_tags
+
+# 1回の書き込みで取り込む行数
+CHUNK_ROWS = 1000
+# 既存のレシピとURLが重複した場合の扱い
+MERGE_POLICIES = {
+    'keep': '既存のレシピを残す',
+    'overwrite': '取り込んだ内容で上書きする',
+    'merge_tags': '既存のレシピにタグを追加する',
+}
+# 後から追加した、ページのJSON-LDから取り出す列
+DETAIL_COLUMNS = ['材料', '調理時間', '分量']
+# 空ならNULLとして保存する列（画面から追加したレシピと同じにする）
+NULLABLE_COLUMNS = ['画像URL'] + DETAIL_COLUMNS
+# 列の数が正しくない行の代わりに読み込ませる印
+BAD_LINE = '\0bad_line'
+
+def merge_tags(*tag_strings):
+    tags = []
+    for tag_string in tag_strings:
+        tags.extend(split_tags(tag_string))
+    return ','.join(dict.fromkeys(tags))
+
+def _minutes(value):
+    # 調理時間は分の整数として取り込む（数値でなければ空にする）
+    try:
+        return int(float(value)) if value else None
+    except ValueError:
+        return None
+
+def _clean_row(row):
+    # ページから取り出した列がCSVに無い場合（古い形式のCSV）は含めず、上書きしても消えないようにする
+    recipe = {}
+    for column in COLUMNS:
+        if column in DETAIL_COLUMNS and column not in row:
+            continue
+        value = row.get(column)
+        value = value.strip() if isinstance(value, str) else None
+        recipe[column] = (value or None) if column in NULLABLE_COLUMNS else value
+    recipe['タグ'] = merge_tags(recipe['タグ'])
+    if '調理時間' in recipe:
+        recipe['調理時間'] = _minutes(recipe['調理時間'])
+    return recipe
+
+def validate_recipe(recipe):
+    if not recipe['URL']:
+        return 'URLが空です'
+    if not recipe['URL'].startswith(('http://', 'https://')):
+        return 'URLの形式が正しくありません'
+    if not recipe['タイトル']:
+        return 'タイトルが空です'
+    return None
+
+def _apply_policy(policy, current, recipe):
+    # 重複したレシピに対して、マージ方針に従った新しい内容を返す（変更しない場合はNone）
+    if policy == 'overwrite':
+        return {**current, **recipe}
+    if policy == 'merge_tags':
+        merged = dict(current)
+        merged['タグ'] = merge_tags(current.get('タグ'), recipe['タグ'])
+        return merged if merged['タグ'] != current.get('タグ') else None
+    return None
+
+def import_recipes(store, file, policy='overwrite', chunk_rows=CHUNK_ROWS, progress=None, on_write=None):
+    # CSVを少しずつ読み込み、チャンクごとに1回の書き込みで取り込む
+    # on_write にはチャンクを書き込むたびに、追加・更新したレシピの (操作, レシピID, タグ) の組を渡す
+    import pandas as pd
+    report = {'added': 0, 'updated': 0, 'skipped': 0, 'errors': []}
+
+    # 列の数が正しくない行は、後の行の行番号がずれないよう印を付けた行として読み進める
+    bad_lines = []
+    def on_bad_line(fields):
+        bad_lines.append(','.join(fields))
+        return [BAD_LINE]
+
+    total_size = getattr(file, 'size', None)
+
+    reader = pd.read_csv(
+        file, chunksize=chunk_rows, dtype=str, keep_default_na=False, encoding='utf-8-sig',
+        engine='python', on_bad_lines=on_bad_line
+    )
+    row_number = 1
+    for chunk in reader:
+        if 'URL' not in chunk.columns:
+            raise ValueError('CSVファイルにURL列がありません')
+
+        rows = []
+        for row in chunk.to_dict('records'):
+            row_number += 1
+            if next(iter(row.values()), None) == BAD_LINE:
+                report['errors'].append({'行': row_number, '理由': '列の数が正しくありません', '内容': bad_lines.pop(0)})
+                continue
+            recipe = _clean_row(row)
+            error = validate_recipe(recipe)
+            if error:
+                report['errors'].append({'行': row_number, '理由': error, '内容': ','.join(str(v) for v in row.values())})
+                continue
+            rows.append((row_number, url_key(recipe['URL']), recipe))
+
+        # 既存のレシピはチャンクごとにURLのインデックスでまとめて引く
+        # （前のチャンクで追加したレシピも書き込み済みなので見つかる）
+        existing = store.find_ids_by_keys({key for _, key, _ in rows})
+        inserts = {}
+        updates = {}
+        update_lines = {}
+        for line, key, recipe in rows:
+            if key in inserts:
+                # 同じファイル内で重複したURLは、まだ書き込む前の内容に方針を適用する
+                merged = _apply_policy(policy, inserts[key], recipe)
+                if merged:
+                    inserts[key] = merged
+                report['skipped'] += 1
+            elif key in existing:
+                if policy == 'keep':
+                    report['skipped'] += 1
+                    continue
+                recipe_id = existing[key]
+                current = updates.get(recipe_id) or store.get(recipe_id)
+                merged = _apply_policy(policy, current, recipe) if current else None
+                if merged:
+                    updates[recipe_id] = merged
+                    update_lines[recipe_id] = line
+                else:
+                    report['skipped'] += 1
+            else:
+                inserts[key] = recipe
+
+        # 既存のレシピは読み込んだときのバージョンのときだけ更新する（取り込み中に画面で編集された内容を上書きしない）
+        new_ids, conflicts = store.write_batch(list(inserts.values()), list(updates.items()))
+        for recipe_id in conflicts:
+            report['errors'].append({'行': update_lines[recipe_id], '理由': '取り込み中に他のユーザーが更新したため上書きしませんでした', '内容': updates.pop(recipe_id)['URL']})
+        report['added'] += len(new_ids)
+        report['updated'] += len(updates)
+        if on_write:
+            written = list(zip(new_ids, inserts.values())) + list(updates.items())
+            on_write([('add', recipe_id, recipe['タグ']) for recipe_id, recipe in written])
+
+        if progress:
+            fraction = min(file.tell() / total_size, 1.0) if total_size and hasattr(file, 'tell') else None
+            progress(row_number - 1, fraction)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='CSVファイルからレシピを取り込みます')
+    parser.add_argument('file', help='取り込むCSVファイル')
+    parser.add_argument('--policy', choices=list(MERGE_POLICIES), default='overwrite', help='URLが重複した場合の扱い')
+    args = parser.parse_args()
+
+    from recipe_store import open_store
+    with open(args.file, 'rb') as f:
+        report = import_recipes(open_store(), f, args.policy, progress=lambda rows, _: print(f'{rows}行を処理しました', file=sys.stderr))
+    print(f"追加: {report['added']}件 / 更新: {report['updated']}件 / スキップ: {report['skipped']}件 / エラー: {len(report['errors'])}件")
+    for error in report['errors']:
+        print(f"  {error['行'] or '-'}行目: {error['理由']}: {error['内容']}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
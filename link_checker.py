@@ -0,0 +1,257 @@
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bulk_import import HostLimiter
+from errors import ConflictError
+from page_parser import NO_TITLE
+from webpage import CONNECT_TIMEOUT, READ_TIMEOUT, fetch_head, get_session
+import tracing
+
+# 同じURLを再び確認するまでの間隔（秒）
+CHECK_INTERVAL = 7 * 24 * 60 * 60
+# 1回の確認で扱うレシピの件数
+BATCH_SIZE = 100
+# 同時に確認する数（全体とホストごと）と、同じホストへのリクエストの間隔（秒）
+MAX_WORKERS = 4
+PER_HOST_LIMIT = 1
+HOST_DELAY = 1.0
+# アプリ内で確認を繰り返す間隔と、起動してから最初に確認するまでの時間（秒）
+SCHEDULE_INTERVAL = 10 * 60
+START_DELAY = 60
+# リンク切れとみなすステータスコードと、連続して失敗した回数
+DEAD_STATUSES = (404, 410)
+DEAD_AFTER = 2
+# HEADに対応していないサーバーにはGETで確認し直す
+HEAD_FALLBACK_STATUSES = (403, 405, 501)
+
+def is_dead(entry):
+    # 確認結果からリンク切れかどうかを判定する（未確認ならFalse）
+    return entry is not None and (entry['status'] in DEAD_STATUSES or entry['failures'] >= DEAD_AFTER)
+
+def _new_entry(url, kind, previous):
+    # 前回の確認結果を引き継いだ新しい確認結果
+    entry = {
+        'url': url, 'kind': kind, 'status': None, 'error': None, 'failures': 0,
+        'etag': None, 'last_modified': None, 'title': None, 'img_url': None,
+        'checked_at': time.time(),
+    }
+    if previous:
+        for key in ('failures', 'etag', 'last_modified', 'title', 'img_url'):
+            entry[key] = previous[key]
+    return entry
+
+def _finish(entry, status=None, error=None):
+    entry['status'] = status
+    entry['error'] = error
+    ok = error is None and status is not None and status < 400
+    entry['failures'] = 0 if ok else entry['failures'] + 1
+    tracing.incr('links_checked')
+    return entry
+
+def check_page(url, previous=None):
+    # 条件付きGETでページを確認し、変わっていればタイトルと画像を取り出し直す
+    entry = _new_entry(url, 'page', previous)
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        with tracing.span('check_page', url=url):
+            response, info = fetch_head(url, headers)
+    except Exception as e:
+        return _finish(entry, error=str(e))
+    if 200 <= response.status_code < 300:
+        entry.update(
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            title=info['title'],
+            img_url=info['img_url'],
+        )
+    return _finish(entry, response.status_code)
+
+def check_image(url, previous=None):
+    # 画像はHEADで存在だけを確認する（本文はダウンロードしない）
+    entry = _new_entry(url, 'image', previous)
+    session = get_session()
+    timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    try:
+        with tracing.span('check_image', url=url):
+            response = session.head(url, allow_redirects=True, timeout=timeout)
+            if response.status_code in HEAD_FALLBACK_STATUSES:
+                with session.get(url, stream=True, timeout=timeout) as response:
+                    pass
+    except Exception as e:
+        return _finish(entry, error=str(e))
+    return _finish(entry, response.status_code)
+
+def refreshed_values(title, img_url, previous, page, image_dead=False):
+    # ページから取り出し直した値のうち、利用者が書き換えていない項目だけを新しい値にする
+    # （前回取り出した値と保存されている値が同じなら書き換えていないとみなす）
+    values = {}
+    new_title = page['title']
+    if new_title and new_title != NO_TITLE and new_title != title and previous and previous['title'] == title:
+        values['タイトル'] = new_title
+    new_img_url = page['img_url']
+    if new_img_url and new_img_url != img_url:
+        if not img_url or image_dead or (previous and previous['img_url'] == img_url):
+            values['画像URL'] = new_img_url
+    return values
+
+class LinkChecker:
+    # 保存したレシピのページと画像のリンクを少しずつ確認し、結果をデータベースに記録する
+    def __init__(self, store, tag_index=None, similar_index=None, max_age=CHECK_INTERVAL, batch_size=BATCH_SIZE,
+                 workers=MAX_WORKERS, per_host=PER_HOST_LIMIT, host_delay=HOST_DELAY):
+        self.store = store
+        self.tag_index = tag_index
+        self.similar_index = similar_index
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.workers = workers
+        self.host_delay = host_delay
+        self._limiter = HostLimiter(per_host)
+        self._run_lock = threading.Lock()
+        self._wake = threading.Event()
+        self.interval = SCHEDULE_INTERVAL
+        self.running = False
+        self.last_run = None
+        self.last_error = None
+
+    def _request(self, url, check, previous):
+        # ホストごとの同時接続数を守り、同じホストへのリクエストの間を空ける
+        with self._limiter.get(url):
+            try:
+                return check(url, previous)
+            finally:
+                time.sleep(self.host_delay)
+
+    def _check_recipe(self, recipe, statuses, checked_before):
+        recipe_id, url, img_url, title, version = recipe
+        entries = []
+        image = statuses.get(img_url)
+        if img_url and (image is None or image['checked_at'] < checked_before):
+            image = self._request(img_url, check_image, image)
+            entries.append(image)
+
+        previous = statuses.get(url)
+        if previous is not None and previous['checked_at'] >= checked_before:
+            return entries, None
+        page = self._request(url, check_page, previous)
+        entries.append(page)
+        if page['status'] is None or not 200 <= page['status'] < 300:
+            return entries, None
+        values = refreshed_values(title, img_url, previous, page, is_dead(image))
+        return entries, ((recipe_id, version, values) if values else None)
+
+    def _refresh(self, recipe_id, version, values):
+        # 確認している間に利用者が編集していたら上書きしない
+        expected_version = self.tag_index.version if self.tag_index is not None else None
+        expected_similar_version = self.similar_index.version if self.similar_index is not None else None
+        try:
+            self.store.update(recipe_id, values, version)
+        except ConflictError:
+            return False
+        new_version = self.store.data_version()
+        if self.tag_index is not None:
+            # タグは変わらないので、インデックスのバージョンだけ進める
+            self.tag_index.apply(expected_version, new_version, [])
+        if self.similar_index is not None:
+            # タイトルが変わった行だけ類似レシピの行列を更新する
+            changes = [('add', recipe_id, self.store.get(recipe_id))] if 'タイトル' in values else []
+            self.similar_index.apply(expected_similar_version, new_version, changes)
+        return True
+
+    def run_once(self, limit=None, checked_before=None):
+        # 確認の時期が来たレシピを1回分まとめて確認し、結果を返す
+        with self._run_lock:
+            self.running = True
+            try:
+                if checked_before is None:
+                    checked_before = time.time() - self.max_age
+                recipes = self.store.links_to_check(checked_before, limit or self.batch_size)
+                statuses = self.store.link_statuses(url for recipe in recipes for url in recipe[1:3])
+                with tracing.span('check_links', recipes=len(recipes)):
+                    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                        outcomes = list(executor.map(lambda recipe: self._check_recipe(recipe, statuses, checked_before), recipes))
+
+                entries = [entry for recipe_entries, _ in outcomes for entry in recipe_entries]
+                self.store.record_link_statuses(entries)
+                refreshed = sum(self._refresh(*refresh) for _, refresh in outcomes if refresh)
+                result = {
+                    'finished_at': time.time(),
+                    'recipes': len(recipes),
+                    'checked': len(entries),
+                    'dead': sum(is_dead(entry) for entry in entries),
+                    'refreshed': refreshed,
+                }
+                self.last_run = result
+                self.last_error = None
+                return result
+            finally:
+                self.running = False
+
+    def run_all(self, progress=None):
+        # 確認の時期が来たレシピが無くなるまで繰り返す（CLIから使う）
+        # 基準の時刻を固定して、確認し終えたレシピをもう一度確認しないようにする
+        checked_before = time.time() - self.max_age
+        totals = {'recipes': 0, 'checked': 0, 'dead': 0, 'refreshed': 0}
+        while True:
+            result = self.run_once(checked_before=checked_before)
+            for key in totals:
+                totals[key] += result[key]
+            if progress:
+                progress(totals)
+            if result['recipes'] < self.batch_size:
+                return totals
+
+    def start(self, interval=SCHEDULE_INTERVAL, start_delay=START_DELAY):
+        # アプリ内のスケジューラーとして、一定間隔で確認を繰り返すスレッドを起動する
+        self.interval = interval
+        threading.Thread(target=self._run, args=(start_delay,), daemon=True).start()
+
+    def _run(self, delay):
+        while True:
+            self._wake.wait(delay)
+            self._wake.clear()
+            try:
+                self.run_once()
+            except Exception as e:
+                # 失敗しても次の間隔で再び確認する
+                self.last_error = str(e)
+            delay = self.interval
+
+    def trigger(self):
+        # 次の間隔を待たずに確認を始める
+        self._wake.set()
+
+    def status(self):
+        return {
+            'running': self.running,
+            'last_run': self.last_run,
+            'last_error': self.last_error,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='保存したレシピのページと画像のリンク切れを確認します')
+    parser.add_argument('--limit', type=int, help='確認するレシピの件数（省略時は確認の時期が来たものすべて）')
+    parser.add_argument('--max-age', type=float, default=CHECK_INTERVAL / 86400, help='再確認するまでの日数')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help='全体の同時確認数')
+    parser.add_argument('--per-host', type=int, default=PER_HOST_LIMIT, help='ホストごとの同時確認数')
+    parser.add_argument('--delay', type=float, default=HOST_DELAY, help='同じホストへのリクエストの間隔（秒）')
+    args = parser.parse_args()
+
+    from recipe_store import open_store
+    checker = LinkChecker(
+        open_store(), max_age=args.max_age * 86400, workers=args.workers,
+        per_host=args.per_host, host_delay=args.delay,
+    )
+    if args.limit:
+        result = checker.run_once(args.limit)
+    else:
+        result = checker.run_all(lambda totals: print(f"{totals['recipes']}件を確認しました", file=sys.stderr))
+    print(f"レシピ: {result['recipes']}件 / 確認したURL: {result['checked']}件 / リンク切れ: {result['dead']}件 / 更新: {result['refreshed']}件")
+
+if __name__ == '__main__':
+    main()
@@ -1,89 +1,326 @@
 import streamlit as st
 from streamlit_tags import st_tags
-import requests
-from bs4 import BeautifulSoup
-import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
+import tracing
 import json
 import os
-from urllib.parse import urljoin
+import time
+from page_cache import PageCache
+from image_cache import ImageCache
+from webpage import fetch_webpage_info, page_details
+from bulk_import import parse_urls, fetch_all, to_recipes
+from canonical_url import url_key
+from tag_index import TagIndex, split_tags
+from similar_index import SimilarIndex
+from tag_ops import TAG_OPERATIONS, SELECTION_OPERATIONS, PREVIEW_ROWS, validate_operation, make_transform, describe
+from sheet_cache import SheetCache
+from errors import ConflictError
 
 # Google Sheets設定
 SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-SHEET_ID = st.secrets["GOOGLE_SHEET_ID"]
+# 手持ちの材料で作れるレシピとして表示する件数
+PANTRY_LIMIT = 10
+# タグをまとめて変更するレシピの選択肢として並べる件数
+SELECTION_LIMIT = 100
 
+def get_sheet_id():
+    # シークレットは読み込み時ではなく、最初にシートに接続するときに読む
+    return st.secrets["GOOGLE_SHEET_ID"]
+
+@st.cache_resource
+def get_page_cache():
+    # プロセス内で共有するページ情報キャッシュ
+    return PageCache()
+
+@tracing.traced()
 def get_webpage_info(url):
     try:
-        response = requests.get(url)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        title = soup.title.string if soup.title else "タイトルが見つかりません"
-        
-        # 画像URLの取得
-        img_tag = soup.find('meta', property='og:image')
-        img_url = img_tag['content'] if img_tag else None
-        
-        if not img_url:
-            img_tag = soup.find('img')
-            img_url = img_tag['src'] if img_tag else None
-        
-        # 相対パスを絶対パスに変換
-        if img_url and not img_url.startswith(('http://', 'https://')):
-            img_url = urljoin(url, img_url)
-        
-        return title, img_url
+        return fetch_webpage_info(url, get_page_cache())
     except Exception as e:
         st.error(f"ウェブページの情報取得中にエラーが発生しました: {str(e)}")
         return "URLが無効です", None
 
-def connect_to_sheet():
+@st.cache_resource
+def get_image_cache():
+    # プロセス内で共有する画像キャッシュ（サムネイルと元の画像）
+    return ImageCache()
+
+def show_preview_image(img_url):
+    # 追加前のプレビューは1枚だけなのでその場でダウンロードしてサムネイルを表示する
+    try:
+        st.image(get_image_cache().fetch(img_url), caption="レシピ画像")
+    except Exception as e:
+        st.warning(f"画像の表示中にエラーが発生しました: {str(e)}")
+
+def show_recipe_image(img_url, key):
+    # 一覧ではサムネイルだけを表示し、元の画像は求められたときに読み込む
+    image_cache = get_image_cache()
+    thumbnail = image_cache.thumbnail(img_url)
+    if thumbnail:
+        st.image(thumbnail, caption="レシピ画像")
+        if st.checkbox('元の画像を表示', key=f'original_{key}'):
+            st.image(image_cache.original(img_url) or img_url, use_column_width=True)
+    elif image_cache.is_failed(img_url):
+        st.warning("画像を読み込めませんでした。")
+        st.markdown(f"[元の画像を開く]({img_url})")
+    else:
+        image_cache.prefetch([img_url])
+        st.info("画像を準備しています。")
+
+@st.cache_resource
+def get_sheet_cache():
+    # 認証済みのクライアントとシートの内容をプロセス内で共有する
+    # Google関連のライブラリは最初に接続するときに読み込む
+    import gspread
+    from google.oauth2.service_account import Credentials
     creds_dict = json.loads(st.secrets["GOOGLE_CREDS_JSON"])
     creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPE)
-    client = gspread.authorize(creds)
-    sheet = client.open_by_key(SHEET_ID).sheet1
-    return sheet
+    with tracing.span('authorize'):
+        client = gspread.authorize(creds)
+    return SheetCache(client, get_sheet_id())
 
+def connect_to_sheet():
+    return get_sheet_cache().worksheet
+
+@tracing.traced()
 def load_recipes():
-    sheet = connect_to_sheet()
-    data = sheet.get_all_values()
-    if len(data) > 1:
-        return pd.DataFrame(data[1:], columns=data[0])
-    return pd.DataFrame(columns=['URL', 'タイトル', 'メモ', 'タグ', '画像URL'])
+    return get_sheet_cache().get()
 
+@tracing.traced()
 def save_recipe(url, title, memo, tags, img_url):
-    sheet = connect_to_sheet()
-    existing_urls = sheet.col_values(1)[1:]  # ヘッダーを除外
-    if url in existing_urls:
+    cache = get_sheet_cache()
+    # 取得済みのページが正規のURLを示していれば、それも重複チェックに使う
+    if cache.has_url(url, page_details(url, get_page_cache())['正規URL']):
         return False, "このURLのレシピはすでに存在しています。"
-    
     new_row = [url, title, memo, tags, img_url]
-    sheet.append_row(new_row)
+    expected_versions = index_versions()
+    recipe_ids = cache.append_rows([new_row])
+    update_indexes(expected_versions, [('add', recipe_ids[0], new_row)])
+    # 画像は保存時にバックグラウンドでダウンロードしておく
+    get_image_cache().prefetch([img_url])
     return True, "レシピが保存されました！"
 
-def update_recipe(index, url, title, memo, tags, img_url):
-    sheet = connect_to_sheet()
-    row = index + 2  # ヘッダー行とインデックスの調整
-    sheet.update(f'A{row}:E{row}', [[url, title, memo, tags, img_url]])
+@tracing.traced()
+def save_recipes(recipes):
+    # 複数のレシピを重複を除いてまとめて追加する（シートへの書き込みはまとめて行われる）
+    cache = get_sheet_cache()
+    added_keys = set()
+    new_rows = []
+    for recipe in recipes:
+        keys = {url_key(url) for url in (recipe['URL'], recipe.get('正規URL')) if url}
+        if keys & added_keys or cache.has_url(recipe['URL'], recipe.get('正規URL')):
+            continue
+        added_keys |= keys
+        new_rows.append([recipe['URL'], recipe['タイトル'], recipe['メモ'], recipe['タグ'], recipe['画像URL']])
+
+    if new_rows:
+        expected_versions = index_versions()
+        recipe_ids = cache.append_rows(new_rows)
+        update_indexes(expected_versions, [('add', recipe_id, row) for recipe_id, row in zip(recipe_ids, new_rows)])
+        get_image_cache().prefetch([row[4] for row in new_rows])
+    return len(new_rows), len(recipes) - len(new_rows)
 
-def delete_recipe(index):
-    sheet = connect_to_sheet()
-    sheet.delete_row(index + 2)  # ヘッダー行とインデックスの調整
+@tracing.traced()
+def update_recipe(recipe_id, url, title, memo, tags, img_url, row_version=None):
+    # row_version は編集を始めたときの行のバージョン（他のセッションが先に更新していたら ConflictError）
+    row = [url, title, memo, tags, img_url]
+    expected_versions = index_versions()
+    get_sheet_cache().update_row(recipe_id, list(row), row_version)
+    update_indexes(expected_versions, [('add', recipe_id, row)])
+
+@tracing.traced()
+def delete_recipe(recipe_id, row_version=None):
+    expected_versions = index_versions()
+    get_sheet_cache().delete_row(recipe_id, row_version)
+    update_indexes(expected_versions, [('remove', recipe_id, None)])
+
+@tracing.traced()
+def retag_recipes(op, sources, targets, ids, dry_run=False):
+    # タグの一括操作。変わるレシピの (ID, タイトル, 変更前, 変更後) を返す（dry_run ならプレビューだけ）
+    # 手元のコピーはまとめて書き換え、シートへは1回のAPI呼び出しで書き込まれる
+    cache = get_sheet_cache()
+    transform = make_transform(op, sources, targets)
+    if dry_run:
+        return cache.retag(ids, transform, dry_run=True)
+    expected_versions = index_versions()
+    changes = cache.retag(ids, transform)
+    if changes:
+        rows = cache.get().set_index('ID')
+        update_indexes(expected_versions, [
+            ('add', recipe_id, rows.loc[recipe_id, ['URL', 'タイトル', 'メモ', 'タグ', '画像URL']].tolist())
+            for recipe_id, _, _, _ in changes
+        ])
+    return changes
+
+def tagged_recipe_ids(tags):
+    # いずれかのタグを持つレシピID（OR条件）
+    tag_index = get_tag_index()
+    return sorted(set().union(*(tag_index.query([tag]) for tag in tags)))
+
+def show_tag_operation(op, sources, targets, ids, key):
+    # プレビューで変わるレシピを確認してから、1回の書き込みでまとめて変更する
+    if f'{key}_done' in st.session_state:
+        st.success(st.session_state.pop(f'{key}_done'))
+    error = validate_operation(op, sources, targets)
+    if error:
+        st.caption(error)
+        return
+    request = (op, tuple(sources), tuple(targets), tuple(ids))
+    if st.button('プレビュー', key=f'{key}_preview'):
+        st.session_state[f'{key}_plan'] = (request, retag_recipes(op, sources, targets, ids, dry_run=True))
+    plan = st.session_state.get(f'{key}_plan')
+    # 条件を変えたらプレビューし直す
+    if plan is None or plan[0] != request:
+        return
+    changes = plan[1]
+    if not changes:
+        st.info('タグが変わるレシピはありません。')
+        return
+    st.write(f"{describe(op, sources, targets)}: {len(changes)}件のレシピが変わります")
+    rows = [
+        {'ID': recipe_id, 'タイトル': title, '変更前': old_tags, '変更後': new_tags}
+        for recipe_id, title, old_tags, new_tags in changes[:PREVIEW_ROWS]
+    ]
+    st.dataframe(rows, hide_index=True, use_container_width=True)
+    if len(changes) > PREVIEW_ROWS:
+        st.caption(f"先頭の{PREVIEW_ROWS}件を表示しています")
+    if st.button(f'{len(changes)}件のレシピに適用', key=f'{key}_apply'):
+        # 書き込むときに読み直すので、プレビューの後に変わった行も正しく書き換える
+        applied = retag_recipes(op, sources, targets, ids)
+        del st.session_state[f'{key}_plan']
+        st.session_state[f'{key}_done'] = f"{len(applied)}件のレシピのタグを変更しました。"
+        st.experimental_rerun()
+
+def start_editing(recipe):
+    # 編集フォームに現在の内容と行のバージョンを読み込む
+    st.session_state.editing = recipe['ID']
+    st.session_state.edit_version = recipe['バージョン']
+    st.session_state.edit_url = recipe['URL']
+    st.session_state.edit_title = recipe['タイトル']
+    st.session_state.edit_memo = recipe['メモ']
+    st.session_state.edit_tags = split_tags(recipe['タグ'])
+    st.session_state.edit_img_url = recipe['画像URL']
+    st.session_state.edit_conflict = False
+
+@st.cache_resource
+def get_tag_index_cache():
+    # プロセス内で共有するタグの転置インデックス
+    return TagIndex()
+
+def get_tag_index():
+    # シートの内容のバージョンが変わったときだけインデックスを作り直す
+    df, version = get_sheet_cache().snapshot()
+    tag_index = get_tag_index_cache()
+    if tag_index.version != version:
+        with tracing.span('rebuild_tag_index'):
+            tag_index.rebuild(zip(df['ID'], df['タグ']), version)
+    return tag_index
+
+def update_tag_index(expected_version, changes):
+    # 書き込みの差分をタグのインデックスに反映する
+    get_tag_index_cache().apply(expected_version, get_sheet_cache().version, changes)
+
+@st.cache_resource
+def get_similar_index_cache():
+    # プロセス内で共有する類似レシピの行列（シートには材料の列が無いので、タイトル・メモ・タグから作る）
+    return SimilarIndex()
+
+def get_similar_index():
+    # シートの内容のバージョンが変わったときだけ、バックグラウンドで行列を作り直す
+    # 作り直している間は古い行列で答え、再実行の中では行列全体を計算し直さない
+    cache = get_sheet_cache()
+    similar_index = get_similar_index_cache()
+    if similar_index.version != cache.version:
+        def load():
+            # シートの内容とそのバージョンを同時に取り出す
+            df, version = cache.snapshot()
+            return version, zip(df['ID'], df['タイトル'], df['メモ'], df['タグ'], [None] * len(df))
+        similar_index.rebuild_in_background(load)
+    return similar_index
+
+def index_versions():
+    # 書き込む前のタグのインデックスと類似レシピの行列のバージョン
+    return get_tag_index_cache().version, get_similar_index_cache().version
+
+def update_indexes(expected_versions, changes):
+    # changes は (操作, レシピID, シートの行) の組で、書き込みの差分を両方に反映する
+    update_tag_index(expected_versions[0], [(action, recipe_id, row[3] if row else None) for action, recipe_id, row in changes])
+    get_similar_index_cache().apply(expected_versions[1], get_sheet_cache().version, [
+        (action, recipe_id, {'タイトル': row[1], 'メモ': row[2], 'タグ': row[3]} if row else None)
+        for action, recipe_id, row in changes
+    ])
 
 def get_all_tags():
-    df = load_recipes()
-    all_tags = set()
-    for tags in df['タグ']:
-        if isinstance(tags, str):
-            all_tags.update(tag.strip() for tag in tags.split(','))
-    return list(all_tags)
+    return get_tag_index().all_tags()
+
+def find_recipes(df, results):
+    # (レシピID, 類似度) の順に、シートの行と類似度を返す
+    rows = df.set_index('ID')
+    return [(rows.loc[recipe_id], score) for recipe_id, score in results if recipe_id in rows.index]
+
+def show_recipe_links(results):
+    for recipe, score in results:
+        st.markdown(f"- [{recipe['タイトル'] or '（タイトルなし）'}]({recipe['URL']})（類似度 {score:.2f}）")
+
+@tracing.traced()
+def filter_by_tags(df, selected_tags):
+    # タグのインデックスで該当するレシピIDの行だけをシートの順に取り出す（AND条件）
+    ids = get_tag_index().query(selected_tags)
+    return df[df['ID'].isin(ids)]
+
+def show_sync_status():
+    # シートへの書き込み状況をサイドバーに表示する
+    cache = get_sheet_cache()
+    status = cache.status()
+    with st.sidebar:
+        st.subheader('保存状況')
+        if status['pending']:
+            st.info(f"シートに未送信の変更: {status['pending']}件")
+        else:
+            st.success('すべての変更をシートに保存しました')
+        if status['last_error']:
+            st.warning(f"シートへの保存に失敗しました（自動で再試行します）: {status['last_error']}")
+        if status['conflicts']:
+            # 他のユーザーと同時に変更して上書きしなかった変更
+            with st.expander(f"他のユーザーの変更と競合した変更: {len(status['conflicts'])}件"):
+                for conflict in status['conflicts']:
+                    st.write(f"{time.strftime('%H:%M:%S', time.localtime(conflict['時刻']))} {conflict['ID']}: {conflict['理由']}")
+        if status['last_flush']:
+            st.caption(f"最終保存: {time.strftime('%H:%M:%S', time.localtime(status['last_flush']))}")
+        if st.button('今すぐ保存', disabled=not status['pending']):
+            cache.flush()
+            st.experimental_rerun()
+
+def show_debug_panel(current):
+    # サイドバーにこの再実行の処理時間とカウンターを表示する
+    # （他のセッションの再実行と混ざらないよう、このセッションのトレースを受け取る）
+    if not st.sidebar.checkbox('処理時間を表示（デバッグ）', key='show_debug_panel'):
+        return
+    trace_dict = current.to_dict()
+    with st.sidebar:
+        st.subheader('処理時間')
+        st.caption(f"再実行 {trace_dict['trace_id']}: {trace_dict['span']['duration_ms']:.1f}ms")
+        rows = [
+            {'処理': '　' * depth + name, 'ms': duration_ms}
+            for depth, name, duration_ms, _ in tracing.flatten(trace_dict)
+        ]
+        st.dataframe(rows, hide_index=True, use_container_width=True)
+        st.subheader('カウンター')
+        st.json(trace_dict['counters'])
+        st.caption(f"JSONログ: {tracing.TRACE_LOG_FILE} / Prometheus: {tracing.METRICS_FILE}")
 
 def main():
     st.title('ぼくのレシピ帳')
     st.write("Webサイト上のレシピをまとめて保存するためのアプリです")
 
+    # レシピデータの読み込み
+    df = load_recipes()
+
     # 全てのタグを取得
     all_tags = get_all_tags()
 
+    # シートへの保存状況
+    show_sync_status()
+
     # セッション状態の初期化
     if 'show_success' not in st.session_state:
         st.session_state.show_success = False
@@ -96,9 +333,9 @@ def main():
 
 
     # タブの作成
-    tab1, tab2 = st.tabs(["レシピ追加", "レシピ一覧"])
+    tab1, tab2, tab3 = st.tabs(["レシピ追加", "レシピ一覧", "タグの管理"])
 
-    with tab1:
+    with tab1, tracing.span('render_add_tab'):
         st.header('新しいレシピを追加')
         
         # 成功メッセージの表示
@@ -117,10 +354,7 @@ def main():
             title, img_url = get_webpage_info(url)
             st.text_input('ウェブページのタイトル：', value=title, key=f'title_{st.session_state.form_key}')
             if img_url:
-                try:
-                    st.image(img_url, caption="レシピ画像", use_column_width=True)
-                except Exception as e:
-                    st.warning(f"画像の表示中にエラーが発生しました: {str(e)}")
+                show_preview_image(img_url)
             else:
                 st.info("レシピ画像が見つかりませんでした。")
         else:
@@ -165,12 +399,38 @@ def main():
             else:
                 st.error("URLとタイトルを入力してください。")
 
-    with tab2:
+        # URLをまとめて追加
+        st.subheader('URLをまとめて追加')
+        bulk_text = st.text_area('URLを1行に1つずつ入力してください：', key='bulk_urls')
+        bulk_file = st.file_uploader("またはURLの一覧・ブックマークのファイルを選択してください", type=['txt', 'html', 'htm'], key='bulk_file')
+        bulk_tags = st.multiselect('追加するレシピに付けるタグ:', options=all_tags, key='bulk_tags')
+        if st.button('まとめて追加'):
+            bulk_text = bulk_text or ''
+            if bulk_file is not None:
+                bulk_text += '\n' + bulk_file.getvalue().decode('utf-8', errors='replace')
+            urls = parse_urls(bulk_text)
+            if urls:
+                cache = get_page_cache()
+                progress_bar = st.progress(0.0, text='ページ情報を取得しています...')
+                results = fetch_all(
+                    urls, lambda u: fetch_webpage_info(u, cache, retry_failed=True),
+                    progress=lambda done, total: progress_bar.progress(done / total, text=f'ページ情報を取得しています... {done}/{total}')
+                )
+                recipes, failed = to_recipes(results, tags=','.join(bulk_tags), details=lambda u: page_details(u, cache))
+                # 取得したページ情報をまとめてキャッシュファイルに書き込む
+                cache.flush()
+                added, skipped = save_recipes(recipes)
+                st.success(f"{added}件のレシピを追加しました（重複: {skipped}件、失敗: {len(failed)}件）")
+                if failed:
+                    with st.expander('取得に失敗したURL'):
+                        for result in failed:
+                            st.write(f"{result['url']}: {result['error']}")
+            else:
+                st.error('URLが見つかりませんでした。')
+
+    with tab2, tracing.span('render_list_tab'):
         st.header('保存したレシピ一覧')
         
-        # レシピデータの読み込み
-        df = load_recipes()
-        
         # タグでフィルタリング（複数選択可能）
         selected_tags = st.multiselect('タグでフィルタリング（複数選択可能、AND条件）', all_tags)
         
@@ -178,7 +438,7 @@ def main():
         if not selected_tags:  # タグが選択されていない場合は全てのレシピを表示
             filtered_df = df
         else:
-            filtered_df = df[df['タグ'].apply(lambda x: all(tag in str(x).split(',') for tag in selected_tags))]
+            filtered_df = filter_by_tags(df, selected_tags)
 
         # ページネーションの実装
         items_per_page = 50
@@ -187,33 +447,42 @@ def main():
         start_idx = (page - 1) * items_per_page
         end_idx = start_idx + items_per_page
             
-        for index, recipe in filtered_df.iloc[start_idx:end_idx].iterrows():
+        for _, recipe in filtered_df.iloc[start_idx:end_idx].iterrows():
+            recipe_id = recipe['ID']
             with st.expander(recipe['タイトル']):
                 st.write(f"URL: {recipe['URL']}")
                 st.write(f"メモ: {recipe['メモ']}")
                 st.write(f"タグ: {recipe['タグ']}")
-                if pd.notna(recipe['画像URL']):
-                    try:
-                        st.image(recipe['画像URL'], caption="レシピ画像", use_column_width=True)
-                    except Exception as e:
-                        st.warning(f"画像の表示中にエラーが発生しました: {str(e)}")
+                # シートの値は常に文字列（未入力なら空文字）
+                if recipe['画像URL']:
+                    show_recipe_image(recipe['画像URL'], recipe_id)
                 else:
                     st.info("このレシピには画像が登録されていません。")
+
+                # 似ているレシピ（タイトル・メモ・タグが近いもの）
+                if st.checkbox('似ているレシピを表示', key=f'similar_{recipe_id}'):
+                    similar = find_recipes(df, get_similar_index().similar(recipe_id))
+                    if similar:
+                        show_recipe_links(similar)
+                    elif get_similar_index_cache().rebuilding:
+                        st.info("似ているレシピを探す準備をしています。しばらくしてからもう一度お試しください。")
+                    else:
+                        st.info("似ているレシピが見つかりませんでした。")
                 
                 col1, col2 = st.columns(2)
                 with col1:
-                    if st.button('編集', key=f'edit_{index}'):
-                        st.session_state.editing = index
-                        st.session_state.edit_url = recipe['URL']
-                        st.session_state.edit_title = recipe['タイトル']
-                        st.session_state.edit_memo = recipe['メモ']
-                        st.session_state.edit_tags = str(recipe['タグ']).split(',')
+                    if st.button('編集', key=f'edit_{recipe_id}'):
+                        start_editing(recipe)
                         st.experimental_rerun()
                 with col2:
-                    if st.button('削除', key=f'delete_{index}'):
-                        delete_recipe(index)
-                        st.success('レシピが削除されました。')
-                        st.experimental_rerun()
+                    if st.button('削除', key=f'delete_{recipe_id}'):
+                        try:
+                            delete_recipe(recipe_id, recipe['バージョン'])
+                        except ConflictError as e:
+                            st.error(f"削除できませんでした: {str(e)}")
+                        else:
+                            st.success('レシピが削除されました。')
+                            st.experimental_rerun()
           
         # ページナビゲーション
         col1, col2, col3 = st.columns([1, 1, 1])
@@ -228,6 +497,18 @@ def main():
                 st.session_state.page = min(n_pages, st.session_state.page + 1)
                 st.experimental_rerun()
 
+        # 手持ちの材料から作れそうなレシピを探す
+        st.subheader('手持ちの材料で作れるレシピ')
+        pantry = st.text_input('手持ちの材料（カンマか空白区切り）', key='pantry')
+        if pantry:
+            cookable = find_recipes(df, get_similar_index().query(pantry, PANTRY_LIMIT))
+            if cookable:
+                show_recipe_links(cookable)
+            elif get_similar_index_cache().rebuilding:
+                st.info("レシピを探す準備をしています。しばらくしてからもう一度お試しください。")
+            else:
+                st.info("該当するレシピが見つかりませんでした。")
+
         # 編集モード
         
         if 'editing' in st.session_state:
@@ -260,16 +541,77 @@ def main():
             combined_tags = list(set(selected_existing_tags + new_tags))
         
             if st.button('更新'):
-                # 現在の画像URLを取得
-                current_img_url = df.iloc[st.session_state.editing]['画像URL']
-                update_recipe(st.session_state.editing, edit_url, edit_title, edit_memo, ','.join(combined_tags), current_img_url)
-                st.success('レシピが更新されました。')
-                del st.session_state.editing
+                try:
+                    update_recipe(
+                        st.session_state.editing, edit_url, edit_title, edit_memo, ','.join(combined_tags),
+                        st.session_state.edit_img_url, st.session_state.edit_version
+                    )
+                except ConflictError as e:
+                    st.session_state.edit_conflict = True
+                    st.error(f"更新できませんでした: {str(e)}")
+                else:
+                    st.success('レシピが更新されました。')
+                    del st.session_state.editing
+                    st.experimental_rerun()
+
+            # 競合した場合は最新の内容を読み込み直してから編集し直す
+            if st.session_state.get('edit_conflict') and st.button('最新の内容を読み込む'):
+                latest_df = load_recipes()
+                latest = latest_df[latest_df['ID'] == st.session_state.editing]
+                if latest.empty:
+                    del st.session_state.editing
+                else:
+                    start_editing(latest.iloc[0])
                 st.experimental_rerun()
         
             if st.button('キャンセル'):
                 del st.session_state.editing
                 st.experimental_rerun()
 
+    with tab3, tracing.span('render_tags_tab'):
+        st.header('タグの管理')
+        tag_counts = get_tag_index().counts()
+
+        # タグそのものの変更（そのタグを持つ全てのレシピが対象）
+        st.subheader('タグの名前の変更・統合・分割・削除')
+        tag_op = st.selectbox('操作', list(TAG_OPERATIONS), format_func=TAG_OPERATIONS.get, key='tag_op')
+        tag_sources = st.multiselect(
+            '対象のタグ', all_tags, key='tag_sources',
+            format_func=lambda tag: f"{tag}（{tag_counts.get(tag, 0)}件）"
+        )
+        tag_targets = []
+        if tag_op != 'delete':
+            tag_targets = split_tags(st.text_input('新しいタグ（複数の場合はカンマ区切り）', key='tag_targets'))
+        show_tag_operation(tag_op, tag_sources, tag_targets, tagged_recipe_ids(tag_sources), 'tag')
+
+        # 選んだレシピへのタグの追加・削除
+        st.subheader('選んだレシピのタグをまとめて変更')
+        selection_tags = st.multiselect('タグで絞り込み', all_tags, key='selection_filter_tags')
+        candidates = filter_by_tags(df, selection_tags) if selection_tags else df
+        if st.checkbox(f'絞り込んだ{len(candidates)}件すべてを選ぶ', key='select_all'):
+            selected_ids = candidates['ID'].tolist()
+        else:
+            # 選択肢が多すぎないよう、絞り込んだ結果の先頭だけを並べる
+            titles = dict(zip(candidates['ID'].head(SELECTION_LIMIT), candidates['タイトル'].head(SELECTION_LIMIT)))
+            selected_ids = st.multiselect(
+                'レシピ', list(titles), key='selected_recipes',
+                format_func=lambda recipe_id: titles.get(recipe_id) or '（タイトルなし）'
+            )
+        selection_op = st.radio(
+            '操作', list(SELECTION_OPERATIONS), format_func=SELECTION_OPERATIONS.get,
+            horizontal=True, key='selection_op'
+        )
+        selection_sources, selection_targets = [], []
+        if selection_op == 'add':
+            selection_targets = split_tags(st.text_input('付けるタグ（複数の場合はカンマ区切り）', key='selection_targets'))
+        else:
+            selection_sources = st.multiselect('外すタグ', all_tags, key='selection_sources')
+        if not selected_ids:
+            st.caption('レシピを選んでください')
+        else:
+            show_tag_operation(selection_op, selection_sources, selection_targets, selected_ids, 'selection')
+
 if __name__ == '__main__':
-    main()
+    with tracing.trace('rerun') as current:
+        main()
+    show_debug_panel(current)
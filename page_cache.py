@@ -0,0 +1,164 @@
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+
+# キャッシュファイルのパス
+CACHE_FILE = 'page_cache.json'
+# キャッシュの有効期限（秒）
+CACHE_TTL = 24 * 60 * 60
+# キャッシュに保持する最大件数
+CACHE_MAX_ENTRIES = 2000
+# 取得に失敗したURLを、再び取得しに行かずに同じエラーとして扱う時間（秒）
+FAILURE_TTL = 60
+# 変更をまとめてファイルに書き込むまでの待ち時間（秒）
+FLUSH_INTERVAL = 5
+
+def normalize_url(url):
+    # スキームとホストを小文字にし、フラグメントを除いたURLをキーにする
+    parts = urlsplit(url.strip())
+    path = parts.path or '/'
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, parts.query, ''))
+
+class PageCache:
+    def __init__(self, path=CACHE_FILE, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, flush_interval=FLUSH_INTERVAL,
+                 failure_ttl=FAILURE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        # ロックは必ず _flush_lock -> _lock の順に取る
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._entries = OrderedDict()
+        # 取得に失敗したURLのキー -> (エラー, 失敗した時刻)（短い間だけなのでファイルには書かない）
+        self._failures = OrderedDict()
+        # まだファイルに書き込んでいない変更があるか
+        self._dirty = False
+        self._timer = None
+        self._load()
+        # 終了時に書き込み待ちの変更を保存する
+        atexit.register(self.flush)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # 壊れたキャッシュファイルは無視して作り直す
+            return
+        # 最終アクセス順に並べてLRUの順序を復元する
+        for key, entry in sorted(data.items(), key=lambda item: item[1].get('accessed_at', 0)):
+            self._entries[key] = entry
+
+    def _mark_dirty(self):
+        # 変更のたびにファイル全体を書き直さず、一定時間後にまとめて書き込む
+        # （_lock を取った状態で呼ぶ）
+        self._dirty = True
+        if self._timer is None and self.path:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty or not self.path:
+                    return
+                data = json.dumps(self._entries, ensure_ascii=False)
+                self._dirty = False
+            # 書き込み中もロックを離して他のスレッドの読み書きを止めない
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, prefix=f'{os.path.basename(self.path)}.', suffix='.tmp', delete=False) as f:
+                f.write(data)
+            try:
+                os.replace(f.name, self.path)
+            except OSError:
+                # 書き込めなかった変更は次の機会に書き直す
+                with self._lock:
+                    self._dirty = True
+                os.remove(f.name)
+                raise
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < self.ttl
+
+    def get(self, url):
+        key = normalize_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry['accessed_at'] = time.time()
+            self._entries.move_to_end(key)
+            return dict(entry)
+
+    def put(self, url, title, img_url, etag=None, last_modified=None, details=None):
+        key = normalize_url(url)
+        now = time.time()
+        with self._lock:
+            self._entries[key] = {
+                'title': title,
+                'img_url': img_url,
+                'details': details or {},
+                'etag': etag,
+                'last_modified': last_modified,
+                'fetched_at': now,
+                'accessed_at': now,
+            }
+            self._entries.move_to_end(key)
+            self._failures.pop(key, None)
+            self._evict()
+            self._mark_dirty()
+
+    def touch(self, url):
+        # 304 Not Modified で再検証できた場合は取得時刻だけ更新する
+        key = normalize_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry['fetched_at'] = time.time()
+            self._mark_dirty()
+
+    def details(self, url):
+        # 取得済みのページから取り出した正規のURLやレシピの情報（無ければ空）
+        key = normalize_url(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry.get('details') or {}) if entry else {}
+
+    def put_failure(self, url, error):
+        key = normalize_url(url)
+        with self._lock:
+            self._failures[key] = (error, time.time())
+            self._failures.move_to_end(key)
+            while len(self._failures) > self.max_entries:
+                self._failures.popitem(last=False)
+
+    def failure(self, url):
+        # 少し前に取得に失敗していれば、そのときのエラーを返す（無ければNone）
+        key = normalize_url(url)
+        with self._lock:
+            failure = self._failures.get(key)
+            if failure is None:
+                return None
+            error, failed_at = failure
+            if time.time() - failed_at >= self.failure_ttl:
+                del self._failures[key]
+                return None
+            return error
@@ -0,0 +1,228 @@
+import codecs
+import json
+import re
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+# ページにタイトルが無い場合に使うタイトル
+NO_TITLE = "タイトルが見つかりません"
+# 文字コードを<meta>から探す範囲（バイト）
+SNIFF_BYTES = 4 * 1024
+# <head>の後、JSON-LDが無いか確かめるために読む範囲（文字数）
+BODY_LOOKAHEAD = 64 * 1024
+
+META_CHARSET = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+ISO_DURATION = re.compile(
+    r'^P(?:(?P<days>\d+(?:\.\d+)?)D)?(?:T(?:(?P<hours>\d+(?:\.\d+)?)H)?(?:(?P<minutes>\d+(?:\.\d+)?)M)?(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?$',
+    re.IGNORECASE
+)
+# 画像として使う<meta>（先に書いたものを優先する）
+IMAGE_META = ['og:image', 'og:image:url', 'og:image:secure_url', 'twitter:image', 'twitter:image:src']
+
+def sniff_encoding(data, default='utf-8'):
+    # BOMか<meta charset>から文字コードを決める（分からなければUTF-8）
+    if data.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    match = META_CHARSET.search(data[:SNIFF_BYTES])
+    if match:
+        try:
+            return codecs.lookup(match.group(1).decode('ascii')).name
+        except (LookupError, UnicodeDecodeError):
+            pass
+    return default
+
+def parse_duration(value):
+    # ISO 8601の期間（例: PT1H30M）を分にする
+    if not isinstance(value, str):
+        return None
+    match = ISO_DURATION.match(value.strip())
+    if not match or not any(match.groupdict().values()):
+        return None
+    parts = {key: float(number) for key, number in match.groupdict().items() if number}
+    minutes = parts.get('days', 0) * 1440 + parts.get('hours', 0) * 60 + parts.get('minutes', 0) + parts.get('seconds', 0) / 60
+    return round(minutes)
+
+def _types(node):
+    types = node.get('@type', [])
+    return types if isinstance(types, list) else [types]
+
+def find_recipe(data):
+    # JSON-LDの中からschema.orgのRecipeを探す（@graphや配列の中も探す）
+    if isinstance(data, list):
+        for item in data:
+            recipe = find_recipe(item)
+            if recipe:
+                return recipe
+    elif isinstance(data, dict):
+        if 'Recipe' in _types(data):
+            return data
+        for key in ('@graph', 'mainEntity', 'mainEntityOfPage'):
+            recipe = find_recipe(data.get(key))
+            if recipe:
+                return recipe
+    return None
+
+def _image_url(value):
+    # 画像はURLの文字列・ImageObject・それらの配列のどれでも書ける
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        value = value.get('url') or value.get('contentUrl')
+    return value if isinstance(value, str) and value.strip() else None
+
+def _text(value):
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    return value.strip() if isinstance(value, str) and value.strip() else None
+
+def recipe_fields(recipe):
+    # Recipeから保存する項目（材料・調理時間・分量・名前・画像）を取り出す
+    ingredients = recipe.get('recipeIngredient') or recipe.get('ingredients') or []
+    if isinstance(ingredients, str):
+        ingredients = [ingredients]
+    cook_time = parse_duration(recipe.get('totalTime'))
+    if cook_time is None:
+        times = [parse_duration(recipe.get(key)) for key in ('prepTime', 'cookTime')]
+        cook_time = sum(minutes for minutes in times if minutes) or None
+    return {
+        'name': _text(recipe.get('name')),
+        'image': _image_url(recipe.get('image')),
+        'ingredients': [' '.join(item.split()) for item in ingredients if isinstance(item, str) and item.strip()],
+        'cook_time': cook_time,
+        'yield': _text(recipe.get('recipeYield')),
+    }
+
+class PageParser(HTMLParser):
+    # ページを先頭から1回だけ読み、タイトル・画像・正規のURL・JSON-LDのRecipeを集める
+    # feed() は少しずつ呼べるので、ダウンロードしながら解析できる
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.meta_images = {}
+        self.canonical_url = None
+        self.body_image = None
+        self.recipe = None
+        self.head_ended = False
+        # <head>の後に読んだ文字数と、本文にJSON-LDがあったかどうか
+        self.body_read = 0
+        self.body_json_ld = False
+        self._title_parts = None
+        self._script_parts = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and self.title is None and not self.head_ended:
+            self._title_parts = []
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            name = (attrs.get('property') or attrs.get('name') or '').lower()
+            if name in IMAGE_META and attrs.get('content') and name not in self.meta_images:
+                self.meta_images[name] = attrs['content'].strip()
+        elif tag == 'link' and self.canonical_url is None:
+            attrs = dict(attrs)
+            if 'canonical' in (attrs.get('rel') or '').lower().split():
+                self.canonical_url = attrs.get('href')
+        elif tag == 'script' and self.recipe is None:
+            if (dict(attrs).get('type') or '').lower().strip() == 'application/ld+json':
+                self._script_parts = []
+                self.body_json_ld = self.body_json_ld or self.head_ended
+        elif tag == 'img' and self.body_image is None:
+            self.body_image = dict(attrs).get('src')
+        elif tag == 'body':
+            self.head_ended = True
+
+    def feed(self, data):
+        if self.head_ended:
+            self.body_read += len(data)
+        super().feed(data)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self._title_parts is not None:
+            self.title = ''.join(self._title_parts)
+            self._title_parts = None
+        elif tag == 'script' and self._script_parts is not None:
+            self._add_json_ld(''.join(self._script_parts))
+            self._script_parts = None
+        elif tag == 'head':
+            self.head_ended = True
+
+    def handle_data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+        elif self._script_parts is not None:
+            self._script_parts.append(data)
+
+    def _add_json_ld(self, text):
+        try:
+            data = json.loads(text)
+        except ValueError:
+            # 壊れたJSON-LDはよくあるので無視する
+            return
+        recipe = find_recipe(data)
+        if recipe:
+            self.recipe = recipe_fields(recipe)
+
+    def image(self):
+        # og:image → twitter:image → Recipeの画像 → 本文の最初の<img> の順に使う
+        for name in IMAGE_META:
+            if self.meta_images.get(name):
+                return self.meta_images[name]
+        if self.recipe and self.recipe['image']:
+            return self.recipe['image']
+        return self.body_image
+
+    def is_done(self):
+        # これ以上読んでも結果が変わらない（<head>を読み終え、Recipeと画像が見つかった）
+        # Recipeが無いページ（レシピ以外のページやエラーページ）は、本文の先頭にJSON-LDが無ければやめる
+        if not self.head_ended or self.image() is None:
+            return False
+        if self.recipe is not None:
+            return True
+        return not self.body_json_ld and self.body_read >= BODY_LOOKAHEAD
+
+    def result(self, url):
+        title = self.title.strip() if self.title and self.title.strip() else None
+        if title is None and self.recipe:
+            title = self.recipe['name']
+        recipe = self.recipe or {}
+        return {
+            'title': title or NO_TITLE,
+            'img_url': absolute_url(url, self.image()),
+            'canonical_url': canonical_link(url, self.canonical_url),
+            'ingredients': recipe.get('ingredients') or [],
+            'cook_time': recipe.get('cook_time'),
+            'yield': recipe.get('yield'),
+        }
+
+def absolute_url(url, img_url):
+    # 相対パスを絶対パスに変換
+    if img_url:
+        img_url = img_url.strip()
+    if img_url and not img_url.startswith(('http://', 'https://')):
+        img_url = urljoin(url, img_url)
+    return img_url or None
+
+def canonical_link(url, href):
+    # ページが示す正規のURL（rel=canonical）を絶対URLにして返す
+    if not href:
+        return None
+    canonical_url = urljoin(url, href.strip())
+    if not canonical_url.startswith(('http://', 'https://')):
+        return None
+    # 全ページでトップページを指しているサイトがあるので、その場合は使わない
+    if urlsplit(canonical_url).path in ('', '/') and urlsplit(url).path not in ('', '/'):
+        return None
+    return canonical_url
+
+def parse_page(url, content, encoding=None):
+    # 取得済みのHTML全体を解析する（少しずつ読む場合は PageParser を直接使う）
+    if isinstance(content, bytes):
+        content = content.decode(encoding or sniff_encoding(content), errors='replace')
+    parser = PageParser()
+    parser.feed(content)
+    parser.close()
+    return parser.result(url)
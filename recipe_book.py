@@ -1,105 +1,366 @@
+import bisect
+import time
 import streamlit as st
 from streamlit_tags import st_tags
-import requests
-from bs4 import BeautifulSoup
-import pandas as pd
-import os
-import base64
-from urllib.parse import urljoin
-
-# CSVファイルのパス
+import tracing
+from page_cache import PageCache
+from image_cache import ImageCache
+from webpage import fetch_webpage_info, page_details
+from bulk_import import parse_urls, fetch_all, to_recipes
+from recipe_store import open_store
+from errors import ConflictError, DuplicateUrlError
+from importer import MERGE_POLICIES, import_recipes
+from tag_index import TagIndex, split_tags
+from similar_index import SimilarIndex
+from tag_ops import TAG_OPERATIONS, SELECTION_OPERATIONS, PREVIEW_ROWS, validate_operation, make_transform, describe
+from link_checker import LinkChecker, is_dead
+from exporter import FORMATS, FORMAT_LABELS, export_filename, export_mime, export_to_tempfile
+
+# データベースファイルのパス
+DB_FILE = 'recipe_book.db'
+# CSVファイルのパス（初回起動時にデータベースへ移行する）
 CSV_FILE = 'recipe_list.csv'
+# 類似レシピの行列を保存するファイル（再起動しても作り直さずに済む）
+SIMILAR_INDEX_FILE = 'similar_index.npz'
+# 選んだレシピのタグを変更するときに選択肢として並べる最大件数
+SELECTION_CHOICES = 100
+# 一覧の1ページに表示する件数の選択肢と初期値
+PAGE_SIZES = [10, 20, 50, 100]
+PAGE_SIZE = 20
+# 手持ちの材料で作れるレシピとして表示する件数
+PANTRY_LIMIT = 10
+
+@st.cache_resource
+def get_store():
+    # プロセス内で共有するレシピのデータベース
+    return open_store(DB_FILE, CSV_FILE)
+
+@st.cache_resource
+def get_tag_index_cache():
+    # プロセス内で共有するタグの転置インデックス
+    return TagIndex()
+
+def get_tag_index():
+    # データのバージョンが変わったときだけインデックスを作り直す
+    store = get_store()
+    tag_index = get_tag_index_cache()
+    version = store.data_version()
+    if tag_index.version != version:
+        with tracing.span('rebuild_tag_index'):
+            tag_index.rebuild(store.iter_tags(), version)
+    return tag_index
+
+def update_tag_index(expected_version, changes):
+    # 書き込みの差分をタグのインデックスに反映する
+    get_tag_index_cache().apply(expected_version, get_store().data_version(), changes)
+
+@st.cache_resource
+def get_similar_index_cache():
+    # プロセス内で共有する類似レシピの行列
+    return SimilarIndex(SIMILAR_INDEX_FILE)
+
+def get_similar_index():
+    # データのバージョンが変わったときだけ、保存した行列を読み込むか、バックグラウンドで作り直す
+    # 作り直している間は古い行列で答え、再実行の中では行列全体を計算し直さない
+    store = get_store()
+    similar_index = get_similar_index_cache()
+    version = store.data_version()
+    if similar_index.version != version and not similar_index.rebuilding and not similar_index.load(version):
+        def load():
+            # バージョンを先に読む（後から書き込まれた分は、次に使うときにバージョンの違いで作り直す）
+            version = store.data_version()
+            return version, store.iter_texts()
+        similar_index.rebuild_in_background(load)
+    return similar_index
+
+def update_similar_index(expected_version, changes):
+    # 書き込んだレシピを読み直して類似レシピの行列に反映する（行列が古ければ次に使うときに作り直す）
+    store = get_store()
+    similar_index = get_similar_index_cache()
+    if similar_index.version is None or similar_index.version != expected_version:
+        changes = []
+    changes = [(action, recipe_id, store.get(recipe_id) if action == 'add' else None) for action, recipe_id in changes]
+    similar_index.apply(expected_version, store.data_version(), changes)
+
+def index_versions():
+    # 書き込む前のタグのインデックスと類似レシピの行列のバージョン
+    return get_tag_index_cache().version, get_similar_index_cache().version
+
+def update_indexes(expected_versions, changes):
+    # changes は (操作, レシピID, タグ) の組
+    update_tag_index(expected_versions[0], changes)
+    update_similar_index(expected_versions[1], [(action, recipe_id) for action, recipe_id, _ in changes])
+
+@st.cache_resource
+def get_page_cache():
+    # プロセス内で共有するページ情報キャッシュ
+    return PageCache()
 
+@tracing.traced()
 def get_webpage_info(url):
     try:
-        response = requests.get(url)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        title = soup.title.string if soup.title else "タイトルが見つかりません"
-        
-        # 画像URLの取得
-        img_tag = soup.find('meta', property='og:image')
-        img_url = img_tag['content'] if img_tag else None
-        
-        if not img_url:
-            img_tag = soup.find('img')
-            img_url = img_tag['src'] if img_tag else None
-        
-        # 相対パスを絶対パスに変換
-        if img_url and not img_url.startswith(('http://', 'https://')):
-            img_url = urljoin(url, img_url)
-        
-        return title, img_url
+        return fetch_webpage_info(url, get_page_cache())
     except Exception as e:
         st.error(f"ウェブページの情報取得中にエラーが発生しました: {str(e)}")
         return "URLが無効です", None
 
-def load_recipes():
-    if os.path.exists(CSV_FILE):
-        return pd.read_csv(CSV_FILE)
-    return pd.DataFrame(columns=['URL', 'タイトル', 'メモ', 'タグ', '画像URL'])
-
-def save_recipe(df, url, title, memo, tags, img_url):
-    if url in df['URL'].values:
-        return df, False, "このURLのレシピはすでに存在しています。"
-
-    new_recipe = pd.DataFrame({
-        'URL': [url],
-        'タイトル': [title],
-        'メモ': [memo],
-        'タグ': [tags],
-        '画像URL': [img_url]
-    })
-    
-    df = pd.concat([df, new_recipe], ignore_index=True)
-    df.to_csv(CSV_FILE, index=False)
-    return df, True, "レシピが保存されました！"
-
-def update_recipe(df, index, url, title, memo, tags):
-    df.at[index, 'URL'] = url
-    df.at[index, 'タイトル'] = title
-    df.at[index, 'メモ'] = memo
-    df.at[index, 'タグ'] = tags
-    df.to_csv(CSV_FILE, index=False)
-    return df
-
-def delete_recipe(df, index):
-    df = df.drop(index)
-    df = df.reset_index(drop=True)
-    df.to_csv(CSV_FILE, index=False)
-    return df
-
-def get_all_tags(df):
-    all_tags = set()
-    for tags in df['タグ']:
-        if isinstance(tags, str):
-            all_tags.update(tag.strip() for tag in tags.split(','))
-    return list(all_tags)
-
-def get_csv_download_link(df):
-    csv = df.to_csv(index=False)
-    b64 = base64.b64encode(csv.encode()).decode()
-    href = f'<a href="data:file/csv;base64,{b64}" download="recipes.csv">CSVファイルをダウンロード</a>'
-    return href
-
-def import_csv(uploaded_file, existing_df):
-    if uploaded_file is not None:
-        imported_df = pd.read_csv(uploaded_file)
-        # URLの重複チェックと統合
-        merged_df = pd.concat([existing_df, imported_df]).drop_duplicates(subset='URL', keep='last')
-        merged_df = merged_df.reset_index(drop=True)
-        merged_df.to_csv(CSV_FILE, index=False)
-        return merged_df
-    return existing_df
+@st.cache_resource
+def get_image_cache():
+    # プロセス内で共有する画像キャッシュ（サムネイルと元の画像）
+    return ImageCache()
+
+@st.cache_resource
+def get_link_checker():
+    # 保存したURLと画像のリンク切れをバックグラウンドで定期的に確認する
+    checker = LinkChecker(get_store(), get_tag_index_cache(), get_similar_index_cache())
+    checker.start()
+    return checker
+
+def show_preview_image(img_url):
+    # 追加前のプレビューは1枚だけなのでその場でダウンロードしてサムネイルを表示する
+    try:
+        st.image(get_image_cache().fetch(img_url), caption="レシピ画像")
+    except Exception as e:
+        st.warning(f"画像の表示中にエラーが発生しました: {str(e)}")
+
+def show_recipe_image(img_url, key):
+    # 一覧ではサムネイルだけを表示し、元の画像は求められたときに読み込む
+    image_cache = get_image_cache()
+    thumbnail = image_cache.thumbnail(img_url)
+    if thumbnail:
+        st.image(thumbnail, caption="レシピ画像")
+        if st.checkbox('元の画像を表示', key=f'original_{key}'):
+            st.image(image_cache.original(img_url) or img_url, use_column_width=True)
+    elif is_dead(get_store().link_statuses([img_url]).get(img_url)):
+        # リンク切れが確認された画像は取りに行かない
+        st.warning("画像のリンクが切れています。")
+    elif image_cache.is_failed(img_url):
+        st.warning("画像を読み込めませんでした。")
+        st.markdown(f"[元の画像を開く]({img_url})")
+    else:
+        image_cache.prefetch([img_url])
+        st.info("画像を準備しています。")
+
+@tracing.traced()
+def save_recipe(url, title, memo, tags, img_url):
+    store = get_store()
+    # 取得済みのページから正規のURL（重複チェックに使う）と材料・調理時間・分量を取り出す
+    details = page_details(url, get_page_cache())
+    new_recipe = {
+        'URL': url,
+        'タイトル': title,
+        'メモ': memo,
+        'タグ': tags,
+        '画像URL': img_url,
+        **details
+    }
+    expected_versions = index_versions()
+    try:
+        recipe_id = store.insert(new_recipe)
+    except DuplicateUrlError:
+        return False, "このURLのレシピはすでに存在しています。"
+    update_indexes(expected_versions, [('add', recipe_id, tags)])
+    # 画像は保存時にバックグラウンドでダウンロードしておく
+    get_image_cache().prefetch([img_url])
+    return True, "レシピが保存されました！"
+
+@tracing.traced()
+def save_recipes(recipes):
+    # 複数のレシピを重複を除いて1つのトランザクションでまとめて保存する
+    expected_versions = index_versions()
+    inserted = get_store().insert_many(recipes)
+    update_indexes(expected_versions, [('add', recipe_id, recipe['タグ']) for recipe_id, recipe in inserted])
+    get_image_cache().prefetch([recipe['画像URL'] for _, recipe in inserted])
+    return len(inserted), len(recipes) - len(inserted)
+
+@tracing.traced()
+def update_recipe(index, url, title, memo, tags, row_version=None):
+    # row_version は編集を始めたときの行のバージョン（他のセッションが先に更新していたら ConflictError）
+    values = {'URL': url, 'タイトル': title, 'メモ': memo, 'タグ': tags}
+    expected_versions = index_versions()
+    get_store().update(index, values, row_version)
+    update_indexes(expected_versions, [('add', index, tags)])
+
+@tracing.traced()
+def delete_recipe(index, row_version=None):
+    expected_versions = index_versions()
+    get_store().delete(index, row_version)
+    update_indexes(expected_versions, [('remove', index, None)])
+
+@tracing.traced()
+def retag_recipes(op, sources, targets, ids, dry_run=False):
+    # タグの一括操作。変わるレシピの (ID, タイトル, 変更前, 変更後) を返す（dry_run ならプレビューだけ）
+    transform = make_transform(op, sources, targets)
+    if dry_run:
+        return get_store().retag(ids, transform, dry_run=True)
+    expected_versions = index_versions()
+    changes = get_store().retag(ids, transform)
+    update_indexes(expected_versions, [('add', recipe_id, new_tags) for recipe_id, _, _, new_tags in changes])
+    return changes
+
+def tagged_recipe_ids(tags):
+    # いずれかのタグを持つレシピID（OR条件）
+    tag_index = get_tag_index()
+    return sorted(set().union(*(tag_index.query([tag]) for tag in tags)))
+
+def show_tag_operation(op, sources, targets, ids, key):
+    # プレビューで変わるレシピを確認してから、1回の書き込みでまとめて変更する
+    if f'{key}_done' in st.session_state:
+        st.success(st.session_state.pop(f'{key}_done'))
+    error = validate_operation(op, sources, targets)
+    if error:
+        st.caption(error)
+        return
+    request = (op, tuple(sources), tuple(targets), tuple(ids))
+    if st.button('プレビュー', key=f'{key}_preview'):
+        st.session_state[f'{key}_plan'] = (request, retag_recipes(op, sources, targets, ids, dry_run=True))
+    plan = st.session_state.get(f'{key}_plan')
+    # 条件を変えたらプレビューし直す
+    if plan is None or plan[0] != request:
+        return
+    changes = plan[1]
+    if not changes:
+        st.info('タグが変わるレシピはありません。')
+        return
+    st.write(f"{describe(op, sources, targets)}: {len(changes)}件のレシピが変わります")
+    rows = [
+        {'ID': recipe_id, 'タイトル': title, '変更前': old_tags, '変更後': new_tags}
+        for recipe_id, title, old_tags, new_tags in changes[:PREVIEW_ROWS]
+    ]
+    st.dataframe(rows, hide_index=True, use_container_width=True)
+    if len(changes) > PREVIEW_ROWS:
+        st.caption(f"先頭の{PREVIEW_ROWS}件を表示しています")
+    if st.button(f'{len(changes)}件のレシピに適用', key=f'{key}_apply'):
+        # 書き込むときに読み直すので、プレビューの後に変わった行も正しく書き換える
+        applied = retag_recipes(op, sources, targets, ids)
+        del st.session_state[f'{key}_plan']
+        st.session_state[f'{key}_done'] = f"{len(applied)}件のレシピのタグを変更しました。"
+        st.experimental_rerun()
+
+@tracing.traced()
+def find_similar_recipes(recipe_id):
+    # 似ているレシピの (レシピの内容, 類似度) を類似度の高い順に返す
+    store = get_store()
+    results = [(store.get(similar_id), score) for similar_id, score in get_similar_index().similar(recipe_id)]
+    return [(recipe, score) for recipe, score in results if recipe]
+
+@tracing.traced()
+def find_cookable_recipes(pantry):
+    # 手持ちの材料で作れそうなレシピの (レシピの内容, 類似度) を返す
+    store = get_store()
+    results = [(store.get(recipe_id), score) for recipe_id, score in get_similar_index().query(pantry, PANTRY_LIMIT)]
+    return [(recipe, score) for recipe, score in results if recipe]
+
+def show_recipe_links(results):
+    for recipe, score in results:
+        st.markdown(f"- [{recipe['タイトル'] or '（タイトルなし）'}]({recipe['URL']})（類似度 {score:.2f}）")
+
+def start_editing(index, recipe):
+    # 編集フォームに現在の内容と行のバージョンを読み込む
+    st.session_state.editing = index
+    st.session_state.edit_version = recipe['バージョン']
+    st.session_state.edit_url = recipe['URL']
+    st.session_state.edit_title = recipe['タイトル']
+    st.session_state.edit_memo = recipe['メモ']
+    st.session_state.edit_tags = split_tags(recipe['タグ'])
+    st.session_state.edit_conflict = False
+
+def get_all_tags():
+    return get_tag_index().all_tags()
+
+@tracing.traced()
+def find_recipe_ids(selected_tags, query):
+    # 絞り込み中のレシピIDを一覧に表示する順に返す（絞り込んでいなければNone）
+    # キーワードがある場合は全文検索の関連度順、タグだけの場合はIDの順（AND条件）
+    # 件数やページ送り、エクスポートに使うため、件数で打ち切らずに一致したIDをすべて返す
+    if query:
+        ids = get_store().search(query)
+        if selected_tags:
+            tagged = set(get_tag_index().query(selected_tags))
+            ids = [recipe_id for recipe_id in ids if recipe_id in tagged]
+        return ids
+    if selected_tags:
+        return get_tag_index().query(selected_tags)
+    return None
+
+@tracing.traced()
+def load_page(ids, cursor, limit, ranked=False):
+    # 1ページ分の (ID, タイトル) と次のページのカーソル（最後のページならNone）を返す
+    # カーソルはIDの順に並べたときは直前のページの最後のID、関連度順のときは表示済みの件数
+    store = get_store()
+    if ids is None:
+        rows = store.list_page(cursor, limit + 1)
+        return rows[:limit], (rows[limit - 1][0] if len(rows) > limit else None)
+    start = cursor if ranked else bisect.bisect_right(ids, cursor)
+    page_ids = ids[start:start + limit]
+    next_cursor = None
+    if start + limit < len(ids):
+        next_cursor = start + limit if ranked else page_ids[-1]
+    return store.get_titles(page_ids), next_cursor
+
+@tracing.traced()
+def export_recipes(fmt, compress=False, ids=None):
+    # ボタンが押されたときだけ、レシピを少しずつ読み出してファイルを作る
+    frames = get_store().iter_frames([int(recipe_id) for recipe_id in ids] if ids is not None else None)
+    with export_to_tempfile(frames, fmt, compress) as f:
+        return f.read()
+
+@tracing.traced()
+def import_csv(uploaded_file, policy='overwrite', progress=None):
+    # CSVをチャンクごとに検証しながら取り込み、結果のレポートを返す
+    # 書き込んだチャンクごとにタグのインデックスと類似レシピの行列に差分を反映する
+    expected_versions = index_versions()
+    def apply_changes(changes):
+        nonlocal expected_versions
+        update_indexes(expected_versions, changes)
+        expected_versions = index_versions()
+    return import_recipes(get_store(), uploaded_file, policy, progress=progress, on_write=apply_changes)
+
+def show_link_status():
+    # リンクの確認状況をサイドバーに表示する
+    checker = get_link_checker()
+    status = checker.status()
+    with st.sidebar:
+        st.subheader('リンクの確認')
+        if status['running']:
+            st.info('保存したレシピのリンクを確認しています...')
+        last_run = status['last_run']
+        if last_run:
+            st.caption(
+                f"最終確認: {time.strftime('%H:%M:%S', time.localtime(last_run['finished_at']))} "
+                f"（レシピ: {last_run['recipes']}件、リンク切れ: {last_run['dead']}件、更新: {last_run['refreshed']}件）"
+            )
+        if status['last_error']:
+            st.warning(f"リンクの確認に失敗しました（次の確認で再試行します）: {status['last_error']}")
+        if st.button('今すぐ確認', disabled=status['running']):
+            checker.trigger()
+
+def show_debug_panel(current):
+    # サイドバーにこの再実行の処理時間とカウンターを表示する
+    # （他のセッションの再実行と混ざらないよう、このセッションのトレースを受け取る）
+    if not st.sidebar.checkbox('処理時間を表示（デバッグ）', key='show_debug_panel'):
+        return
+    trace_dict = current.to_dict()
+    with st.sidebar:
+        st.subheader('処理時間')
+        st.caption(f"再実行 {trace_dict['trace_id']}: {trace_dict['span']['duration_ms']:.1f}ms")
+        rows = [
+            {'処理': '　' * depth + name, 'ms': duration_ms}
+            for depth, name, duration_ms, _ in tracing.flatten(trace_dict)
+        ]
+        st.dataframe(rows, hide_index=True, use_container_width=True)
+        st.subheader('カウンター')
+        st.json(trace_dict['counters'])
+        st.caption(f"JSONログ: {tracing.TRACE_LOG_FILE} / Prometheus: {tracing.METRICS_FILE}")
 
 def main():
     st.title('ぼくのレシピ帳')
     st.write("Webサイト上のレシピをまとめて保存するためのアプリです")
 
-    # レシピデータの読み込み
-    df = load_recipes()
-
     # 全てのタグを取得
-    all_tags = get_all_tags(df)
+    all_tags = get_all_tags()
+
+    show_link_status()
 
     # セッション状態の初期化
     if 'show_success' not in st.session_state:
@@ -110,9 +371,9 @@ def main():
         st.session_state.form_key = 0
 
     # タブの作成
-    tab1, tab2, tab3 = st.tabs(["レシピ追加", "レシピ一覧", "インポート/エクスポート"])
+    tab1, tab2, tab3, tab4 = st.tabs(["レシピ追加", "レシピ一覧", "インポート/エクスポート", "タグの管理"])
 
-    with tab1:
+    with tab1, tracing.span('render_add_tab'):
         st.header('新しいレシピを追加')
         
         # 成功メッセージの表示
@@ -131,10 +392,7 @@ def main():
             title, img_url = get_webpage_info(url)
             st.text_input('ウェブページのタイトル：', value=title, key=f'title_{st.session_state.form_key}')
             if img_url:
-                try:
-                    st.image(img_url, caption="レシピ画像", use_column_width=True)
-                except Exception as e:
-                    st.warning(f"画像の表示中にエラーが発生しました: {str(e)}")
+                show_preview_image(img_url)
             else:
                 st.info("レシピ画像が見つかりませんでした。")
         else:
@@ -166,7 +424,7 @@ def main():
         # 保存ボタン
         if st.button('レシピを保存', key=f'save_button_{st.session_state.form_key}'):
             if url and st.session_state[f'title_{st.session_state.form_key}']:  # URLとタイトルが入力されているか確認
-                df, success, message = save_recipe(df, url, st.session_state[f'title_{st.session_state.form_key}'], memo, ','.join(combined_tags), img_url)
+                success, message = save_recipe(url, st.session_state[f'title_{st.session_state.form_key}'], memo, ','.join(combined_tags), img_url)
                 if success:
                     st.session_state.show_success = True
                     st.session_state.clear_form = True
@@ -179,46 +437,132 @@ def main():
         # フォームクリアフラグをリセット
         if st.session_state.clear_form:
             st.session_state.clear_form = False
+
+        # URLをまとめて追加
+        st.subheader('URLをまとめて追加')
+        bulk_text = st.text_area('URLを1行に1つずつ入力してください：', key='bulk_urls')
+        bulk_file = st.file_uploader("またはURLの一覧・ブックマークのファイルを選択してください", type=['txt', 'html', 'htm'], key='bulk_file')
+        bulk_tags = st.multiselect('追加するレシピに付けるタグ:', options=all_tags, key='bulk_tags')
+        if st.button('まとめて追加'):
+            bulk_text = bulk_text or ''
+            if bulk_file is not None:
+                bulk_text += '\n' + bulk_file.getvalue().decode('utf-8', errors='replace')
+            urls = parse_urls(bulk_text)
+            if urls:
+                cache = get_page_cache()
+                progress_bar = st.progress(0.0, text='ページ情報を取得しています...')
+                results = fetch_all(
+                    urls, lambda u: fetch_webpage_info(u, cache, retry_failed=True),
+                    progress=lambda done, total: progress_bar.progress(done / total, text=f'ページ情報を取得しています... {done}/{total}')
+                )
+                recipes, failed = to_recipes(results, tags=','.join(bulk_tags), details=lambda u: page_details(u, cache))
+                # 取得したページ情報をまとめてキャッシュファイルに書き込む
+                cache.flush()
+                added, skipped = save_recipes(recipes)
+                st.success(f"{added}件のレシピを追加しました（重複: {skipped}件、失敗: {len(failed)}件）")
+                if failed:
+                    with st.expander('取得に失敗したURL'):
+                        for result in failed:
+                            st.write(f"{result['url']}: {result['error']}")
+            else:
+                st.error('URLが見つかりませんでした。')
     
-    with tab2:
+    with tab2, tracing.span('render_list_tab'):
         st.header('保存したレシピ一覧')
         
+        # キーワード検索（タイトル・メモ・タグ）
+        search_query = st.text_input('キーワードで検索（タイトル・メモ・タグ）', key='search_query')
+
         # タグでフィルタリング（複数選択可能）
         selected_tags = st.multiselect('タグでフィルタリング（複数選択可能、AND条件）', all_tags)
         
-        # レシピの表示（AND条件でフィルタリング）
-        if not selected_tags:  # タグが選択されていない場合は全てのレシピを表示
-            filtered_df = df
-        else:
-            filtered_df = df[df['タグ'].apply(lambda x: all(tag in str(x).split(',') for tag in selected_tags))]
-        
-        for index, recipe in filtered_df.iterrows():
-            with st.expander(recipe['タイトル']):
+        # 1ページの表示件数
+        page_size = st.selectbox('1ページの表示件数', PAGE_SIZES, index=PAGE_SIZES.index(PAGE_SIZE), key='page_size')
+
+        # 絞り込みの条件が変わったら最初のページに戻す（ページごとのカーソルを積んでおく）
+        list_filter = (search_query, tuple(selected_tags), page_size)
+        if st.session_state.get('list_filter') != list_filter:
+            st.session_state.list_filter = list_filter
+            st.session_state.page_cursors = [0]
+        page_cursors = st.session_state.page_cursors
+
+        # 絞り込み中のレシピID（エクスポートでも使う）と、表示中のページだけを読み込む
+        filtered_ids = find_recipe_ids(selected_tags, search_query)
+        total = len(filtered_ids) if filtered_ids is not None else get_store().count()
+        page, next_cursor = load_page(filtered_ids, page_cursors[-1], page_size, ranked=bool(search_query))
+        st.caption(f"{total}件中 {len(page_cursors)}ページ目")
+
+        # 開いたレシピだけメモと画像を読み込む
+        for index, title in page:
+            if not st.toggle(title or '（タイトルなし）', key=f'open_{index}'):
+                continue
+            recipe = get_store().get(index)
+            if recipe is None:
+                continue
+            with st.container(border=True):
                 st.write(f"URL: {recipe['URL']}")
                 st.write(f"メモ: {recipe['メモ']}")
                 st.write(f"タグ: {recipe['タグ']}")
-                if pd.notna(recipe['画像URL']):
-                    try:
-                        st.image(recipe['画像URL'], caption="レシピ画像", use_column_width=True)
-                    except Exception as e:
-                        st.warning(f"画像の表示中にエラーが発生しました: {str(e)}")
+                # ページから取り出せた場合だけ表示する
+                if recipe['調理時間']:
+                    st.write(f"調理時間: {recipe['調理時間']}分")
+                if recipe['分量']:
+                    st.write(f"分量: {recipe['分量']}")
+                if recipe['材料']:
+                    st.write("材料:")
+                    st.markdown('\n'.join(f"- {item}" for item in recipe['材料'].splitlines()))
+                if recipe['画像URL']:
+                    show_recipe_image(recipe['画像URL'], index)
                 else:
                     st.info("このレシピには画像が登録されていません。")
+
+                # 似ているレシピ（タイトル・メモ・タグ・材料が近いもの）
+                if st.checkbox('似ているレシピを表示', key=f'similar_{index}'):
+                    similar = find_similar_recipes(index)
+                    if similar:
+                        show_recipe_links(similar)
+                    elif get_similar_index_cache().rebuilding:
+                        st.info("似ているレシピを探す準備をしています。しばらくしてからもう一度お試しください。")
+                    else:
+                        st.info("似ているレシピが見つかりませんでした。")
                 
                 col1, col2 = st.columns(2)
                 with col1:
                     if st.button('編集', key=f'edit_{index}'):
-                        st.session_state.editing = index
-                        st.session_state.edit_url = recipe['URL']
-                        st.session_state.edit_title = recipe['タイトル']
-                        st.session_state.edit_memo = recipe['メモ']
-                        st.session_state.edit_tags = str(recipe['タグ']).split(',')
+                        start_editing(index, recipe)
                         st.experimental_rerun()
                 with col2:
                     if st.button('削除', key=f'delete_{index}'):
-                        df = delete_recipe(df, index)
-                        st.success('レシピが削除されました。')
-                        st.experimental_rerun()
+                        try:
+                            delete_recipe(index, recipe['バージョン'])
+                        except ConflictError as e:
+                            st.error(f"削除できませんでした: {str(e)}")
+                        else:
+                            st.success('レシピが削除されました。')
+                            st.experimental_rerun()
+
+        # ページ送り
+        col_prev, col_next = st.columns(2)
+        with col_prev:
+            if st.button('前のページ', disabled=len(page_cursors) == 1):
+                page_cursors.pop()
+                st.experimental_rerun()
+        with col_next:
+            if st.button('次のページ', disabled=next_cursor is None):
+                page_cursors.append(next_cursor)
+                st.experimental_rerun()
+
+        # 手持ちの材料から作れそうなレシピを探す
+        st.subheader('手持ちの材料で作れるレシピ')
+        pantry = st.text_input('手持ちの材料（カンマか空白区切り）', key='pantry')
+        if pantry:
+            cookable = find_cookable_recipes(pantry)
+            if cookable:
+                show_recipe_links(cookable)
+            elif get_similar_index_cache().rebuilding:
+                st.info("レシピを探す準備をしています。しばらくしてからもう一度お試しください。")
+            else:
+                st.info("該当するレシピが見つかりませんでした。")
 
         # 編集モード
         if 'editing' in st.session_state:
@@ -233,32 +577,132 @@ def main():
             )
 
             if st.button('更新'):
-                df = update_recipe(df, st.session_state.editing, edit_url, edit_title, edit_memo, ','.join(edit_tags))
-                st.success('レシピが更新されました。')
-                del st.session_state.editing
+                try:
+                    update_recipe(st.session_state.editing, edit_url, edit_title, edit_memo, ','.join(edit_tags), st.session_state.edit_version)
+                except ConflictError as e:
+                    st.session_state.edit_conflict = True
+                    st.error(f"更新できませんでした: {str(e)}")
+                except DuplicateUrlError as e:
+                    st.error(f"更新できませんでした: {str(e)}")
+                else:
+                    st.success('レシピが更新されました。')
+                    del st.session_state.editing
+                    st.experimental_rerun()
+
+            # 競合した場合は最新の内容を読み込み直してから編集し直す
+            if st.session_state.get('edit_conflict') and st.button('最新の内容を読み込む'):
+                latest = get_store().get(st.session_state.editing)
+                if latest is None:
+                    del st.session_state.editing
+                else:
+                    start_editing(st.session_state.editing, latest)
                 st.experimental_rerun()
 
             if st.button('キャンセル'):
                 del st.session_state.editing
                 st.experimental_rerun()
 
-    with tab3:
+    with tab3, tracing.span('render_import_export_tab'):
         st.header('レシピのインポート/エクスポート')
 
         # CSVファイルのインポート
         st.subheader('CSVファイルからレシピをインポート')
         uploaded_file = st.file_uploader("CSVファイルを選択してください", type="csv")
+        import_policy = st.radio('URLが重複したレシピの扱い', list(MERGE_POLICIES), index=1, format_func=MERGE_POLICIES.get)
+
+        # インポート結果の表示
+        if 'import_report' in st.session_state:
+            report = st.session_state.pop('import_report')
+            st.success(f"レシピがインポートされました！（追加: {report['added']}件、更新: {report['updated']}件、スキップ: {report['skipped']}件）")
+            if report['errors']:
+                with st.expander(f"取り込めなかった行（{len(report['errors'])}件）"):
+                    st.dataframe(report['errors'], use_container_width=True)
+
         if st.button('インポート'):
             if uploaded_file is not None:
-                df = import_csv(uploaded_file, df)
-                st.success('レシピがインポートされました！')
-                st.experimental_rerun()
+                progress_bar = st.progress(0.0, text='インポートしています...')
+                def show_progress(rows, fraction):
+                    progress_bar.progress(fraction or 0.0, text=f'インポートしています... {rows}行')
+                try:
+                    st.session_state.import_report = import_csv(uploaded_file, import_policy, show_progress)
+                except ValueError as e:
+                    st.error(f"インポート中にエラーが発生しました: {str(e)}")
+                else:
+                    st.experimental_rerun()
             else:
                 st.error('CSVファイルをアップロードしてください。')
 
-        # CSVダウンロードリンク
-        st.subheader('レシピをCSVファイルでエクスポート')
-        st.markdown(get_csv_download_link(df), unsafe_allow_html=True)
+        # エクスポート
+        st.subheader('レシピをエクスポート')
+        export_format = st.selectbox('形式', list(FORMATS), format_func=FORMAT_LABELS.get)
+        export_compress = st.checkbox('gzipで圧縮する')
+        export_filtered = st.checkbox(
+            f'一覧で絞り込んだレシピだけをエクスポートする（{total}件）',
+            disabled=filtered_ids is None
+        )
+        if st.button('エクスポートファイルを作成'):
+            ids = filtered_ids if export_filtered else None
+            st.session_state.export_file = (
+                export_filename(export_format, export_compress),
+                export_mime(export_format, export_compress),
+                export_recipes(export_format, export_compress, ids)
+            )
+        if 'export_file' in st.session_state:
+            file_name, mime, data = st.session_state.export_file
+            if st.download_button(f'{file_name} をダウンロード', data=data, file_name=file_name, mime=mime):
+                del st.session_state.export_file
+
+    with tab4, tracing.span('render_tags_tab'):
+        st.header('タグの管理')
+        tag_counts = get_tag_index().counts()
+
+        # タグそのものの変更（そのタグを持つ全てのレシピが対象）
+        st.subheader('タグの名前の変更・統合・分割・削除')
+        tag_op = st.selectbox('操作', list(TAG_OPERATIONS), format_func=TAG_OPERATIONS.get, key='tag_op')
+        tag_sources = st.multiselect(
+            '対象のタグ', all_tags, key='tag_sources',
+            format_func=lambda tag: f"{tag}（{tag_counts.get(tag, 0)}件）"
+        )
+        tag_targets = []
+        if tag_op != 'delete':
+            tag_targets = split_tags(st.text_input('新しいタグ（複数の場合はカンマ区切り）', key='tag_targets'))
+        show_tag_operation(tag_op, tag_sources, tag_targets, tagged_recipe_ids(tag_sources), 'tag')
+
+        # 選んだレシピへのタグの追加・削除
+        st.subheader('選んだレシピのタグをまとめて変更')
+        selection_tags = st.multiselect('タグで絞り込み', all_tags, key='selection_filter_tags')
+        selection_query = st.text_input('キーワードで絞り込み', key='selection_query')
+        candidate_ids = find_recipe_ids(selection_tags, selection_query)
+        if candidate_ids is None:
+            st.caption('タグかキーワードで絞り込んでからレシピを選んでください')
+        else:
+            # 絞り込んだ結果はキーワード検索でも件数で打ち切らないので、すべてを選べる
+            if st.checkbox(f'絞り込んだ{len(candidate_ids)}件すべてを選ぶ', key='select_all'):
+                selected_ids = candidate_ids
+            else:
+                # 選択肢が多すぎないよう、絞り込んだ結果の先頭だけを並べる
+                if len(candidate_ids) > SELECTION_CHOICES:
+                    st.caption(f'{len(candidate_ids)}件のうち先頭の{SELECTION_CHOICES}件から選べます')
+                titles = dict(get_store().get_titles(candidate_ids[:SELECTION_CHOICES]))
+                selected_ids = st.multiselect(
+                    'レシピ', list(titles), key='selected_recipes',
+                    format_func=lambda recipe_id: titles.get(recipe_id) or '（タイトルなし）'
+                )
+            selection_op = st.radio(
+                '操作', list(SELECTION_OPERATIONS), format_func=SELECTION_OPERATIONS.get,
+                horizontal=True, key='selection_op'
+            )
+            selection_sources, selection_targets = [], []
+            if selection_op == 'add':
+                selection_targets = split_tags(st.text_input('付けるタグ（複数の場合はカンマ区切り）', key='selection_targets'))
+            else:
+                selection_sources = st.multiselect('外すタグ', all_tags, key='selection_sources')
+            if not selected_ids:
+                st.caption('レシピを選んでください')
+            else:
+                show_tag_operation(selection_op, selection_sources, selection_targets, selected_ids, 'selection')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    with tracing.trace('rerun') as current:
+        main()
+    show_debug_panel(current)
\ No newline at end of file
@@ -0,0 +1,517 @@
+import math
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+import search_index
+import tracing
+from canonical_url import rules_version, url_key
+from errors import ConflictError, DuplicateUrlError
+
+# データベースファイルのパス
+DB_FILE = 'recipe_book.db'
+# 移行元のCSVファイルのパス
+CSV_FILE = 'recipe_list.csv'
+
+COLUMNS = ['URL', 'タイトル', 'メモ', 'タグ', '画像URL', '材料', '調理時間', '分量']
+# DataFrameの列名とテーブルの列名の対応
+FIELDS = {
+    'URL': 'url', 'タイトル': 'title', 'メモ': 'memo', 'タグ': 'tags', '画像URL': 'img_url',
+    '材料': 'ingredients', '調理時間': 'cook_time', '分量': 'servings',
+}
+# ページのJSON-LDから取り出した項目（材料は1行に1つ、調理時間は分）
+# 後から追加した列なので、古いデータベースには起動時に追加する
+ADDED_FIELDS = {
+    'version': 'INTEGER NOT NULL DEFAULT 1',
+    'ingredients': 'TEXT',
+    'cook_time': 'INTEGER',
+    'servings': 'TEXT',
+}
+INTEGER_COLUMNS = ['調理時間']
+# URLのインデックスの形式（変えたら上げる。古い形式のテーブルは起動時に作り直す）
+URL_KEYS_FORMAT = '2'
+
+URL_KEYS_SCHEMA = '''
+-- 正規化したURLのハッシュ -> レシピID（重複チェック用）
+-- url はキーの元になったURL（レシピのURLか、ページが示した正規のURL）で、ルールが変わったときの作り直しに使う
+-- 同じキーのレシピが複数あれば全て持ち、先に登録されたもの（IDが小さいもの）を重複の相手とする
+-- （削除しても、同じURLの残ったレシピで重複を見つけられる）
+CREATE TABLE IF NOT EXISTS url_keys (
+    key BLOB NOT NULL,
+    recipe_id INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    is_alias INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (key, recipe_id, is_alias)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_url_keys_recipe ON url_keys(recipe_id);
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS recipes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    title TEXT,
+    memo TEXT,
+    tags TEXT,
+    img_url TEXT,
+    version INTEGER NOT NULL DEFAULT 1,
+    ingredients TEXT,
+    cook_time INTEGER,
+    servings TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_recipes_url ON recipes(url);
+CREATE INDEX IF NOT EXISTS idx_recipes_title ON recipes(title);
+-- 保存したURL（レシピのページと画像）ごとのリンクの確認結果
+-- title と img_url は前回ページから取り出した値で、利用者が書き換えていないかの判定に使う
+CREATE TABLE IF NOT EXISTS link_status (
+    url TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status INTEGER,
+    error TEXT,
+    failures INTEGER NOT NULL DEFAULT 0,
+    etag TEXT,
+    last_modified TEXT,
+    title TEXT,
+    img_url TEXT,
+    checked_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+''' + URL_KEYS_SCHEMA
+
+SELECT_COLUMNS = ', '.join(f'{field} AS "{column}"' for column, field in FIELDS.items())
+INSERT_SQL = f"INSERT INTO recipes ({', '.join(FIELDS.values())}) VALUES ({', '.join('?' * len(FIELDS))})"
+UPDATE_SQL = f"UPDATE recipes SET {', '.join(f'{field} = ?' for field in FIELDS.values())}, version = version + 1 WHERE id = ?"
+
+def _clean(value):
+    # pandasの欠損値（NaN）はNULLとして保存する（pandasを読み込まずに判定する）
+    if value is None:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if type(value).__name__ == 'NAType':
+        # 整数の列（Int64）の欠損値
+        return None
+    if hasattr(value, 'item'):
+        # numpyの数値はPythonの数値にしないと保存できない
+        return _clean(value.item())
+    return value
+
+def _row(recipe):
+    return tuple(_clean(recipe.get(column)) for column in COLUMNS)
+
+def _frame(df):
+    # 整数の列は欠損値があっても小数にならないようにする（CSVに「30.0」と書き出さない）
+    for column in INTEGER_COLUMNS:
+        df[column] = df[column].astype('Int64')
+    return df
+
+def _rows_read(rows):
+    # 読み出した行数を計測用のカウンターに加える
+    tracing.incr('rows_read', len(rows))
+    return rows
+
+class RecipeStore:
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        # トランザクションは自前で管理する（isolation_level=None）
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=5000')
+        self.conn.executescript(SCHEMA)
+        self._ensure_columns()
+        search_index.ensure_schema(self.conn)
+        self._ensure_search_index()
+        self._ensure_url_keys()
+
+    def _ensure_columns(self):
+        # 後から追加した列（行のバージョンやレシピの情報）が無い古いデータベースに列を追加する
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(recipes)')]
+        for field, definition in ADDED_FIELDS.items():
+            if field not in columns:
+                self.conn.execute(f'ALTER TABLE recipes ADD COLUMN {field} {definition}')
+
+    def _ensure_search_index(self):
+        # トークン化の方式が変わった場合（初回を含む）は検索インデックスを作り直す
+        if self.get_meta('search_tokenizer') == search_index.TOKENIZER_VERSION:
+            return
+        with self.transaction() as conn:
+            search_index.rebuild(conn)
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('search_tokenizer', ?)",
+                (search_index.TOKENIZER_VERSION,)
+            )
+
+    def _ensure_url_keys(self):
+        # 正規化のルールかテーブルの形式が変わった場合（初回を含む）はURLのインデックスを作り直す
+        version = f'{URL_KEYS_FORMAT}-{rules_version()}'
+        if self.get_meta('url_rules') == version:
+            return
+        with self.transaction() as conn:
+            aliases = conn.execute('SELECT recipe_id, url FROM url_keys WHERE is_alias = 1').fetchall()
+            conn.execute('DROP TABLE url_keys')
+            for statement in URL_KEYS_SCHEMA.split(';'):
+                conn.execute(statement)
+            for recipe_id, url in conn.execute('SELECT id, url FROM recipes ORDER BY id').fetchall():
+                self._add_url_key(conn, recipe_id, url)
+            for recipe_id, url in aliases:
+                self._add_url_key(conn, recipe_id, url, alias=True)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('url_rules', ?)", (version,))
+
+    @contextmanager
+    def transaction(self, bump_version=True):
+        # レシピの内容が変わらない書き込み（リンクの確認結果など）は bump_version=False にする
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+                # 書き込みのたびにデータのバージョンを進める
+                if bump_version:
+                    self.conn.execute(
+                        "INSERT INTO meta (key, value) VALUES ('version', 1) "
+                        "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+                    )
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def load(self):
+        import pandas as pd
+        with self._lock:
+            return _rows_read(_frame(pd.read_sql_query(
+                f'SELECT id, {SELECT_COLUMNS} FROM recipes ORDER BY id',
+                self.conn, index_col='id'
+            )))
+
+    def data_version(self):
+        return int(self.get_meta('version', 0))
+
+    def iter_tags(self):
+        with self._lock:
+            return _rows_read(self.conn.execute('SELECT id, tags FROM recipes').fetchall())
+
+    def iter_texts(self):
+        # 類似レシピの行列を作るための (ID, タイトル, メモ, タグ, 材料)
+        with self._lock:
+            return _rows_read(self.conn.execute('SELECT id, title, memo, tags, ingredients FROM recipes').fetchall())
+
+    def iter_frames(self, ids=None, chunk_rows=5000):
+        # エクスポート用にレシピを少しずつ読み出す（読み出しの間はロックを保持しない）
+        import pandas as pd
+        if ids is None:
+            last_id = 0
+            while True:
+                with self._lock:
+                    df = pd.read_sql_query(
+                        f'SELECT id, {SELECT_COLUMNS} FROM recipes WHERE id > ? ORDER BY id LIMIT ?',
+                        self.conn, params=(last_id, chunk_rows), index_col='id'
+                    )
+                if df.empty:
+                    return
+                yield _rows_read(_frame(df))
+                last_id = int(df.index[-1])
+        else:
+            ids = list(ids)
+            for start in range(0, len(ids), chunk_rows):
+                batch = ids[start:start + chunk_rows]
+                placeholders = ', '.join('?' * len(batch))
+                with self._lock:
+                    df = pd.read_sql_query(
+                        f'SELECT id, {SELECT_COLUMNS} FROM recipes WHERE id IN ({placeholders})',
+                        self.conn, params=batch, index_col='id'
+                    )
+                # 指定された順序（検索結果の順位など）に並べ直す
+                yield _rows_read(_frame(df)).reindex([recipe_id for recipe_id in batch if recipe_id in df.index])
+
+    def list_page(self, after=0, limit=20):
+        # 一覧の1ページ分の (ID, タイトル) をIDの順に返す
+        # OFFSETを使わず直前のページの最後のIDから読むので、件数が増えても速さが変わらない
+        with self._lock:
+            return _rows_read(self.conn.execute(
+                'SELECT id, title FROM recipes WHERE id > ? ORDER BY id LIMIT ?', (after, limit)
+            ).fetchall())
+
+    def get_titles(self, ids):
+        # 指定したIDの (ID, タイトル) を指定した順に返す
+        ids = list(ids)
+        if not ids:
+            return []
+        placeholders = ', '.join('?' * len(ids))
+        with self._lock:
+            titles = dict(_rows_read(self.conn.execute(
+                f'SELECT id, title FROM recipes WHERE id IN ({placeholders})', ids
+            ).fetchall()))
+        return [(recipe_id, titles[recipe_id]) for recipe_id in ids if recipe_id in titles]
+
+    def get(self, recipe_id):
+        # レシピの内容と行のバージョンを返す
+        with self._lock:
+            cursor = self.conn.execute(f'SELECT {SELECT_COLUMNS}, version FROM recipes WHERE id = ?', (recipe_id,))
+            row = cursor.fetchone()
+        tracing.incr('rows_read', 1 if row else 0)
+        return dict(zip(COLUMNS + ['バージョン'], row)) if row else None
+
+    def count(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM recipes').fetchone()[0]
+
+    def _find_id(self, conn, urls):
+        for url in urls:
+            if not url:
+                continue
+            row = conn.execute('SELECT MIN(recipe_id) FROM url_keys WHERE key = ?', (url_key(url),)).fetchone()
+            if row[0] is not None:
+                return row[0]
+        return None
+
+    def find_id_by_url(self, url, canonical_url=None):
+        # 正規化したURLのハッシュで重複を探す（ページが示す正規のURLがあればそれでも探す）
+        with self._lock:
+            return self._find_id(self.conn, (url, canonical_url))
+
+    def url_exists(self, url, canonical_url=None):
+        return self.find_id_by_url(url, canonical_url) is not None
+
+    def find_ids_by_keys(self, keys):
+        # 複数のURLのキーをまとめて引き、見つかったキー -> レシピIDを返す
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ', '.join('?' * len(batch))
+            with self._lock:
+                found.update(self.conn.execute(
+                    f'SELECT key, MIN(recipe_id) FROM url_keys WHERE key IN ({placeholders}) GROUP BY key', batch
+                ).fetchall())
+        return found
+
+    def _add_url_key(self, conn, recipe_id, url, alias=False):
+        # 同じキーのレシピがあっても登録する（重複の相手には先に登録されたレシピを使う）
+        if url:
+            conn.execute(
+                'INSERT OR IGNORE INTO url_keys (key, recipe_id, url, is_alias) VALUES (?, ?, ?, ?)',
+                (url_key(url), recipe_id, url, int(alias))
+            )
+
+    def _reindex_url(self, conn, recipe_id, url):
+        # レシピのURLが変わったらキーを付け替える（ページが示す正規のURLのキーは残す）
+        conn.execute('DELETE FROM url_keys WHERE recipe_id = ? AND is_alias = 0', (recipe_id,))
+        self._add_url_key(conn, recipe_id, url)
+
+    def _insert(self, conn, recipe):
+        cursor = conn.execute(INSERT_SQL, _row(recipe))
+        search_index.index_recipe(conn, cursor.lastrowid, *(_clean(recipe.get(column)) for column in ('タイトル', 'メモ', 'タグ')))
+        self._add_url_key(conn, cursor.lastrowid, recipe.get('URL'))
+        self._add_url_key(conn, cursor.lastrowid, recipe.get('正規URL'), alias=True)
+        tracing.incr('rows_written')
+        return cursor.lastrowid
+
+    def _reindex(self, conn, recipe_id):
+        row = conn.execute('SELECT title, memo, tags FROM recipes WHERE id = ?', (recipe_id,)).fetchone()
+        if row:
+            search_index.index_recipe(conn, recipe_id, *row)
+
+    def insert(self, recipe):
+        # 重複の確認と追加を同じトランザクションで行い、同時に同じURLを保存しても1件だけにする
+        with self.transaction() as conn:
+            duplicate_id = self._find_id(conn, (recipe['URL'], recipe.get('正規URL')))
+            if duplicate_id is not None:
+                raise DuplicateUrlError(f'このURLのレシピはすでに存在しています（ID: {duplicate_id}）。')
+            return self._insert(conn, recipe)
+
+    def insert_many(self, recipes, skip_existing=True):
+        # 複数のレシピを1つのトランザクションで追加し、追加したIDとレシピの組を返す
+        # 重複はURLのインデックスで判定するので、同じ呼び出しの中での重複も除かれる
+        ids = []
+        with self.transaction() as conn:
+            for recipe in recipes:
+                if skip_existing and self._find_id(conn, (recipe['URL'], recipe.get('正規URL'))) is not None:
+                    continue
+                ids.append((self._insert(conn, recipe), recipe))
+        return ids
+
+    def _check_version(self, conn, cursor, recipe_id):
+        # 条件付きの更新・削除で行が変わらなかった理由を調べて知らせる
+        if cursor.rowcount:
+            return
+        if conn.execute('SELECT 1 FROM recipes WHERE id = ?', (recipe_id,)).fetchone():
+            raise ConflictError('このレシピは他のユーザーによって先に更新されました。')
+        raise ConflictError('このレシピは他のユーザーによって削除されました。')
+
+    def update(self, recipe_id, values, expected_version=None):
+        # expected_version を渡すと、そのバージョンのときだけ更新する（違えば ConflictError）
+        # 他のレシピと同じURLに変えようとした場合は DuplicateUrlError
+        assignments = ', '.join(f'{FIELDS[column]} = ?' for column in values)
+        params = [_clean(value) for value in values.values()] + [recipe_id]
+        condition = 'id = ?'
+        if expected_version is not None:
+            condition += ' AND version = ?'
+            params.append(int(expected_version))
+        with self.transaction() as conn:
+            if 'URL' in values and not conn.execute(
+                'SELECT 1 FROM url_keys WHERE key = ? AND recipe_id = ?', (url_key(values['URL']), recipe_id)
+            ).fetchone():
+                # 他のレシピと同じURLに書き換える場合は、保存するときと同じく重複として断る
+                duplicate_id = self._find_id(conn, (values['URL'],))
+                if duplicate_id is not None:
+                    raise DuplicateUrlError(f'このURLのレシピはすでに存在しています（ID: {duplicate_id}）。')
+            cursor = conn.execute(f'UPDATE recipes SET {assignments}, version = version + 1 WHERE {condition}', params)
+            self._check_version(conn, cursor, recipe_id)
+            self._reindex(conn, recipe_id)
+            if 'URL' in values:
+                self._reindex_url(conn, recipe_id, values['URL'])
+        tracing.incr('rows_written')
+
+    def delete(self, recipe_id, expected_version=None):
+        params = [recipe_id]
+        condition = 'id = ?'
+        if expected_version is not None:
+            condition += ' AND version = ?'
+            params.append(int(expected_version))
+        with self.transaction() as conn:
+            cursor = conn.execute(f'DELETE FROM recipes WHERE {condition}', params)
+            self._check_version(conn, cursor, recipe_id)
+            search_index.unindex_recipe(conn, recipe_id)
+            conn.execute('DELETE FROM url_keys WHERE recipe_id = ?', (recipe_id,))
+        tracing.incr('rows_written')
+
+    def iter_urls(self):
+        with self._lock:
+            return _rows_read(self.conn.execute('SELECT id, url FROM recipes').fetchall())
+
+    def links_to_check(self, checked_before, limit=100):
+        # ページか画像のどちらかが未確認か、確認から時間の経ったレシピを古い順に返す
+        with self._lock:
+            return _rows_read(self.conn.execute(
+                '''
+                SELECT r.id, r.url, r.img_url, r.title, r.version
+                FROM recipes r
+                LEFT JOIN link_status p ON p.url = r.url
+                LEFT JOIN link_status i ON i.url = r.img_url
+                WHERE COALESCE(p.checked_at, 0) < ?
+                   OR (COALESCE(r.img_url, '') != '' AND COALESCE(i.checked_at, 0) < ?)
+                ORDER BY MIN(
+                    COALESCE(p.checked_at, 0),
+                    CASE WHEN COALESCE(r.img_url, '') = '' THEN COALESCE(p.checked_at, 0) ELSE COALESCE(i.checked_at, 0) END
+                ), r.id
+                LIMIT ?
+                ''',
+                (checked_before, checked_before, limit)
+            ).fetchall())
+
+    def link_statuses(self, urls):
+        # URL -> 確認結果（未確認のURLは含まない）
+        urls = [url for url in dict.fromkeys(urls) if url]
+        found = {}
+        for start in range(0, len(urls), 500):
+            batch = urls[start:start + 500]
+            placeholders = ', '.join('?' * len(batch))
+            with self._lock:
+                cursor = self.conn.execute(f'SELECT * FROM link_status WHERE url IN ({placeholders})', batch)
+                names = [column[0] for column in cursor.description]
+                found.update((row[0], dict(zip(names, row))) for row in cursor.fetchall())
+        return found
+
+    def record_link_statuses(self, entries):
+        # 確認結果をまとめて書き込む（レシピの内容は変わらないのでデータのバージョンは進めない）
+        if not entries:
+            return
+        with self.transaction(bump_version=False) as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO link_status '
+                '(url, kind, status, error, failures, etag, last_modified, title, img_url, checked_at) '
+                'VALUES (:url, :kind, :status, :error, :failures, :etag, :last_modified, :title, :img_url, :checked_at)',
+                entries
+            )
+
+    def write_batch(self, inserts, updates):
+        # 追加と更新を1つのトランザクションでまとめて書き込み、追加したIDと、競合して更新しなかったIDを返す
+        # 更新する内容に読み込んだときの 'バージョン' があれば、そのバージョンのときだけ更新する
+        # （読み込んだ後に他のセッションが更新したレシピは上書きしない）
+        ids = []
+        conflicts = []
+        with self.transaction() as conn:
+            for recipe_id, recipe in updates:
+                if recipe.get('バージョン') is None:
+                    cursor = conn.execute(UPDATE_SQL, _row(recipe) + (recipe_id,))
+                else:
+                    cursor = conn.execute(UPDATE_SQL + ' AND version = ?', _row(recipe) + (recipe_id, int(recipe['バージョン'])))
+                if not cursor.rowcount:
+                    conflicts.append(recipe_id)
+                    continue
+                self._reindex(conn, recipe_id)
+                self._reindex_url(conn, recipe_id, recipe['URL'])
+            tracing.incr('rows_written', len(updates) - len(conflicts))
+            for recipe in inserts:
+                ids.append(self._insert(conn, recipe))
+        return ids, conflicts
+
+    def _tag_changes(self, conn, ids, transform):
+        # transform でタグが変わる行だけを (ID, タイトル, 変更前, 変更後) のIDの順で返す
+        changes = []
+        ids = list(ids)
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            placeholders = ', '.join('?' * len(batch))
+            rows = _rows_read(conn.execute(
+                f'SELECT id, title, tags FROM recipes WHERE id IN ({placeholders})', batch
+            ).fetchall())
+            for recipe_id, title, tags in rows:
+                new_tags = transform(tags)
+                if new_tags is not None:
+                    changes.append((recipe_id, title, tags, new_tags))
+        changes.sort()
+        return changes
+
+    def retag(self, ids, transform, dry_run=False):
+        # 指定したレシピのタグを transform で書き換え、変わる行の (ID, タイトル, 変更前, 変更後) を返す
+        # 変わる行は1つのトランザクションでまとめて書き込む（dry_run ならプレビューだけで書き込まない）
+        # 書き込むときはトランザクションの中で読み直すので、プレビューの後の変更も失われない
+        if dry_run:
+            with self._lock:
+                return self._tag_changes(self.conn, ids, transform)
+        with self.transaction() as conn:
+            changes = self._tag_changes(conn, ids, transform)
+            conn.executemany(
+                'UPDATE recipes SET tags = ?, version = version + 1 WHERE id = ?',
+                [(new_tags, recipe_id) for recipe_id, _, _, new_tags in changes]
+            )
+            for recipe_id, _, _, _ in changes:
+                self._reindex(conn, recipe_id)
+        tracing.incr('rows_written', len(changes))
+        return changes
+
+    def search(self, query, limit=None):
+        with self._lock:
+            return search_index.search(self.conn, query, limit)
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def migrate_from_csv(self, csv_path=CSV_FILE):
+        # 既存のCSVファイルからの移行は最初の1回だけ行う
+        if self.get_meta('csv_migrated') or not os.path.exists(csv_path):
+            return 0
+        import pandas as pd
+        df = pd.read_csv(csv_path).reindex(columns=COLUMNS)
+        recipes = df.to_dict('records')
+        with self.transaction() as conn:
+            # 別のプロセスが先に移行していないかトランザクション内で確認する
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'csv_migrated'").fetchone():
+                return 0
+            for recipe in recipes:
+                self._insert(conn, recipe)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_migrated', '1')")
+        return len(recipes)
+
+def open_store(path=DB_FILE, csv_path=CSV_FILE):
+    store = RecipeStore(path)
+    store.migrate_from_csv(csv_path)
+    return store
@@ -0,0 +1,78 @@
+import re
+import unicodedata
+
+# トークン化の方式を変えたら上げる（インデックスを作り直す）
+TOKENIZER_VERSION = '1'
+# 列ごとの重み（タイトル、メモ、タグ）
+BM25_WEIGHTS = (3.0, 1.0, 2.0)
+
+WORD = re.compile(r'\w+')
+
+SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS recipe_search USING fts5(
+    title, memo, tags,
+    tokenize = "unicode61 remove_diacritics 0 tokenchars '_'",
+    prefix = '1'
+);
+'''
+
+def _normalize(text):
+    if not isinstance(text, str):
+        return ''
+    return unicodedata.normalize('NFKC', text).lower()
+
+def _ngrams(word):
+    # 形態素解析を使わず、文字のバイグラムと末尾の1文字をトークンにする
+    return [word[i:i + 2] for i in range(len(word) - 1)] + [word[-1]]
+
+def tokenize(text):
+    tokens = []
+    for word in WORD.findall(_normalize(text)):
+        tokens.extend(_ngrams(word))
+    return tokens
+
+def build_query(query):
+    # 語ごとにバイグラムのフレーズ検索を作り、AND でつなぐ
+    # 1文字だけの語は前方一致にして入力途中でも候補が出るようにする
+    terms = []
+    for word in WORD.findall(_normalize(query)):
+        if len(word) == 1:
+            terms.append(f'"{word}"*')
+        else:
+            bigrams = [word[i:i + 2] for i in range(len(word) - 1)]
+            terms.append('"' + ' '.join(bigrams) + '"')
+    return ' AND '.join(dict.fromkeys(terms))
+
+def ensure_schema(conn):
+    conn.executescript(SCHEMA)
+
+def index_recipe(conn, recipe_id, title, memo, tags):
+    conn.execute('DELETE FROM recipe_search WHERE rowid = ?', (recipe_id,))
+    conn.execute(
+        'INSERT INTO recipe_search (rowid, title, memo, tags) VALUES (?, ?, ?, ?)',
+        (recipe_id, ' '.join(tokenize(title)), ' '.join(tokenize(memo)), ' '.join(tokenize(tags)))
+    )
+
+def unindex_recipe(conn, recipe_id):
+    conn.execute('DELETE FROM recipe_search WHERE rowid = ?', (recipe_id,))
+
+def rebuild(conn):
+    conn.execute('DELETE FROM recipe_search')
+    rows = conn.execute('SELECT id, title, memo, tags FROM recipes').fetchall()
+    for row in rows:
+        index_recipe(conn, *row)
+
+def search(conn, query, limit=None):
+    # BM25のスコア順にレシピIDを返す（limit を省略すると一致したものをすべて返す）
+    match = build_query(query)
+    if not match:
+        return []
+    sql = (
+        f'SELECT rowid FROM recipe_search WHERE recipe_search MATCH ? '
+        f'ORDER BY bm25(recipe_search, {", ".join(map(str, BM25_WEIGHTS))})'
+    )
+    params = (match,)
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params += (limit,)
+    return [row[0] for row in conn.execute(sql, params).fetchall()]
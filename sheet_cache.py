@@ -0,0 +1,371 @@
+import atexit
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from bulk_import import backoff_delay
+from canonical_url import url_key
+from errors import ConflictError
+import tracing
+
+COLUMNS = ['URL', 'タイトル', 'メモ', 'タグ', '画像URL', 'ID', 'バージョン']
+# レシピの内容の列数（IDとバージョンの列の手前まで）
+VALUE_COLUMNS = 5
+ID_COLUMN = 'F'
+VERSION_COLUMN = 'G'
+# 他のユーザーによる変更を確認する間隔（秒）
+CHECK_INTERVAL = 30
+# 溜まった変更をシートに書き込む間隔（秒）
+FLUSH_INTERVAL = 2
+# 再試行の待ち時間の上限（秒）
+RETRY_MAX_DELAY = 300
+# 利用上限（429）などの一時的なエラーとして扱うステータスコード
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# 保持しておく競合の記録の件数
+MAX_CONFLICTS = 20
+
+def new_recipe_id():
+    return uuid.uuid4().hex[:16]
+
+def coalesce(ops):
+    # 変更の記録をまとめて、更新・削除・追加をそれぞれ1回のAPI呼び出しにできる形にする
+    # 更新と削除はレシピIDをキーにし、シート上で期待するバージョン（最初の変更の前のもの）を残す
+    appends = {}
+    updates = {}
+    deletes = {}
+    for op in ops:
+        if op[0] == 'append':
+            row = op[1]
+            appends[row[5]] = row
+        elif op[0] == 'update':
+            recipe_id, row, expected = op[1], op[2], op[3]
+            if recipe_id in appends:
+                # まだ送信していない追加行はその内容を書き換える
+                appends[recipe_id] = row
+            else:
+                expected = updates[recipe_id][1] if recipe_id in updates else expected
+                updates[recipe_id] = (row, expected)
+        elif op[0] == 'delete':
+            recipe_id, expected = op[1], op[2]
+            if recipe_id in appends:
+                del appends[recipe_id]
+            else:
+                if recipe_id in updates:
+                    expected = updates.pop(recipe_id)[1]
+                deletes.setdefault(recipe_id, expected)
+    return list(appends.values()), updates, deletes
+
+def _to_ops(appends, updates, deletes):
+    ops = [('update', recipe_id, row, expected) for recipe_id, (row, expected) in updates.items()]
+    ops += [('delete', recipe_id, expected) for recipe_id, expected in deletes.items()]
+    ops += [('append', row) for row in appends]
+    return ops
+
+def _call(name, fn, *args, **kwargs):
+    # Sheets / Drive APIの呼び出し回数と時間を計測する
+    with tracing.span(f'sheets.{name}'):
+        tracing.incr('sheets_api_calls')
+        return fn(*args, **kwargs)
+
+def is_retryable(error):
+    from gspread.exceptions import APIError
+    return isinstance(error, APIError) and error.response.status_code in RETRY_STATUSES
+
+class SheetCache:
+    def __init__(self, client, sheet_id, check_interval=CHECK_INTERVAL, flush_interval=FLUSH_INTERVAL):
+        self.client = client
+        self.sheet_id = sheet_id
+        self.check_interval = check_interval
+        self.flush_interval = flush_interval
+        self.spreadsheet = _call('open_by_key', client.open_by_key, sheet_id)
+        self.worksheet = self.spreadsheet.sheet1
+        # ロックは必ず _flush_lock -> _lock の順に取る
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._df = None
+        # 正規化したURLのハッシュ -> 件数（重複チェック用）
+        self._urls = Counter()
+        # レシピID -> 手元のDataFrameでの行の位置
+        self._index = {}
+        self._modified_time = None
+        self._checked_at = 0
+        # 内容が変わるたびに進むバージョン（タグのインデックス等の作り直しに使う）
+        self.version = 0
+        # まだシートに書き込んでいない変更
+        self._ops = []
+        self._attempt = 0
+        self._retry_at = 0
+        self.last_flush = None
+        self.last_error = None
+        # シートへの書き込み時に他のプロセスの変更と競合して破棄した変更
+        self.conflicts = deque(maxlen=MAX_CONFLICTS)
+
+        threading.Thread(target=self._run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def _fetch_modified_time(self):
+        # スプレッドシートの最終更新時刻だけをDrive APIで取得する（内容は取得しない）
+        from gspread.urls import DRIVE_FILES_API_V3_URL
+        response = _call(
+            'modified_time', self.client.request, 'get', f'{DRIVE_FILES_API_V3_URL}/{self.sheet_id}',
+            params={'fields': 'modifiedTime', 'supportsAllDrives': True}
+        )
+        return response.json()['modifiedTime']
+
+    def _refresh(self):
+        # 更新時刻を先に取得しておき、読み込み中の変更を取りこぼさないようにする
+        # pandas はアプリの起動を速くするため、最初にシートを読み込むときに読み込む
+        import pandas as pd
+        modified_time = self._fetch_modified_time()
+        data = _call('get_all_values', self.worksheet.get_all_values)
+        tracing.incr('rows_read', max(len(data) - 1, 0))
+        rows = [(row + [''] * len(COLUMNS))[:len(COLUMNS)] for row in data[1:]]
+        if self._assign_ids(data[:1], rows):
+            modified_time = self._fetch_modified_time()
+        self._df = pd.DataFrame(rows, columns=COLUMNS)
+        self._urls = Counter(url_key(url) for url in self._df['URL'])
+        self._index = {recipe_id: i for i, recipe_id in enumerate(self._df['ID'])}
+        self._modified_time = modified_time
+        self._checked_at = time.monotonic()
+        self.version += 1
+
+    def _assign_ids(self, header, rows):
+        # IDの無い行（以前の形式のシートや手で追加した行）にIDとバージョンを振ってシートに書き込む
+        if not header:
+            # 空のシートには見出し行だけを書き込む
+            _call('batch_update', self.worksheet.batch_update, [{'range': f'A1:{VERSION_COLUMN}1', 'values': [COLUMNS]}])
+            return True
+        missing = [i for i, row in enumerate(rows) if not row[5]]
+        if not missing and header[0][5:7] == COLUMNS[5:7]:
+            return False
+        for i in missing:
+            rows[i][5] = new_recipe_id()
+            rows[i][6] = '1'
+        values = [COLUMNS[5:7]] + [row[5:7] for row in rows]
+        _call('batch_update', self.worksheet.batch_update, [
+            {'range': f'{ID_COLUMN}1:{VERSION_COLUMN}{len(values)}', 'values': values}
+        ])
+        tracing.incr('rows_written', len(missing))
+        return True
+
+    def get(self):
+        # 共有のDataFrameを返す（呼び出し側で変更しないこと）
+        with self._lock:
+            if self._df is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return self._df
+
+        with self._flush_lock:
+            with self._lock:
+                if self._df is None:
+                    self._refresh()
+                    return self._df
+                if time.monotonic() - self._checked_at < self.check_interval:
+                    return self._df
+                self._checked_at = time.monotonic()
+                changed = self._fetch_modified_time() != self._modified_time
+            # 他のユーザーが変更していたら、未送信の変更を先に書き込んでから読み直す
+            if changed and self._flush():
+                with self._lock:
+                    self._refresh()
+            with self._lock:
+                return self._df
+
+    def snapshot(self):
+        # DataFrameとそのバージョンを同時に取得する
+        self.get()
+        with self._lock:
+            return self._df, self.version
+
+    def has_url(self, url, canonical_url=None):
+        # 正規化したURLのハッシュで重複を探す（ページが示す正規のURLがあればそれでも探す）
+        self.get()
+        keys = [url_key(value) for value in (url, canonical_url) if value]
+        with self._lock:
+            return any(self._urls[key] > 0 for key in keys)
+
+    def invalidate(self):
+        with self._lock:
+            self._df = None
+
+    def _position(self, recipe_id, expected_version):
+        # 手元のコピーで行の位置を求め、バージョンが変わっていたら競合として知らせる
+        position = self._index.get(recipe_id)
+        if position is None:
+            raise ConflictError('このレシピは他のユーザーによって削除されました。')
+        if expected_version is not None and str(expected_version) != self._df.at[position, 'バージョン']:
+            raise ConflictError('このレシピは他のユーザーによって先に更新されました。')
+        return position
+
+    def append_rows(self, rows):
+        # 手元のコピーに反映し、シートへの書き込みは後でまとめて行う
+        # 追加した行のレシピIDを返す
+        import pandas as pd
+        self.get()
+        with self._lock:
+            df = self._df
+            # シートから読み込んだ値と揃えるため、空の値は空文字にする
+            values = [['' if value is None else value for value in row[:VALUE_COLUMNS]] + [new_recipe_id(), '1'] for row in rows]
+            self._df = pd.concat([df, pd.DataFrame(values, columns=COLUMNS)], ignore_index=True)
+            for i, row in enumerate(values):
+                self._urls[url_key(row[0])] += 1
+                self._index[row[5]] = len(df) + i
+                self._ops.append(('append', row))
+            self.version += 1
+            return [row[5] for row in values]
+
+    def update_row(self, recipe_id, row, expected_version=None):
+        # expected_version を渡すと、そのバージョンのときだけ更新する（違えば ConflictError）
+        self.get()
+        with self._lock:
+            position = self._position(recipe_id, expected_version)
+            df = self._df.copy()
+            key = df.at[position, 'URL']
+            current_version = df.at[position, 'バージョン']
+            row = ['' if value is None else value for value in row[:VALUE_COLUMNS]]
+            row += [recipe_id, str(int(current_version or 1) + 1)]
+            df.iloc[position] = row
+            self._df = df
+            self._urls[url_key(key)] -= 1
+            self._urls[url_key(row[0])] += 1
+            self._ops.append(('update', recipe_id, row, current_version))
+            self.version += 1
+
+    def retag(self, ids, transform, dry_run=False):
+        # 指定したレシピのタグを transform で書き換え、変わる行の (ID, タイトル, 変更前, 変更後) を返す
+        # 手元のコピーはまとめて書き換え、シートには次の書き込みで1回のAPI呼び出しで送る（dry_run ならプレビューだけ）
+        self.get()
+        with self._lock:
+            df = self._df
+            rows = df[df['ID'].isin(set(ids))]
+            new_tags = rows['タグ'].map(transform)
+            changed = rows[new_tags.notna()]
+            changes = list(zip(changed['ID'], changed['タイトル'], changed['タグ'], new_tags[changed.index]))
+            if dry_run or not changes:
+                return changes
+            df = df.copy()
+            versions = df.loc[changed.index, 'バージョン']
+            df.loc[changed.index, 'タグ'] = new_tags[changed.index]
+            df.loc[changed.index, 'バージョン'] = (versions.replace('', '1').astype(int) + 1).astype(str)
+            for position, current_version in versions.items():
+                self._ops.append(('update', df.at[position, 'ID'], df.loc[position].tolist(), current_version))
+            self._df = df
+            self.version += 1
+            return changes
+
+    def delete_row(self, recipe_id, expected_version=None):
+        self.get()
+        with self._lock:
+            position = self._position(recipe_id, expected_version)
+            df = self._df
+            self._urls[url_key(df.at[position, 'URL'])] -= 1
+            self._ops.append(('delete', recipe_id, df.at[position, 'バージョン']))
+            self._df = df.drop(position).reset_index(drop=True)
+            self._index = {recipe_id: i for i, recipe_id in enumerate(self._df['ID'])}
+            self.version += 1
+
+    def status(self):
+        with self._lock:
+            return {
+                'pending': len(self._ops),
+                'last_flush': self.last_flush,
+                'last_error': self.last_error,
+                'retry_at': self._retry_at if self._attempt else None,
+                'conflicts': list(self.conflicts),
+            }
+
+    def _run(self):
+        # 一定間隔で溜まった変更を書き込む（失敗時はバックオフした時刻まで待つ）
+        while True:
+            time.sleep(self.flush_interval)
+            if self._ops and time.monotonic() >= self._retry_at:
+                self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            ops, self._ops = self._ops, []
+        if not ops:
+            return True
+
+        appends, updates, deletes = coalesce(ops)
+        conflicts = []
+        try:
+            if updates or deletes:
+                # レシピIDから現在の行番号とバージョンを求める（読み込みは1回だけ）
+                rows = {}
+                for i, values in enumerate(_call('get_ids', self.worksheet.get, f'{ID_COLUMN}2:{VERSION_COLUMN}')):
+                    recipe_id, version = (values + ['', ''])[:2]
+                    rows.setdefault(recipe_id, (i + 2, version))
+
+                # 他のプロセスが先に変更・削除した行への変更は、上書きせずに競合として破棄する
+                expected_versions = {key: expected for key, (_, expected) in updates.items()}
+                expected_versions.update(deletes)
+                for recipe_id, expected in expected_versions.items():
+                    if recipe_id not in rows:
+                        conflicts.append((recipe_id, '他のユーザーによって削除されていました'))
+                    elif rows[recipe_id][1] != expected:
+                        conflicts.append((recipe_id, '他のユーザーによって先に更新されていました'))
+                for recipe_id, _ in conflicts:
+                    updates.pop(recipe_id, None)
+                    deletes.pop(recipe_id, None)
+                if conflicts:
+                    with self._lock:
+                        self.conflicts.extend({'ID': recipe_id, '理由': reason, '時刻': time.time()} for recipe_id, reason in conflicts)
+
+                data = [
+                    {'range': f'A{rows[key][0]}:{VERSION_COLUMN}{rows[key][0]}', 'values': [row]}
+                    for key, (row, _) in updates.items()
+                ]
+                if data:
+                    _call('batch_update', self.worksheet.batch_update, data)
+                    tracing.incr('rows_written', len(data))
+                updates = {}
+
+                # 下の行から削除して行番号がずれないようにする
+                requests = [
+                    {'deleteDimension': {'range': {
+                        'sheetId': self.worksheet.id, 'dimension': 'ROWS',
+                        'startIndex': row - 1, 'endIndex': row,
+                    }}}
+                    for row in sorted((rows[key][0] for key in deletes), reverse=True)
+                ]
+                if requests:
+                    _call('delete_rows', self.spreadsheet.batch_update, {'requests': requests})
+                    tracing.incr('rows_written', len(requests))
+                deletes = {}
+
+            if appends:
+                _call('append_rows', self.worksheet.append_rows, appends)
+                tracing.incr('rows_written', len(appends))
+                appends = []
+            modified_time = self._fetch_modified_time()
+        except Exception as e:
+            # 送信できなかった変更は、その後に記録された変更より前に戻して再試行する
+            with self._lock:
+                self._ops = _to_ops(appends, updates, deletes) + self._ops
+                self._attempt += 1
+                # 利用上限などの一時的なエラーは指数バックオフ、それ以外は最大の間隔で再試行する
+                if is_retryable(e):
+                    delay = backoff_delay(self._attempt, maximum=RETRY_MAX_DELAY)
+                else:
+                    delay = RETRY_MAX_DELAY
+                self._retry_at = time.monotonic() + delay
+                self.last_error = str(e)
+            return False
+
+        with self._lock:
+            self._attempt = 0
+            self._retry_at = 0
+            self.last_error = None
+            self.last_flush = time.time()
+            # 自分の書き込みによる更新時刻を記録して、再取得の対象にしない
+            self._modified_time = modified_time
+            self._checked_at = time.monotonic()
+            if conflicts:
+                # 手元のコピーが他のプロセスの変更とずれているので、次の参照時に読み直す
+                self._modified_time = None
+                self._checked_at = 0
+        return True
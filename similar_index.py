@@ -0,0 +1,392 @@
+import argparse
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from search_index import tokenize
+from tag_index import split_tags
+import tracing
+
+# 類似レシピの行列を保存するファイル
+INDEX_FILE = 'similar_index.npz'
+# 特徴量の作り方を変えたら上げる（保存した行列を使わずに作り直す）
+FEATURE_VERSION = '1'
+# 項目ごとの重み（タイトル・メモ・材料名の文字のバイグラム、タグ、材料名）
+FIELD_WEIGHTS = {'title': 2.0, 'memo': 0.5, 'ingredients': 1.0, 'tag': 3.0, 'ingredient': 3.0}
+# 表示する件数
+TOP_K = 5
+# 削除・更新で使わなくなった行がこの割合を超えたら行列を詰める
+COMPACT_RATIO = 0.25
+# 編集を反映してからファイルに書き込むまでの待ち時間（秒）
+SAVE_DELAY = 30
+
+# 材料の行の先頭の記号や「A:」のようなグループ名、括弧書きの補足、名前の後ろの分量
+INGREDIENT_MARK = re.compile(r'^(?:[\W_]|[a-z](?=[\s:]))+')
+INGREDIENT_NOTE = re.compile(r'\(.*?\)|\[.*?\]|【.*?】|「.*?」')
+QUANTITY = re.compile(r'[\s:…]|\d|大さじ|小さじ|少々|適量|適宜|ひとつまみ|お好みで')
+# 手持ちの材料の区切り
+PANTRY_SEPARATOR = re.compile(r'[,、\n\s/・]+')
+
+def ingredient_name(line):
+    # 「・鶏もも肉（皮なし） 300g」のような材料の行から名前だけを取り出す
+    text = unicodedata.normalize('NFKC', line).lower()
+    text = INGREDIENT_MARK.sub('', INGREDIENT_NOTE.sub(' ', text))
+    return QUANTITY.split(text, 1)[0].strip()
+
+def features(title, memo, tags, ingredients):
+    # レシピを「語 -> 重み」にする（文字のバイグラムは w:、タグは t:、材料名は i: を付けて区別する）
+    names = [ingredient_name(line) for line in ingredients.splitlines()] if isinstance(ingredients, str) else []
+    names = [name for name in names if name]
+    weights = Counter()
+    for field, text in (('title', title), ('memo', memo), ('ingredients', ' '.join(names))):
+        for token in tokenize(text):
+            weights['w:' + token] += FIELD_WEIGHTS[field]
+    for tag in split_tags(tags):
+        weights['t:' + unicodedata.normalize('NFKC', tag).lower()] += FIELD_WEIGHTS['tag']
+    for name in names:
+        weights['i:' + name] += FIELD_WEIGHTS['ingredient']
+    return weights
+
+def pantry_features(text):
+    # 手持ちの材料（カンマ・読点・空白・改行区切り）を材料の行として扱う
+    parts = PANTRY_SEPARATOR.split(text) if isinstance(text, str) else []
+    return features(None, None, None, '\n'.join(part for part in parts if part))
+
+def _fields(recipe):
+    return recipe.get('タイトル'), recipe.get('メモ'), recipe.get('タグ'), recipe.get('材料')
+
+class SimilarIndex:
+    # 正規化したTF-IDFの疎行列（1行が1レシピ）で、コサイン類似度の上位のレシピを求める
+    # 保存・編集されたレシピは行を追加して反映し、古い行は0にしておいて後でまとめて詰める
+    # IDFは作り直したときの値を使い続ける（追加した行だけ、その時点の文書頻度で重みを付ける）
+    def __init__(self, path=None, save_delay=SAVE_DELAY):
+        self.path = path
+        self.save_delay = save_delay
+        self._lock = threading.RLock()
+        # 語 -> 列番号、列ごとの文書頻度
+        self._terms = {}
+        self._df = None
+        # 行番号 -> レシピID、使っている行かどうか、レシピID -> 行番号
+        self._ids = []
+        self._alive = None
+        self._row_of = {}
+        self._matrix = None
+        # 行列の中身（行を追加するたびに全体をコピーしないよう、余裕を持たせて確保する）
+        self._data = None
+        self._indices = None
+        self._indptr = None
+        self._dead = 0
+        self.version = None
+        # ファイルへの書き込みの順序（古い内容で新しい内容を上書きしない）
+        self._save_lock = threading.Lock()
+        self._save_seq = 0
+        self._saved_seq = 0
+        # まだファイルに書き込んでいない変更があるか
+        self._dirty = False
+        self._timer = None
+        self._rebuild_thread = None
+        self.rebuilding = False
+        # 終了時に書き込み待ちの変更を保存する
+        atexit.register(self.save)
+
+    def rebuild(self, items, version=None):
+        # (レシピID, タイトル, メモ, タグ, 材料) の組から行列を作り直す
+        import numpy as np
+        from scipy import sparse
+        terms = {}
+        ids = []
+        rows, cols, values = array('q'), array('q'), array('d')
+        for recipe_id, *fields in items:
+            for term, weight in features(*fields).items():
+                rows.append(len(ids))
+                cols.append(terms.setdefault(term, len(terms)))
+                values.append(weight)
+            ids.append(recipe_id)
+        rows = np.frombuffer(rows, dtype=np.int64)
+        cols = np.frombuffer(cols, dtype=np.int64)
+        df = np.bincount(cols, minlength=len(terms))
+        data = self._weights(np.frombuffer(values, dtype=np.float64), rows, cols, df, len(ids))
+        matrix = sparse.csr_matrix((data, (rows, cols)), shape=(len(ids), len(terms)))
+        with self._lock:
+            self._terms = terms
+            self._df = df
+            self._ids = ids
+            self._alive = np.ones(len(ids), dtype=bool)
+            self._row_of = {recipe_id: row for row, recipe_id in enumerate(ids)}
+            self._set_matrix(matrix)
+            self._dead = 0
+            self.version = version
+            self._dirty = True
+        # 作り直した行列はすぐに書き込む（書き込み中も検索は止めない）
+        self.save()
+
+    def rebuild_in_background(self, load):
+        # load() が返す (データのバージョン, レシピ) から、保存と同じバックグラウンドのスレッドで作り直す
+        # 作り直している間は古い行列で答え、終わったら入れ替える（同時に作り直すのは1つだけ）
+        with self._lock:
+            if self.rebuilding:
+                return False
+            self.rebuilding = True
+
+        def run():
+            try:
+                version, items = load()
+                with tracing.span('rebuild_similar_index'):
+                    self.rebuild(items, version)
+            finally:
+                self.rebuilding = False
+        self._rebuild_thread = threading.Thread(target=run, daemon=True)
+        self._rebuild_thread.start()
+        return True
+
+    @staticmethod
+    def _weights(values, rows, cols, df, n_docs):
+        # 対数をとった重みにIDFを掛け、行ごとに長さ1にする
+        import numpy as np
+        idf = np.log((1 + n_docs) / (1 + df)) + 1
+        data = np.log1p(values) * idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=data ** 2))
+        return (data / norms[rows]).astype(np.float32)
+
+    def _set_matrix(self, matrix):
+        self._data = matrix.data
+        self._indices = matrix.indices
+        self._indptr = matrix.indptr
+        self._matrix = matrix
+
+    @staticmethod
+    def _reserve(buffer, used, size):
+        # 足りなければ2倍ずつ広げる（行の追加は平均すると追加した分のコピーで済む）
+        import numpy as np
+        if size <= len(buffer):
+            return buffer
+        grown = np.empty(max(size, 2 * len(buffer)), dtype=buffer.dtype)
+        grown[:used] = buffer[:used]
+        return grown
+
+    def _remove(self, recipe_id):
+        row = self._row_of.pop(recipe_id, None)
+        if row is None:
+            return
+        start, end = self._matrix.indptr[row], self._matrix.indptr[row + 1]
+        self._df[self._matrix.indices[start:end]] -= 1
+        self._matrix.data[start:end] = 0
+        self._alive[row] = False
+        self._dead += 1
+
+    def _append(self, added):
+        import numpy as np
+        from scipy import sparse
+        rows, cols, values = [], [], []
+        for row, weights in enumerate(added.values()):
+            for term, weight in weights.items():
+                rows.append(row)
+                cols.append(self._terms.setdefault(term, len(self._terms)))
+                values.append(weight)
+        rows = np.array(rows, dtype=np.int64)
+        cols = np.array(cols, dtype=np.int64)
+        if len(self._terms) > len(self._df):
+            self._df = np.concatenate([self._df, np.zeros(len(self._terms) - len(self._df), dtype=self._df.dtype)])
+        np.add.at(self._df, cols, 1)
+        data = self._weights(np.array(values, dtype=np.float64), rows, cols, self._df, len(self._row_of) + len(added))
+        new_rows = sparse.csr_matrix((data, (rows, cols)), shape=(len(added), len(self._terms)))
+        # 行列全体をコピーせず、確保しておいた配列の後ろに新しい行を書き足す
+        base = len(self._ids)
+        nnz = int(self._indptr[base])
+        end, n_rows = nnz + new_rows.nnz, base + len(added)
+        self._data = self._reserve(self._data, nnz, end)
+        self._indices = self._reserve(self._indices, nnz, end)
+        self._indptr = self._reserve(self._indptr, base + 1, n_rows + 1)
+        self._data[nnz:end] = new_rows.data
+        self._indices[nnz:end] = new_rows.indices
+        self._indptr[base + 1:n_rows + 1] = new_rows.indptr[1:] + nnz
+        self._matrix = sparse.csr_matrix(
+            (self._data[:end], self._indices[:end], self._indptr[:n_rows + 1]),
+            shape=(n_rows, len(self._terms)), copy=False
+        )
+        self._alive = np.concatenate([self._alive, np.ones(len(added), dtype=bool)])
+        for offset, recipe_id in enumerate(added):
+            self._ids.append(recipe_id)
+            self._row_of[recipe_id] = base + offset
+
+    def _compact(self):
+        import numpy as np
+        alive = np.flatnonzero(self._alive)
+        matrix = self._matrix[alive]
+        matrix.eliminate_zeros()
+        self._set_matrix(matrix)
+        self._ids = [self._ids[row] for row in alive.tolist()]
+        self._alive = np.ones(len(self._ids), dtype=bool)
+        self._row_of = {recipe_id: row for row, recipe_id in enumerate(self._ids)}
+        self._dead = 0
+
+    def apply(self, expected_version, new_version, changes):
+        # 行列が直前のバージョンの場合だけ差分を反映する（TagIndex.apply と同じ）
+        # changes は (操作, レシピID, レシピの内容) の組で、操作が 'remove' なら内容は使わない
+        with self._lock:
+            if self.version is None or self.version != expected_version or new_version != expected_version + 1:
+                self.version = None
+                return False
+            added = {}
+            for action, recipe_id, recipe in changes:
+                self._remove(recipe_id)
+                added.pop(recipe_id, None)
+                if action != 'remove':
+                    added[recipe_id] = features(*_fields(recipe))
+            if added:
+                self._append(added)
+            if self._dead > COMPACT_RATIO * len(self._ids):
+                self._compact()
+            self.version = new_version
+            self._schedule_save()
+            return True
+
+    def _schedule_save(self):
+        # 編集のたびに行列全体を書き直さず、しばらく待ってからまとめて書き込む（_lock を取った状態で呼ぶ）
+        self._dirty = True
+        if self._timer is None and self.path:
+            self._timer = threading.Timer(self.save_delay, self.save)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def save(self):
+        # 書き込み待ちの変更があれば、その時点の内容を書き出す（使わなくなった行も、使っているかどうかと一緒に書く）
+        if not self.path:
+            return
+        import numpy as np
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty or self._matrix is None:
+                return
+            # 書き込み中にも変更される配列（行の重み・使っている行・文書頻度）はコピーしておく
+            arrays = {
+                'data': self._matrix.data.copy(), 'indices': self._matrix.indices, 'indptr': self._matrix.indptr,
+                'shape': np.array(self._matrix.shape), 'ids': np.array(self._ids), 'alive': self._alive.copy(),
+                'terms': np.array(list(self._terms)), 'df': self._df.copy(),
+                'meta': np.array(json.dumps({'feature_version': FEATURE_VERSION, 'version': self.version})),
+            }
+            self._dirty = False
+            self._save_seq += 1
+            seq = self._save_seq
+        # 書き込み中もロックを離して検索や編集の反映を止めない
+        self._write(seq, arrays)
+
+    def _write(self, seq, arrays):
+        # 一時ファイルに書き、置き換える
+        import numpy as np
+        with self._save_lock:
+            if seq < self._saved_seq:
+                return
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.path)
+            self._saved_seq = seq
+
+    def flush(self):
+        # バックグラウンドの作り直しが終わるのを待ち、書き込み待ちの変更を書き込む
+        thread = self._rebuild_thread
+        if thread is not None:
+            thread.join()
+        self.save()
+
+    def load(self, version):
+        # 保存した行列が指定したデータのバージョンのものなら読み込む
+        if not self.path or not os.path.exists(self.path):
+            return False
+        import numpy as np
+        from scipy import sparse
+        try:
+            with np.load(self.path) as f:
+                if json.loads(str(f['meta'])) != {'feature_version': FEATURE_VERSION, 'version': version}:
+                    return False
+                matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+                ids = f['ids'].tolist()
+                alive = f['alive']
+                terms = f['terms'].tolist()
+                df = f['df']
+        except (OSError, ValueError, KeyError):
+            # 壊れたファイルは無視して作り直す
+            return False
+        with self._lock:
+            self._terms = {term: column for column, term in enumerate(terms)}
+            self._df = df
+            self._ids = ids
+            self._alive = alive
+            self._row_of = {ids[row]: row for row in np.flatnonzero(alive).tolist()}
+            self._set_matrix(matrix)
+            self._dead = len(ids) - len(self._row_of)
+            self.version = version
+            self._dirty = False
+        return True
+
+    def _top(self, vector, k, exclude=None):
+        # 全てのレシピとの類似度を1回の疎行列とベクトルの積で求め、上位k件を選ぶ
+        import numpy as np
+        scores = self._matrix @ vector
+        if exclude is not None:
+            scores[exclude] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(self._ids[row], float(scores[row])) for row in candidates]
+
+    def similar(self, recipe_id, k=TOP_K):
+        # 似ているレシピの (レシピID, 類似度) を類似度の高い順に返す
+        with self._lock:
+            row = self._row_of.get(recipe_id)
+            if row is None:
+                return []
+            return self._top(self._matrix[row].toarray().ravel(), k, exclude=row)
+
+    def query(self, text, k=TOP_K):
+        # 手持ちの材料で作れそうなレシピ（材料名とタイトルが多く重なるもの）を返す
+        import numpy as np
+        with self._lock:
+            if self._matrix is None or not self._ids:
+                return []
+            weights = [(self._terms[term], weight) for term, weight in pantry_features(text).items() if term in self._terms]
+            if not weights:
+                return []
+            columns = np.array([column for column, _ in weights])
+            idf = np.log((1 + len(self._row_of)) / (1 + self._df[columns])) + 1
+            vector = np.zeros(len(self._terms), dtype=np.float32)
+            vector[columns] = np.log1p([weight for _, weight in weights]) * idf
+            vector /= np.linalg.norm(vector)
+            return self._top(vector, k)
+
+    def __len__(self):
+        return len(self._row_of)
+
+def main():
+    parser = argparse.ArgumentParser(description='似ているレシピと、手持ちの材料で作れるレシピを表示します')
+    parser.add_argument('--id', type=int, help='似ているレシピを探すレシピのID')
+    parser.add_argument('--pantry', help='手持ちの材料（カンマ区切り）')
+    parser.add_argument('-k', type=int, default=TOP_K, help='表示する件数')
+    args = parser.parse_args()
+    if args.id is None and not args.pantry:
+        parser.error('--id か --pantry を指定してください')
+
+    from recipe_store import open_store
+    store = open_store()
+    index = SimilarIndex(INDEX_FILE)
+    version = store.data_version()
+    if not index.load(version):
+        start = time.perf_counter()
+        index.rebuild(store.iter_texts(), version)
+        print(f'{len(index)}件のレシピから行列を作りました（{time.perf_counter() - start:.2f}秒）')
+    results = index.similar(args.id, args.k) if args.id is not None else index.query(args.pantry, args.k)
+    titles = dict(store.get_titles(recipe_id for recipe_id, _ in results))
+    for recipe_id, score in results:
+        print(f'{score:.3f}\t{recipe_id}\t{titles.get(recipe_id)}')
+
+if __name__ == '__main__':
+    main()
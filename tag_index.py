@@ -0,0 +1,89 @@
+import threading
+
+def split_tags(tags):
+    # カンマ区切りのタグ文字列をタグのリストに分割する
+    if not isinstance(tags, str):
+        return []
+    return [tag.strip() for tag in tags.split(',') if tag.strip()]
+
+class TagIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        # タグ -> そのタグを持つレシピIDの集合（転置インデックス）
+        self._postings = {}
+        # レシピID -> タグのタプル（更新・削除時に元のタグを引くため）
+        self._tags_of = {}
+        self.version = None
+
+    def rebuild(self, items, version=None):
+        # (レシピID, タグ文字列) の組からインデックスを作り直す
+        with self._lock:
+            self._postings = {}
+            self._tags_of = {}
+            for recipe_id, tags in items:
+                self._add(recipe_id, tags)
+            self.version = version
+
+    def _add(self, recipe_id, tags):
+        tags = tuple(dict.fromkeys(split_tags(tags)))
+        self._tags_of[recipe_id] = tags
+        for tag in tags:
+            self._postings.setdefault(tag, set()).add(recipe_id)
+
+    def _remove(self, recipe_id):
+        for tag in self._tags_of.pop(recipe_id, ()):
+            posting = self._postings.get(tag)
+            if posting is None:
+                continue
+            posting.discard(recipe_id)
+            if not posting:
+                del self._postings[tag]
+
+    def add(self, recipe_id, tags):
+        with self._lock:
+            self._remove(recipe_id)
+            self._add(recipe_id, tags)
+
+    def remove(self, recipe_id):
+        with self._lock:
+            self._remove(recipe_id)
+
+    def apply(self, expected_version, new_version, changes):
+        # インデックスが直前のバージョンの場合だけ差分を反映する
+        # それ以外（他のプロセスの書き込みが挟まった等）は次回の参照時に作り直させる
+        with self._lock:
+            if self.version is None or self.version != expected_version or new_version != expected_version + 1:
+                self.version = None
+                return False
+            for action, recipe_id, tags in changes:
+                if action == 'remove':
+                    self._remove(recipe_id)
+                else:
+                    self._remove(recipe_id)
+                    self._add(recipe_id, tags)
+            self.version = new_version
+            return True
+
+    def query(self, tags):
+        # 全てのタグを持つレシピIDを昇順で返す（AND条件）
+        with self._lock:
+            postings = [self._postings.get(tag, set()) for tag in tags]
+            if not postings:
+                return sorted(self._tags_of)
+            # 件数の少ないポスティングから順に積集合を取る
+            postings.sort(key=len)
+            result = set(postings[0])
+            for posting in postings[1:]:
+                result &= posting
+                if not result:
+                    break
+            return sorted(result)
+
+    def counts(self):
+        with self._lock:
+            return {tag: len(posting) for tag, posting in self._postings.items()}
+
+    def all_tags(self):
+        # 件数が変わっても選択肢の順序が変わらないよう名前順で返す
+        with self._lock:
+            return sorted(self._postings)
@@ -0,0 +1,69 @@
+from tag_index import split_tags
+
+# タグを持つ全てのレシピが対象になる操作
+TAG_OPERATIONS = {
+    'rename': 'タグの名前を変更する',
+    'merge': '複数のタグを1つにまとめる',
+    'split': '1つのタグを複数のタグに分ける',
+    'delete': 'タグを削除する',
+}
+# 選んだレシピだけが対象になる操作
+SELECTION_OPERATIONS = {
+    'add': '選んだレシピにタグを付ける',
+    'remove': '選んだレシピからタグを外す',
+}
+# プレビューに表示する行数
+PREVIEW_ROWS = 100
+
+def validate_operation(op, sources, targets):
+    # 操作に必要なタグがそろっているかを確認し、問題があればその理由を返す
+    # sources は変更・削除するタグ、targets は新しいタグ（付けるタグ）
+    if op == 'rename' and (len(sources) != 1 or len(targets) != 1):
+        return '変更するタグと新しい名前を1つずつ指定してください'
+    if op == 'merge' and (len(sources) < 2 or len(targets) != 1):
+        return 'まとめるタグを2つ以上と、まとめた後のタグを1つ指定してください'
+    if op == 'split' and (len(sources) != 1 or len(targets) < 2):
+        return '分けるタグを1つと、分けた後のタグを2つ以上指定してください'
+    if op in ('delete', 'remove') and not sources:
+        return '削除するタグを指定してください'
+    if op == 'add' and not targets:
+        return '付けるタグを指定してください'
+    if op in ('rename', 'merge', 'split') and set(sources) == set(targets):
+        return 'タグが変わりません'
+    return None
+
+def replace_tags(tags, sources, targets):
+    # sources のタグを targets に置き換える（最初に見つかった位置に入れ、重複は除く）
+    result = []
+    for tag in split_tags(tags):
+        result.extend(targets if tag in sources else [tag])
+    return list(dict.fromkeys(result))
+
+def make_transform(op, sources, targets):
+    # タグの文字列を受け取り、変わる場合だけ新しいタグの文字列を返す関数を作る（変わらなければNone）
+    sources = set(sources)
+    targets = list(dict.fromkeys(targets))
+
+    def transform(tags):
+        current = split_tags(tags)
+        if op == 'add':
+            new_tags = list(dict.fromkeys(current + targets))
+        elif op == 'remove':
+            new_tags = [tag for tag in current if tag not in sources]
+        else:
+            new_tags = replace_tags(tags, sources, [] if op == 'delete' else targets)
+        return ','.join(new_tags) if new_tags != current else None
+    return transform
+
+def describe(op, sources, targets):
+    # プレビューの見出しに使う操作の説明
+    sources = '、'.join(sources)
+    targets = '、'.join(targets)
+    return {
+        'rename': f'「{sources}」を「{targets}」に変更',
+        'merge': f'「{sources}」を「{targets}」にまとめる',
+        'split': f'「{sources}」を「{targets}」に分ける',
+        'delete': f'「{sources}」を削除',
+        'add': f'「{targets}」を付ける',
+        'remove': f'「{sources}」を外す',
+    }[op]
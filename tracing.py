@@ -0,0 +1,189 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+# 再実行ごとの計測結果を1行1件のJSONで書き出すファイル
+TRACE_LOG_FILE = 'trace_log.jsonl'
+TRACE_LOG_MAX_BYTES = 5 * 1024 * 1024
+TRACE_LOG_BACKUPS = 3
+# Prometheusのテキスト形式で集計値を書き出すファイル
+METRICS_FILE = 'metrics.prom'
+METRIC_PREFIX = 'recipe_book'
+
+logger = logging.getLogger('recipe_book.trace')
+
+# 実行中のスパン（スレッドごと・Streamlitの再実行ごとに別になる）
+_current = contextvars.ContextVar('recipe_book_span', default=None)
+# プロセス全体の集計値
+_lock = threading.Lock()
+_span_totals = {}
+_counter_totals = {}
+_log_ready = False
+
+class Span:
+    def __init__(self, name, attrs, trace=None):
+        self.name = name
+        self.attrs = attrs
+        self.trace = trace
+        self.start = time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def to_dict(self, origin):
+        return {
+            'name': self.name,
+            'offset_ms': round((self.start - origin) * 1000, 3),
+            'duration_ms': round((self.duration or 0) * 1000, 3),
+            'attrs': self.attrs,
+            'children': [child.to_dict(origin) for child in self.children],
+        }
+
+class Trace:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self.counters = {}
+        self.root = Span(name, {}, self)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.id,
+            'started_at': self.started_at,
+            'counters': dict(self.counters),
+            'span': self.root.to_dict(self.root.start),
+        }
+
+def _record_span(name, duration):
+    with _lock:
+        total = _span_totals.setdefault(name, [0, 0.0])
+        total[0] += 1
+        total[1] += duration
+
+@contextmanager
+def span(name, **attrs):
+    # 処理時間を計測する（実行中のトレースがあればその子として記録する）
+    parent = _current.get()
+    current = Span(name, attrs, parent.trace if parent else None)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current.reset(token)
+        if parent:
+            parent.children.append(current)
+        _record_span(name, current.duration)
+
+def traced(name=None):
+    # 関数の呼び出しをスパンとして計測するデコレーター
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def incr(name, value=1):
+    # カウンターを増やす（集計値と、実行中のトレースの両方に反映する）
+    with _lock:
+        _counter_totals[name] = _counter_totals.get(name, 0) + value
+        current = _current.get()
+        if current and current.trace:
+            counters = current.trace.counters
+            counters[name] = counters.get(name, 0) + value
+
+@contextmanager
+def trace(name='rerun'):
+    # 1回の再実行全体を計測し、終わったらログと集計値のファイルに書き出す
+    current = Trace(name)
+    token = _current.set(current.root)
+    try:
+        yield current
+    except BaseException as e:
+        # st.experimental_rerun なども例外として届くので名前だけ記録する
+        current.root.attrs['exit'] = type(e).__name__
+        raise
+    finally:
+        current.root.duration = time.perf_counter() - current.root.start
+        _current.reset(token)
+        _record_span(name, current.root.duration)
+        _export(current)
+
+def _setup_log():
+    global _log_ready
+    if _log_ready:
+        return
+    _log_ready = True
+    if not logger.handlers and TRACE_LOG_FILE:
+        handler = RotatingFileHandler(TRACE_LOG_FILE, maxBytes=TRACE_LOG_MAX_BYTES, backupCount=TRACE_LOG_BACKUPS, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+def _export(current):
+    # 書き出しに失敗してもアプリの動作は止めない
+    try:
+        _setup_log()
+        logger.info(json.dumps(current.to_dict(), ensure_ascii=False))
+        if METRICS_FILE:
+            # 同時に終わった再実行が同じ一時ファイルを書き換えないよう、書き手ごとの一時ファイルから置き換える
+            directory = os.path.dirname(os.path.abspath(METRICS_FILE))
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, prefix=f'{os.path.basename(METRICS_FILE)}.', suffix='.tmp', delete=False) as f:
+                f.write(metrics_text())
+            try:
+                os.replace(f.name, METRICS_FILE)
+            except OSError:
+                os.remove(f.name)
+                raise
+    except OSError as e:
+        logging.getLogger(__name__).warning('計測結果を書き出せませんでした: %s', e)
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', f'{METRIC_PREFIX}_{name}')
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metrics_text():
+    # 集計値をPrometheusのテキスト形式で返す
+    with _lock:
+        spans = {name: list(total) for name, total in _span_totals.items()}
+        counters = dict(_counter_totals)
+
+    lines = []
+    metric = _metric_name('span_seconds')
+    lines.append(f'# HELP {metric} 処理ごとの所要時間（秒）')
+    lines.append(f'# TYPE {metric} summary')
+    for name in sorted(spans):
+        count, seconds = spans[name]
+        lines.append(f'{metric}_sum{{span="{_label(name)}"}} {seconds:.6f}')
+        lines.append(f'{metric}_count{{span="{_label(name)}"}} {count}')
+    for name in sorted(counters):
+        metric = _metric_name(f'{name}_total')
+        lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric} {counters[name]}')
+    return '\n'.join(lines) + '\n'
+
+def flatten(trace_dict):
+    # デバッグ表示用にスパンの木を (深さ, 名前, 所要時間ms, 属性) の行に平らにする
+    rows = []
+    def walk(span_dict, depth):
+        rows.append((depth, span_dict['name'], span_dict['duration_ms'], span_dict['attrs']))
+        for child in span_dict['children']:
+            walk(child, depth + 1)
+    walk(trace_dict['span'], 0)
+    return rows
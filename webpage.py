@@ -0,0 +1,166 @@
+import codecs
+import threading
+import time
+from page_parser import PageParser, sniff_encoding
+import tracing
+
+# 接続・読み込みのタイムアウト（秒）
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+# 1ページの取得にかける時間の上限（秒）
+TOTAL_TIMEOUT = 15
+# 1ページから読み込む最大バイト数
+MAX_BYTES = 512 * 1024
+CHUNK_SIZE = 16 * 1024
+# コネクションプールの設定
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 32
+# 一時的なエラーとして扱うステータスコード
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    # keep-aliveの接続を使い回すため、プロセス内で1つのセッションを共有する
+    global _session
+    with _session_lock:
+        if _session is None:
+            # 起動を速くするため、最初にページを取得するときに読み込む
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+def _response_encoding(response):
+    # Content-Typeにcharsetが明示されている場合だけ使う
+    if 'charset' in response.headers.get('Content-Type', '').lower():
+        try:
+            return codecs.lookup(response.encoding).name
+        except (LookupError, TypeError):
+            return None
+    return None
+
+def _decode_chunks(chunks, encoding):
+    # 文字コードの指定が無ければ最初のチャンクの<meta charset>から決め、少しずつ文字列にする
+    decoder = None
+    for chunk in chunks:
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(encoding or sniff_encoding(chunk))(errors='replace')
+        yield len(chunk), decoder.decode(chunk)
+    if decoder is not None:
+        yield 0, decoder.decode(b'', final=True)
+
+def _read_chunks(response, deadline, chunk_size=CHUNK_SIZE):
+    # iter_content は chunk_size がそろうまで待ち、READ_TIMEOUT も1回の受信ごとにかかるため、
+    # 少しずつ送ってくるサーバーだと上限の時間を過ぎても読み続けてしまう
+    # 届いている分だけを読み（read1）、待つ時間も残りの時間までにする
+    import requests
+    from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
+    raw = response.raw
+    sock = getattr(raw.connection, 'sock', None)
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if sock is not None:
+            sock.settimeout(min(READ_TIMEOUT, remaining))
+        # 例外は iter_content と同じ requests の例外にして返す
+        try:
+            chunk = raw.read1(chunk_size, decode_content=True)
+        except ReadTimeoutError as e:
+            if time.monotonic() >= deadline:
+                return
+            raise requests.ConnectionError(e)
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        if not chunk:
+            return
+        yield chunk
+
+def fetch_head(url, headers=None, max_bytes=MAX_BYTES):
+    # ページを読みながら1回だけ解析し、必要な情報がそろった時点で読むのをやめる
+    # JSON-LDは本文に書かれることも多いので、<head>の後もRecipeが見つかるか、本文の先頭にJSON-LDが無いと分かるまで読む
+    session = get_session()
+    deadline = time.monotonic() + TOTAL_TIMEOUT
+    with session.get(url, headers=headers, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+        if response.status_code == 304:
+            return response, None
+
+        parser = PageParser()
+        received = 0
+        for size, text in _decode_chunks(_read_chunks(response, deadline), _response_encoding(response)):
+            received += size
+            parser.feed(text)
+            if parser.is_done() or received >= max_bytes:
+                break
+        tracing.incr('bytes_fetched', received)
+    # 途中でやめた場合も、解析しきれずに残っている部分を処理してから結果を作る
+    parser.close()
+    return response, parser.result(url)
+
+def page_details(url, cache):
+    # 取得済みのページから、保存するレシピに加える項目を返す（未取得なら空）
+    details = cache.details(url) if cache is not None else {}
+    ingredients = details.get('ingredients')
+    return {
+        '正規URL': details.get('canonical_url'),
+        '材料': '\n'.join(ingredients) if ingredients else None,
+        '調理時間': details.get('cook_time'),
+        '分量': details.get('yield'),
+    }
+
+def fetch_webpage_info(url, cache=None, retry_failed=False):
+    # 少し前に失敗したURLは、再び取得しに行かずに同じエラーにする（retry_failed なら取得し直す）
+    if cache is not None and not retry_failed:
+        error = cache.failure(url)
+        if error is not None:
+            tracing.incr('page_cache_failure_hits')
+            raise error.with_traceback(None)
+
+    entry = cache.get(url) if cache is not None else None
+    if entry and cache.is_fresh(entry):
+        tracing.incr('page_cache_hits')
+        return entry['title'], entry['img_url']
+    tracing.incr('page_cache_misses')
+
+    # 期限切れのキャッシュがあれば条件付きGETで再検証する
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    try:
+        with tracing.span('http_get', url=url):
+            response, info = fetch_head(url, headers)
+        tracing.incr('http_requests')
+        if response.status_code == 304 and entry:
+            tracing.incr('page_cache_revalidated')
+            cache.touch(url)
+            return entry['title'], entry['img_url']
+        # エラーページのタイトルや画像をレシピとして返さないよう、2xx以外は全てエラーにする
+        # （429と5xxは bulk_import で再試行される）
+        if not 200 <= response.status_code < 300:
+            import requests
+            raise requests.HTTPError(f'{response.status_code} {response.reason}: {url}', response=response)
+    except Exception as e:
+        if cache is not None:
+            cache.put_failure(url, e)
+        raise
+
+    if cache is not None:
+        cache.put(
+            url, info['title'], info['img_url'],
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            details={key: info[key] for key in ('canonical_url', 'ingredients', 'cook_time', 'yield')},
+        )
+    return info['title'], info['img_url']